@@ -0,0 +1,83 @@
+"""Transparent streaming compression of the files of the DNS pipeline (elastic_search.py and csv_transformation.py).
+
+The compression of a file is selected by its extension: '.gz' is gzip, '.zst' is zstd (with the optional
+'zstandard' package), anything else is a plain file. open_file() returns a file object like open() does, and every
+read or write goes through the (de)compressor chunk by chunk, a whole file is never decompressed in memory.
+Appending to a compressed file adds a new gzip member or zstd frame, the readers read across them.
+
+The intermediate files of both scripts get the suffix of the DNS_COMPRESSION environment variable
+('gz', 'zst' or empty for plain CSV), so the two scripts of a daily run agree on the file names:
+    DNS_COMPRESSION=gz python elastic_search.py && DNS_COMPRESSION=gz python csv_transformation.py
+"""
+import gzip
+import io
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {'': '', 'none': '', 'gz': '.gz', 'gzip': '.gz', 'zst': '.zst', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compression_suffix(compression=None):
+    """
+    Return the file suffix of a compression name, DNS_COMPRESSION by default.
+
+    Raises:
+        ValueError: If the compression is unknown.
+        RuntimeError: If the compression is zstd and the 'zstandard' package is not installed.
+    """
+    if compression is None:
+        compression = os.getenv('DNS_COMPRESSION', '')
+    compression = compression.lower()
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f'unknown compression {compression!r}, expected one of {sorted(COMPRESSION_SUFFIXES)}')
+    suffix = COMPRESSION_SUFFIXES[compression]
+    if suffix == '.zst' and zstandard is None:
+        raise RuntimeError("zstd compression needs the 'zstandard' package: pip install zstandard")
+    return suffix
+
+
+def is_compressed(file_name):
+    """Return True if the file is read and written through a compressor, so it cannot be seeked or truncated."""
+    return file_name.endswith(('.gz', '.zst'))
+
+
+def open_file(file_name, mode='r', encoding='utf-8', newline=None, level=None, buffering=-1):
+    """
+    Open a plain, gzip or zstd file, selected by its extension, like open().
+
+    Args:
+        file_name (str): The path to the file.
+        mode (str): 'r', 'w', 'a' or 'x', with 'b' for a binary file object.
+        encoding (str): The encoding of a text file object.
+        newline (str, optional): The newline mode of a text file object, '' for the csv module.
+        level (int, optional): The compression level of a written file.
+        buffering (int): The buffer size of a plain file, like open().
+
+    Returns:
+        A file object, to be used as a context manager.
+    """
+    binary = 'b' in mode
+    base_mode = mode.replace('b', '').replace('t', '')
+    if file_name.endswith('.gz'):
+        if binary:
+            return gzip.open(file_name, base_mode + 'b', compresslevel=level or GZIP_LEVEL)
+        return gzip.open(file_name, base_mode + 't', compresslevel=level or GZIP_LEVEL, encoding=encoding, newline=newline)
+    if file_name.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"cannot open {file_name}: zstd compression needs the 'zstandard' package")
+        if base_mode == 'r':
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), read_across_frames=True, closefd=True))
+        else:
+            stream = zstandard.ZstdCompressor(level=level or ZSTD_LEVEL).stream_writer(open(file_name, base_mode + 'b'), closefd=True)
+        if binary:
+            return stream
+        return io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+    if binary:
+        return open(file_name, mode, buffering=buffering)
+    return open(file_name, mode, buffering=buffering, encoding=encoding, newline=newline)
@@ -1,34 +1,96 @@
 '''The logic of this script:
-Look up reversed fqdns.
+Look up reversed fqdns: every distinct 'in-addr.arpa' name is resolved once, concurrently, by an in-process DNS client
+(--dns-server, --dns-timeout, --dns-attempts, --dns-workers; fake_dns_server.py is a local stub server to test it).
+The results are kept between runs in the 'ptr_cache.sqlite' cache (per-entry TTL, negative caching, LRU eviction),
+only the new or expired names are resolved.
+With --streaming the steps up to the provider columns are fused: the original file is read once and the final one
+written once (transform_streaming).
+With --month-store the day is upserted into a sqlite store of the month quantities (MonthStore) instead of rewriting
+the month file, which is exported on demand (--export-month).
+With --count-workers the counting is sharded by byte ranges over a process pool (count_queries_parallel).
+With --compact the FQDNs are interned once (FqdnTable) and the counts kept in typed arrays.
+With --sketch-dir the counted day is also summarized in a mergeable sketch (dns_sketches.py) for the top-N and
+distinct-count reports, over the rows with a provider like the month file.
+With DNS_COMPRESSION=gz (or zst) the daily, mapping and month files are read and written through streaming
+gzip (zstd) compression, selected by their '.gz' ('.zst') suffix (compressed_files.py).
+--date or --from-date/--to-date transform other days than yesterday: the days are built in a pool of --processes
+processes (run_days), then merged into their month files one by one in date order. The files of every day
+(day_files, with the mapping file 'updated_values_<day>.csv'), the default month file and the metrics are in
+--workdir, the paths of the other options are relative to the current directory.
+Every stage is recorded in the run manifest of the day (RunManifest): a rerun skips the stages whose inputs and
+outputs are unchanged and never appends the day to the month file twice.
+Every stage is also measured (StageMetrics: wall and CPU time, rows and bytes in/out, peak RSS) and the measurements
+of the run are written to 'run_metrics_<first day>_<run start time>-<pid>.json' and '.prom' (OpenMetrics, --metrics-file, --no-metrics);
+--profile-stage runs one stage under cProfile.
+With --history-dir the closed month becomes a sorted partition of a HistoryStore instead of being appended to
+'dns_full_data.csv'; --history-totals computes the yearly or all-time totals by a bounded external merge.
 If today is the 1st day of the month, create a file named "month_YYYY.csv"; otherwise, use the file for this month.
 Create a dictionary mapping the reversed fqdn to the normal one (if found) and write them in 'updated_values.csv'.
 Create a new file 'dns_result_{FROM_DATE}' replacing reversed fqdns with normal ones.
 Count the number of occurrences and write it to a CSV file.
-Map fqdns to server providers (reading from 'file_to_match' CSV file).
+Map fqdns to server providers (reading from 'file_to_match' CSV file, matched by an Aho-Corasick index built once).
 When finding the right value, check what row it is.
 Take the values from this exact row and put them in the final CSV columns 3, 4, 5, 6.
 Append today's data into a monthly file.
 Check that the names of the queries are unique and sum up their values.
 If today is the last day of the month, append this month's data to the final 'dns_full_data.csv' file and check if the names of the queries are unique. Otherwise, continue the above logic.'''
 
+import argparse
+from array import array
+import cProfile
 import csv
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import pickle
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
 import datetime
-import subprocess
 import logging
 import csv
 import os
 import collections
+import random
+import resource
+import socket
+import sqlite3
+import struct
+import time
+
+import dns_sketches
+from compressed_files import compression_suffix, is_compressed, open_file
 
-logging.basicConfig(filename='csv_transformation.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 today = date.today()
 yesterday = today - timedelta(days=1)
 FROM_DATE = yesterday.strftime("%Y-%m-%d")
 TO_DATE = today.strftime("%Y-%m-%d")
-original_csv_file = f'dns_result_original_{FROM_DATE}.csv'
+# '.gz' or '.zst' with DNS_COMPRESSION, see compressed_files.py
+OUTPUT_SUFFIX = compression_suffix()
+original_csv_file = f'dns_result_original_{FROM_DATE}.csv{OUTPUT_SUFFIX}'
 file_to_match = 'file_to_match.csv'
-final_file = f'dns_result_{FROM_DATE}.csv'
-
+final_file = f'dns_result_{FROM_DATE}.csv{OUTPUT_SUFFIX}'
+updated_values_file = f'updated_values.csv{OUTPUT_SUFFIX}'
+DNS_TIMEOUT = 2.0
+DNS_ATTEMPTS = 2
+DNS_WORKERS = 64
+DNS_TYPE_PTR = 12
+DNS_CLASS_IN = 1
+DNS_RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+ptr_cache_file = 'ptr_cache.sqlite'
+month_store_file = 'dns_months.sqlite'
+history_directory = 'dns_history'
+HISTORY_FAN_IN = 16
+run_manifest_file = f'run_manifest_{FROM_DATE}.json'
+PTR_CACHE_TTL = 7 * 86400
+PTR_NEGATIVE_TTL = 86400
+PTR_FAILURE_TTL = 3600
+PTR_CACHE_SIZE = 1000000
+# the bytes of the month file hashed before appending a day, to check that the file was not rewritten before truncating it
+MONTH_TAIL_BYTES = 64 * 1024
 
 
 def is_first_day_of_month():
@@ -49,56 +111,297 @@ def is_first_day_of_month():
     first_of_month = datetime.datetime.now()
     if first_of_month.day == 1:
         month_year = first_of_month.strftime("%B_%Y")
-        month_file_name = f"{month_year.lower()}.csv"
-        with open(month_file_name, 'w', newline='', encoding='utf-8') as file:
+        month_file_name = f"{month_year.lower()}.csv{OUTPUT_SUFFIX}"
+        with open_file(month_file_name, 'w', newline='') as file:
             writer = csv.writer(file)
             writer.writerow(['query', 'total quantity', 'service provider name', 'sid'])
         logging.info('is_first_day_of_month(): Created a csv file for the current month')
         return month_file_name
 
 
-def reversed_values_lookup():
+def default_dns_server(resolv_conf='/etc/resolv.conf'):
+    """Return the first nameserver of resolv.conf, 127.0.0.1 if there is none."""
+    try:
+        with open(resolv_conf, 'r', encoding='utf-8') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    return parts[1]
+    except OSError as e:
+        logging.error('default_dns_server(): Could not read %s: %s', resolv_conf, e)
+    return '127.0.0.1'
+
+
+def build_ptr_query(name, query_id):
+    """Build the wire format of a recursive PTR query for the given name."""
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    labels = b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.rstrip('.').split('.'))
+    return header + labels + b'\x00' + struct.pack('!HH', DNS_TYPE_PTR, DNS_CLASS_IN)
+
+
+def read_dns_name(message, offset):
+    """
+    Read a possibly compressed domain name from a DNS message.
+
+    Returns:
+        tuple: The name with a trailing dot, like the 'host' command prints it, and the offset after the name.
+    """
+    labels = []
+    end = None
+    for _ in range(128):
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | message[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(message[offset:offset + length].decode('ascii', errors='replace'))
+        offset += length
+    else:
+        raise ValueError('too many labels or a compression loop in the DNS answer')
+    return '.'.join(labels) + '.', end if end is not None else offset
+
+
+def parse_ptr_response(message, query_id):
+    """
+    Parse the answer to a PTR query.
+
+    Returns:
+        tuple: The response code name ('NOERROR', 'NXDOMAIN', 'SERVFAIL', ...), the first PTR hostname
+            (None if there is none) and its TTL in seconds (the SOA minimum of a negative answer is not read, 0).
+    """
+    response_id, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', message[:12])
+    if response_id != query_id or not flags & 0x8000:
+        raise ValueError('not the response to this query')
+    rcode = DNS_RCODES.get(flags & 0x000F, f'RCODE{flags & 0x000F}')
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = read_dns_name(message, offset)
+        offset += 4
+    for _ in range(ancount):
+        _, offset = read_dns_name(message, offset)
+        record_type, _, ttl, rdlength = struct.unpack('!HHIH', message[offset:offset + 10])
+        offset += 10
+        if record_type == DNS_TYPE_PTR:
+            hostname, _ = read_dns_name(message, offset)
+            return rcode, hostname, ttl
+        offset += rdlength
+    return rcode, None, 0
+
+
+def resolve_ptr(name, server, timeout=DNS_TIMEOUT, attempts=DNS_ATTEMPTS, port=53):
+    """
+    Resolve one reverse 'in-addr.arpa' name over UDP, in-process.
+
+    Every attempt waits at most 'timeout' seconds for the answer, answers with another id are ignored.
+
+    Args:
+        name (str): The reverse name, e.g. '4.3.2.1.in-addr.arpa'.
+        server (str): The IP address of the DNS server.
+        timeout (float): The timeout of one attempt, in seconds.
+        attempts (int): The number of attempts before giving up with 'TIMEOUT'.
+        port (int): The UDP port of the DNS server.
+
+    Returns:
+        tuple: The status ('NOERROR', 'NXDOMAIN', 'SERVFAIL', 'TIMEOUT', 'ERROR', ...), the hostname or None and its TTL.
+    """
+    for attempt in range(attempts):
+        query_id = random.getrandbits(16)
+        with socket.socket(socket.AF_INET6 if ':' in server else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            deadline = time.monotonic() + timeout
+            try:
+                sock.sendto(build_ptr_query(name, query_id), (server, port))
+                while True:
+                    message, _ = sock.recvfrom(4096)
+                    try:
+                        return parse_ptr_response(message, query_id)
+                    except (ValueError, IndexError, struct.error):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise socket.timeout()
+                        sock.settimeout(remaining)
+            except socket.timeout:
+                logging.debug('resolve_ptr(): Attempt %s for %s timed out', attempt + 1, name)
+            except OSError as e:
+                logging.error('resolve_ptr(): Could not query %s for %s: %s', server, name, e)
+                return 'ERROR', None, 0
+    return 'TIMEOUT', None, 0
+
+
+def resolve_ptrs(names, server=None, timeout=DNS_TIMEOUT, attempts=DNS_ATTEMPTS, workers=DNS_WORKERS, port=53):
+    """
+    Resolve the distinct reverse names concurrently, at most 'workers' queries in flight.
+
+    Args:
+        names (iterable): The distinct reverse names.
+        server (str, optional): The IP address of the DNS server, the first nameserver of resolv.conf by default.
+        timeout (float): The timeout of one attempt, in seconds.
+        attempts (int): The number of attempts of every name.
+        workers (int): The maximum number of concurrent queries.
+        port (int): The UDP port of the DNS server.
+
+    Returns:
+        dict: The (status, hostname, ttl) result of every name, see resolve_ptr.
+    """
+    server = server or default_dns_server()
+    names = list(names)
+    results = {}
+    statuses = collections.Counter()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(resolve_ptr, name, server, timeout, attempts, port): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            results[name] = future.result()
+            statuses[results[name][0]] += 1
+    logging.info('resolve_ptrs(): Resolved %s names via %s in %.1fs: %s', len(names), server, time.monotonic() - started, dict(statuses))
+    return results
+
+
+class PtrCache:
     """
-    Search for matches for reversed queries and implement lookup commands.
+    An on-disk sqlite cache of the PTR lookups, so a daily run only resolves the names that are new or expired.
 
-    This function reads a CSV file and searches for queries containing "in-addr.arpa" in the first column.
-    For each matching query, it runs a `host` command to perform a reverse DNS lookup and extract the result.
+    Every entry keeps its own expiry time: 'ttl' seconds for a found hostname, 'negative_ttl' for NXDOMAIN
+    (and an answer without a PTR record) and 'failure_ttl' for timeouts and server errors.
+    When the cache holds more than 'max_entries' names, the least recently used ones are evicted.
+    The hits, negative hits, misses and expired entries of the run are logged by close().
+    """
+    def __init__(self, file_name=ptr_cache_file, ttl=PTR_CACHE_TTL, negative_ttl=PTR_NEGATIVE_TTL,
+                 failure_ttl=PTR_FAILURE_TTL, max_entries=PTR_CACHE_SIZE):
+        self.file_name = file_name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self.stats = collections.Counter()
+        # several day processes of run_days can share the cache, wait for the lock of another writer
+        self.connection = sqlite3.connect(file_name, timeout=60)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS ptr (name TEXT PRIMARY KEY, status TEXT NOT NULL, hostname TEXT, '
+            'expires REAL NOT NULL, last_used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS ptr_last_used ON ptr (last_used)')
+        self.connection.commit()
+
+    def get_many(self, names, now=None):
+        """
+        Return the cached results of the names that have not expired, as (status, hostname, ttl left) like resolve_ptr.
+
+        The last use time of the returned entries is updated, for the LRU eviction.
+        """
+        now = time.time() if now is None else now
+        found = {}
+        names = list(names)
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT name, status, hostname, expires FROM ptr WHERE name IN ({",".join("?" * len(chunk))})', chunk)
+            for name, status, hostname, expires in rows:
+                if expires > now:
+                    found[name] = (status, hostname, int(expires - now))
+                    self.stats['negative_hits' if hostname is None else 'hits'] += 1
+                else:
+                    self.stats['expired'] += 1
+        self.stats['misses'] += len(names) - len(found)
+        self.connection.executemany('UPDATE ptr SET last_used = ? WHERE name = ?', ((now, name) for name in found))
+        self.connection.commit()
+        return found
+
+    def put_many(self, results, now=None):
+        """Store the resolve_ptr results of the names, with the expiry of their status."""
+        now = time.time() if now is None else now
+        rows = []
+        for name, (status, hostname, _) in results.items():
+            if hostname:
+                expires = now + self.ttl
+            elif status in ('NOERROR', 'NXDOMAIN'):
+                expires = now + self.negative_ttl
+            else:
+                expires = now + self.failure_ttl
+            rows.append((name, status, hostname, expires, now))
+        self.connection.executemany('INSERT OR REPLACE INTO ptr VALUES (?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+        self.stats['stored'] += len(rows)
+
+    def evict(self):
+        """Delete the least recently used entries above max_entries."""
+        total, = self.connection.execute('SELECT COUNT(*) FROM ptr').fetchone()
+        if total > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM ptr WHERE name IN (SELECT name FROM ptr ORDER BY last_used LIMIT ?)', (total - self.max_entries,))
+            self.connection.commit()
+            self.stats['evicted'] += total - self.max_entries
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+        logging.info('PtrCache.close(): %s: %s', self.file_name, dict(self.stats))
+
+
+def reversed_values_lookup(dns_server=None, timeout=DNS_TIMEOUT, attempts=DNS_ATTEMPTS, workers=DNS_WORKERS, dns_port=53, cache=None,
+                           original_csv_file=original_csv_file, updated_values_file=updated_values_file):
+    """
+    Search for matches for reversed queries and resolve them.
+
+    This function reads a CSV file and collects the distinct queries containing "in-addr.arpa" in the first column.
+    They are resolved concurrently by resolve_ptrs with an in-process DNS client, every name is looked up once
+    however many times it occurs in the file. With a PtrCache only the names that are not cached or expired are resolved.
     The results are then written to a new CSV file named 'updated_values.csv' with a mapping of original queries
     and their corresponding reverse lookup results.
 
+    Args:
+        dns_server (str, optional): The IP address of the DNS server, the first nameserver of resolv.conf by default.
+        timeout (float): The timeout of one query attempt, in seconds.
+        attempts (int): The number of attempts of every name.
+        workers (int): The maximum number of concurrent queries.
+        dns_port (int): The UDP port of the DNS server.
+        cache (PtrCache, optional): The cache of the previous lookups, updated with the new ones.
+        original_csv_file (str): The original file of the day.
+        updated_values_file (str): The mapping file written, 'updated_values.csv' by default.
+
     Returns:
         None
 
     Note:
-        - This function uses the 'subprocess' module to execute the `host` command.
         - Results of successful lookups are written to 'updated_values.csv' with two columns: original query and result.
-        - Errors during command execution are logged as errors.
-    """
-    mapping = []
-    with open(original_csv_file, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-        for line in lines:
-            words = line.strip().split(',')[0]
-            if "in-addr.arpa" in words:
-                command = f"host -t ptr {words}"
-                result = subprocess.run(command, shell=True, capture_output=True, text=True, check=False)
-                if result.returncode == 0:
-                    logging.info('reversed_values_lookup(): Command executed successfully:%s', result.stdout )
-                    split_parts = result.stdout.split("pointer")
-                    if len(split_parts) > 1:
-                        value_after_pointer = split_parts[1].strip()
-                        logging.info('reversed_values_lookup():%s', value_after_pointer)
-                        mapping.append((words, value_after_pointer))
-                else:
-                    logging.error('reversed_values_lookup(): Command execution failed %s', result.stderr)
-    with open('updated_values.csv', 'w', newline='', encoding='utf-8') as output_file:
-        csvwriter = csv.writer(output_file)
-        csvwriter.writerows(mapping)
-    logging.info('reversed_values_lookup(): Iterated reversed FQDNs and looked up the normal values for it')
+        - The result keeps the trailing dot, as the `host -t ptr` output used before.
+        - Names that could not be resolved are counted by status in the log.
+    """
+    names = {}
+    with open_file(original_csv_file, 'r', newline='') as file:
+        for row in csv.reader(file):
+            if row and "in-addr.arpa" in row[0]:
+                names.setdefault(row[0], None)
+    lookup_reversed_names(names, dns_server, timeout, attempts, workers, dns_port, cache, updated_values_file)
     return None
 
 
-def replace_found_fqdns():
+def lookup_reversed_names(names, dns_server=None, timeout=DNS_TIMEOUT, attempts=DNS_ATTEMPTS, workers=DNS_WORKERS, dns_port=53, cache=None,
+                          updated_values_file=updated_values_file):
+    """
+    Resolve the distinct reversed names (through the cache if given) and write the found ones to 'updated_values_file'.
+
+    Returns:
+        dict: The normal FQDN of every reversed name that was found, in the order of 'names'.
+    """
+    results = cache.get_many(names) if cache is not None else {}
+    resolved = resolve_ptrs([name for name in names if name not in results], dns_server, timeout, attempts, workers, dns_port)
+    if cache is not None:
+        cache.put_many(resolved)
+    results.update(resolved)
+    mapping = {name: results[name][1] for name in names if results[name][1]}
+    with open_file(updated_values_file, 'w', newline='') as output_file:
+        csvwriter = csv.writer(output_file)
+        csvwriter.writerows(mapping.items())
+    logging.info('lookup_reversed_names(): Looked up %s distinct reversed FQDNs, found %s normal values', len(names), len(mapping))
+    return mapping
+
+
+def replace_found_fqdns(original_csv_file=original_csv_file, updated_values_file=updated_values_file, final_file=final_file):
     """
     Replace reversed FQDNs with their corresponding normal FQDNs.
 
@@ -107,6 +410,11 @@ def replace_found_fqdns():
     If a match is found, it replaces the original FQDN with the corresponding normal FQDN.
     The updated rows are written to a new CSV file.
 
+    Args:
+        original_csv_file (str): The original file of the day.
+        updated_values_file (str): The mapping file written by reversed_values_lookup.
+        final_file (str): The daily file written.
+
     Returns:
         None
 
@@ -116,13 +424,13 @@ def replace_found_fqdns():
         - The updated data is written to 'final_file'.
     """
     mapping = {}
-    with open('updated_values.csv', 'r', encoding='utf-8') as mapping_file:
+    with open_file(updated_values_file, 'r') as mapping_file:
         mapping_reader = csv.reader(mapping_file)
         for row in mapping_reader:
             key = row[0]
             value = row[1]
             mapping[key] = value
-    with open(original_csv_file, 'r', encoding='utf-8') as origins_file:
+    with open_file(original_csv_file, 'r') as origins_file:
         origins_reader = csv.reader(origins_file)
         rows = list(origins_reader)
     updated_rows = []
@@ -131,7 +439,7 @@ def replace_found_fqdns():
             new_value = mapping[row[0]]
             row[0] = new_value
         updated_rows.append(row)
-    with open(final_file, 'w', newline='', encoding='utf-8') as updated_file:
+    with open_file(final_file, 'w', newline='') as updated_file:
         csvwriter = csv.writer(updated_file)
         csvwriter.writerows(updated_rows)
     logging.info('replace_found_fqdns(): Replaced found reversed FQDNs')
@@ -158,7 +466,7 @@ def count_queries_from_csv(final_file):
     """
     value_counts = collections.Counter()
     # Read queries from the input CSV file
-    with open(final_file, 'r', newline='', encoding='utf-8') as file:
+    with open_file(final_file, 'r', newline='') as file:
         reader = csv.reader(file)
         for row in reader:
             if len(row) >= 2:
@@ -167,7 +475,7 @@ def count_queries_from_csv(final_file):
                 value_counts[query] += count
 
     # Write the counts to the output CSV file
-    with open(final_file, 'w', newline='', encoding='utf-8') as file:
+    with open_file(final_file, 'w', newline='') as file:
         writer = csv.writer(file)
         for value, count in value_counts.items():
             if len(value) > 3:
@@ -176,7 +484,170 @@ def count_queries_from_csv(final_file):
     return None
 
 
-def update_csv_file_with_columns(file_to_match):
+def split_byte_ranges(file_name, chunks):
+    """Split a file into at most 'chunks' [start, end) byte ranges; a line belongs to the range where it starts."""
+    size = os.path.getsize(file_name)
+    bounds = sorted({size * index // chunks for index in range(chunks)} | {size})
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def count_chunk(file_name, chunk_index, start, end, partitions, spill_dir):
+    """
+    Count the queries of the lines starting in [start, end) and spill them into one pickle file per partition.
+
+    Every query goes to the partition crc32(query) % partitions, with its count and the position of its first row
+    (chunk index, row number in the chunk), so the reduce can restore the first-seen order of the whole file.
+
+    Returns:
+        list: The paths of the partition files, indexed by partition.
+    """
+    counts = [{} for _ in range(partitions)]
+    with open(file_name, 'rb') as file:
+        if start > 0:
+            file.seek(start - 1)
+            file.readline()
+
+        def lines():
+            position = file.tell()
+            for line in file:
+                if position >= end:
+                    break
+                position += len(line)
+                yield line.decode('utf-8')
+
+        for row_number, row in enumerate(csv.reader(lines())):
+            if len(row) >= 2:
+                query = row[0]
+                partition = counts[zlib.crc32(query.encode('utf-8')) % partitions]
+                entry = partition.get(query)
+                if entry is None:
+                    partition[query] = [(chunk_index, row_number), int(row[1])]
+                else:
+                    entry[1] += int(row[1])
+    paths = []
+    for partition_index, partition in enumerate(counts):
+        path = os.path.join(spill_dir, f'chunk_{chunk_index}_partition_{partition_index}.pickle')
+        with open(path, 'wb') as spill_file:
+            pickle.dump(partition, spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+        paths.append(path)
+    return paths
+
+
+def reduce_partition(paths):
+    """Merge the spilled counts of one partition, return its (first position, query, count) entries sorted by position."""
+    merged = {}
+    for path in paths:
+        with open(path, 'rb') as spill_file:
+            for query, (first_seen, count) in pickle.load(spill_file).items():
+                entry = merged.get(query)
+                if entry is None:
+                    merged[query] = [first_seen, count]
+                else:
+                    entry[0] = min(entry[0], first_seen)
+                    entry[1] += count
+    return sorted((first_seen, query, count) for query, (first_seen, count) in merged.items())
+
+
+def count_queries_parallel(final_file, workers=None, partitions=None, chunks_per_worker=4):
+    """
+    Count the queries of a CSV file like count_queries_from_csv, on several cores.
+
+    The file is split into byte ranges on line boundaries, every range is counted by a process of the pool and
+    its partial counts are spilled per hash partition (crc32 of the query). Every partition is then reduced by
+    a process, and the partitions are merged back in the order of the first row of every query, so the written
+    file is exactly the one of count_queries_from_csv.
+
+    Args:
+        final_file (str): The path to the input CSV file with 'query,count' rows, overwritten with the counts.
+        workers (int, optional): The number of processes, the number of CPUs by default.
+        partitions (int, optional): The number of hash partitions of the reduce, 'workers' by default.
+        chunks_per_worker (int): The number of byte ranges per process, more ranges balance the load better.
+
+    Returns:
+        None
+
+    Note:
+        - A quoted field with a line break would be split across ranges, the query files never have one.
+        - A compressed file cannot be split by byte ranges, it is counted by count_queries_from_csv.
+    """
+    if is_compressed(final_file):
+        logging.info('count_queries_parallel(): %s is compressed and cannot be split by byte ranges, counting it in one process', final_file)
+        return count_queries_from_csv(final_file)
+    workers = workers or os.cpu_count() or 1
+    partitions = partitions or workers
+    started = time.monotonic()
+    ranges = split_byte_ranges(final_file, workers * chunks_per_worker)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(final_file))) as spill_dir, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(count_chunk, final_file, chunk_index, start, end, partitions, spill_dir)
+                   for chunk_index, (start, end) in enumerate(ranges)]
+        chunk_paths = [future.result() for future in futures]
+        reduced = list(executor.map(reduce_partition, ([paths[index] for paths in chunk_paths] for index in range(partitions))))
+    with open_file(final_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        for _, value, count in heapq.merge(*reduced):
+            if len(value) > 3:
+                writer.writerow([value, count])
+    logging.info('count_queries_parallel(): Counted %s ranges in %s processes and %s partitions in %.1fs',
+                 len(ranges), workers, partitions, time.monotonic() - started)
+    return None
+
+
+class ProviderMatcher:
+    """
+    An Aho-Corasick automaton over the last column of the 'file_to_match' rows, built once.
+
+    match(fqdn) returns the index of the first row (in file order) whose last column is a substring of the FQDN,
+    the same row as testing 'provider_row[-1] in fqdn' for every row in order, in a time independent of the number of rows.
+    """
+    def __init__(self, patterns):
+        self.goto = [{}]
+        # the lowest row index among the patterns that end at the node, then also along its suffix links
+        self.best = [None]
+        self.empty_best = None
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                if self.empty_best is None:
+                    self.empty_best = index
+                continue
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.best.append(None)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            if self.best[node] is None:
+                self.best[node] = index
+        self.fail = [0] * len(self.goto)
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                suffix_best = self.best[self.fail[child]]
+                if suffix_best is not None and (self.best[child] is None or suffix_best < self.best[child]):
+                    self.best[child] = suffix_best
+                queue.append(child)
+
+    def match(self, text):
+        """Return the index of the first matching row, None if no row matches."""
+        goto, fail, best = self.goto, self.fail, self.best
+        found = self.empty_best
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if best[node] is not None and (found is None or best[node] < found):
+                found = best[node]
+        return found
+
+
+def update_csv_file_with_columns(file_to_match, final_file=final_file):
     """
     Map values from a generated file to a file that includes service provider name, subdomain, environment, and SID.
 
@@ -187,38 +658,182 @@ def update_csv_file_with_columns(file_to_match):
 
     Args:
         file_to_match (str): The path to the CSV file containing data to be mapped and added to 'final_file.'
+        final_file (str): The daily file, updated in place.
 
     Returns:
         None
 
     Note:
-        - The function iterates through both CSV files to perform the mapping based on a matching condition.
+        - A row matches when its last column is a substring of the query, the first matching row in file order is used.
+        - The matching is done by a ProviderMatcher built once from 'file_to_match', not by testing every row.
+        - Empty rows of 'file_to_match' are ignored.
         - The columns in 'final_file' are updated with the mapped values from 'file_to_match.'
         - The updated data is written back to 'final_file.'
     """
-    with open(file_to_match, 'r', encoding='utf-8') as csvfile2:
+    with open_file(file_to_match, 'r') as csvfile2:
         csv_reader2 = csv.reader(csvfile2)
-        file2_data = [row for row in csv_reader2]
+        file2_data = [row for row in csv_reader2 if row]
+    matcher = ProviderMatcher(provider_row[-1] for provider_row in file2_data)
     updated_data = []
-    with open(final_file, 'r', encoding='utf-8') as csvfile1:
+    matched = 0
+    with open_file(final_file, 'r') as csvfile1:
         csv_reader1 = csv.reader(csvfile1)
         for row in csv_reader1:
             updated_row = row[:]
-            for provider_row in file2_data:
-                print(provider_row)
-                if provider_row[-1] in row[0]:
-                    print(provider_row[0])
-                    updated_row.append(provider_row[0])
-                    updated_row.append(provider_row[1])
-                    break
+            index = matcher.match(row[0])
+            if index is not None:
+                provider_row = file2_data[index]
+                updated_row.append(provider_row[0])
+                updated_row.append(provider_row[1])
+                matched += 1
             updated_data.append(updated_row)
-    with open(final_file, 'w', newline='', encoding='utf-8') as csvfile1:
+    with open_file(final_file, 'w', newline='') as csvfile1:
         csv_writer = csv.writer(csvfile1)
         csv_writer.writerows(updated_data)
-    logging.info('update_csv_file_with_columns(): Mapped the FQDNs to the values in match_file and updated columns')
+    logging.info('update_csv_file_with_columns(): Mapped %s of %s FQDNs to the values in match_file and updated columns', matched, len(updated_data))
     return None
 
 
+class FqdnTable:
+    """
+    The distinct FQDNs of a file interned once, with their counts in a typed array.
+
+    Every FQDN gets an id in the order of its first row, and 'ids' keeps the insertion order, so iterating it
+    gives the FQDNs in the order of their ids (and of a Counter) without a second list of names.
+    The counts are kept in an array('Q') instead of int objects, and the provider match of every id
+    is computed once by match_providers.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.counts = array('Q')
+        self.providers = array('l')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, name, count):
+        """Add the count of a FQDN and return its id."""
+        query_id = self.ids.get(name)
+        if query_id is None:
+            query_id = self.ids[name] = len(self.ids)
+            self.counts.append(count)
+        else:
+            self.counts[query_id] += count
+        return query_id
+
+    def items(self):
+        """Yield the (FQDN, count) pairs in the order of the ids."""
+        return zip(self.ids, self.counts)
+
+    def match_providers(self, matcher):
+        """Return the ProviderMatcher row of every id (-1 if none), matching only the ids added since the last call."""
+        for name in itertools.islice(self.ids, len(self.providers), None):
+            index = matcher.match(name)
+            self.providers.append(-1 if index is None else index)
+        return self.providers
+
+
+def count_queries_compact(final_file):
+    """
+    Count the queries like count_queries_from_csv, with the FQDNs interned in a FqdnTable.
+
+    Args:
+        final_file (str): The path to the input CSV file with 'query,count' rows, overwritten with the counts.
+
+    Returns:
+        None
+    """
+    table = FqdnTable()
+    for query, count in read_query_counts(final_file):
+        table.add(query, count)
+    with open_file(final_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows([value, count] for value, count in table.items() if len(value) > 3)
+    logging.info('count_queries_compact(): Counted %s distinct FQDNs', len(table))
+    return None
+
+
+def read_query_counts(file_name, min_columns=2):
+    """
+    Yield the (query, count) pairs of the rows with at least 'min_columns' columns: 2 reads the rows like
+    count_queries_from_csv, 3 only the rows with a provider, the ones count_appended and MonthStore keep in the month.
+    """
+    with open_file(file_name, 'r', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) >= min_columns:
+                yield row[0], int(row[1])
+
+
+def replace_reversed(query_counts, mapping):
+    """Yield the (query, count) pairs with the reversed queries replaced by their normal FQDN."""
+    for query, count in query_counts:
+        yield mapping.get(query, query), count
+
+
+def with_provider_columns(table, providers, provider_rows):
+    """Yield the final rows: query, count and the provider name and SID of the first matching 'file_to_match' row."""
+    for query, count, index in zip(table.ids, table.counts, providers):
+        if len(query) <= 3:
+            continue
+        row = [query, count]
+        if index >= 0:
+            row.append(provider_rows[index][0])
+            row.append(provider_rows[index][1])
+        yield row
+
+
+def transform_streaming(file_to_match, cache=None, original_csv_file=original_csv_file, updated_values_file=updated_values_file,
+                        final_file=final_file, **lookup_options):
+    """
+    Build 'final_file' from 'original_csv_file' in a single pass, instead of the four rewrites of
+    reversed_values_lookup, replace_found_fqdns, count_queries_from_csv and update_csv_file_with_columns.
+
+    The original file is read once and the counts are summed per query in a FqdnTable, so the memory is bounded by
+    the number of distinct queries, not of rows. The distinct reversed queries are resolved (lookup_reversed_names),
+    then the replaced queries are summed again, mapped to the providers once per id, filtered by a generator
+    and 'final_file' is written once.
+
+    Args:
+        file_to_match (str): The path to the CSV file with the service providers.
+        cache (PtrCache, optional): The cache of the PTR lookups.
+        original_csv_file (str): The original file of the day.
+        updated_values_file (str): The mapping file written.
+        final_file (str): The daily file written.
+        **lookup_options: The DNS options of lookup_reversed_names (dns_server, timeout, attempts, workers, dns_port).
+
+    Returns:
+        None
+
+    Note:
+        - The rows are the same, in the same order, as the ones of the four steps: only rows with a count are read,
+          the queries are in the order of their first row (after the replacement) and the ones shorter than 4
+          characters are dropped.
+        - 'updated_values.csv' is still written, with the found reversed queries only.
+    """
+    counts = FqdnTable()
+    for query, count in read_query_counts(original_csv_file):
+        counts.add(query, count)
+    mapping = lookup_reversed_names([query for query in counts.ids if "in-addr.arpa" in query], cache=cache,
+                                    updated_values_file=updated_values_file, **lookup_options)
+    replaced_counts = FqdnTable()
+    for query, count in replace_reversed(counts.items(), mapping):
+        replaced_counts.add(query, count)
+    with open_file(file_to_match, 'r') as provider_file:
+        provider_rows = [row for row in csv.reader(provider_file) if row]
+    providers = replaced_counts.match_providers(ProviderMatcher(provider_row[-1] for provider_row in provider_rows))
+    with open_file(final_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows(with_provider_columns(replaced_counts, providers, provider_rows))
+    logging.info('transform_streaming(): Summed %s distinct queries from %s distinct original ones into %s in a single pass', len(replaced_counts), len(counts), final_file)
+    return None
+
+
+def temporary_name(file_name):
+    """Return the name of the temporary file replacing 'file_name' atomically, with the same compression suffix."""
+    directory, base_name = os.path.split(file_name)
+    return os.path.join(directory, f'.tmp_{base_name}')
+
+
 def append_csv(final_file, month_file_name):
     """
     Append today's data from a source CSV file to a monthly CSV file.
@@ -231,23 +846,36 @@ def append_csv(final_file, month_file_name):
         month_file_name (str): The path to the monthly CSV file to which data will be appended.
 
     Returns:
-        None
+        int: The number of rows appended.
+
+    Raises:
+        Exception: Any error of the operation is logged and raised again, so the day is not marked as merged.
 
     Note:
         - The function uses the 'csv' module to read and write CSV data.
         - If an error occurs during the operation, it is logged as an error.
     """
     try:
-        with open(final_file, "r", newline="", encoding='utf-8') as source, open(month_file_name, "a", newline="", encoding='utf-8') as destination:
+        with open_file(final_file, 'r', newline='') as source, open_file(month_file_name, 'a', newline='') as destination:
             source_reader = csv.reader(source)
             destination_writer = csv.writer(destination)
             # Append the data from the source to the destination file
+            rows = 0
             for row in source_reader:
                 destination_writer.writerow(row)
+                rows += 1
         logging.info(f"append_csv(): Appended {final_file} to {month_file_name}")
-        return None
+        return rows
     except Exception as e:
         logging.error(f"append_csv(): An error occurred: {str(e)}")
+        raise
+
+
+def parse_count(value_str):
+    """Return the quantity of a CSV cell as an int (or a float if it has a fraction), None if it is not numeric."""
+    if not value_str.replace('.', '', 1).isdigit():
+        return None
+    return float(value_str) if '.' in value_str else int(value_str)
 
 
 def count_appended(month_file_name):
@@ -262,7 +890,7 @@ def count_appended(month_file_name):
         month_file_name (str): The path to the monthly CSV file containing appended data.
 
     Returns:
-        None
+        int: The number of rows written, with the header.
 
     Note:
         - The function reads and updates data in the same CSV file.
@@ -270,49 +898,652 @@ def count_appended(month_file_name):
         - Duplicate names are combined, and non-matching rows are preserved.
     """
     name_data = {}
-    with open(month_file_name, 'r', encoding='utf-8') as csv_file:
+    with open_file(month_file_name, 'r') as csv_file:
         csv_reader = csv.reader(csv_file)
         header = next(csv_reader, None)
         for row in csv_reader:
             if len(row) >= 3:
                 name = row[0]
-                value_str = row[1]
-                if value_str.replace('.', '', 1).isdigit():
-                    value = (value_str)
-                else:
-                    value = None
+                value = parse_count(row[1])
                 if name in name_data:
-                    if value is not None:
+                    if value is not None and not isinstance(name_data[name][1], str):
                         name_data[name][1] += value
                 else:
+                    if value is not None:
+                        row[1] = value
                     name_data[name] = row
-    with open(month_file_name, 'w', newline='', encoding='utf-8') as csv_output:
+    temporary_file = temporary_name(month_file_name)
+    with open_file(temporary_file, 'w', newline='') as csv_output:
         csv_writer = csv.writer(csv_output)
         if header:
             csv_writer.writerow(header)
         for name, data in name_data.items():
             csv_writer.writerow(data)
+    os.replace(temporary_file, month_file_name)
     logging.info(f"count_appended(): Data with duplicate names combined (if numeric) and non-matching rows preserved saved to {month_file_name}")
-    return None
+    return len(name_data) + (1 if header else 0)
+
+
+def count_appended_compact(month_file_name):
+    """
+    Combine the duplicate queries of the monthly file like count_appended, with the FQDNs interned in a FqdnTable.
+
+    The service provider name and SID of the first row of every query are interned too, so a query costs an id,
+    an array slot and a small int instead of a row list.
 
+    Args:
+        month_file_name (str): The path to the monthly CSV file containing appended data.
+
+    Returns:
+        int: The number of rows written, with the header.
+
+    Note:
+        - The integer quantities of a query are summed in the array and its fractional ones apart, then added,
+          while count_appended adds them in row order: float addition is not associative, so a total with
+          fractions can differ from the one of count_appended in the last digits (1, 2, 0.1, 0.2 gives 3.3
+          here and 3.3000000000000003 there). The integer totals, the only ones the daily files have, are equal.
+    """
+    table = FqdnTable()
+    extras = {}
+    extra_ids = array('l')
+    # the rare quantities that are not integers: the first non-numeric value of a query, the float part of a sum
+    text_values = {}
+    fractions = {}
+    with open_file(month_file_name, 'r') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader, None)
+        for row in csv_reader:
+            if len(row) < 3:
+                continue
+            value = parse_count(row[1])
+            query_id = table.ids.get(row[0])
+            if query_id is None:
+                query_id = table.add(row[0], value if isinstance(value, int) else 0)
+                extra_ids.append(extras.setdefault(tuple(row[2:]), len(extras)))
+                if value is None:
+                    text_values[query_id] = row[1]
+            elif value is None or query_id in text_values:
+                continue
+            elif isinstance(value, int):
+                table.counts[query_id] += value
+                continue
+            if isinstance(value, float):
+                fractions[query_id] = fractions.get(query_id, 0) + value
+    extra_rows = list(extras)
+    temporary_file = temporary_name(month_file_name)
+    with open_file(temporary_file, 'w', newline='') as csv_output:
+        csv_writer = csv.writer(csv_output)
+        if header:
+            csv_writer.writerow(header)
+        for query_id, (name, count) in enumerate(table.items()):
+            if query_id in text_values:
+                count = text_values[query_id]
+            elif query_id in fractions:
+                count += fractions[query_id]
+            csv_writer.writerow([name, count, *extra_rows[extra_ids[query_id]]])
+    os.replace(temporary_file, month_file_name)
+    logging.info(f"count_appended_compact(): Combined {len(table)} distinct queries in {month_file_name}")
+    return len(table) + (1 if header else 0)
+
+
+class MonthStore:
+    """
+    An incremental sqlite store of the monthly query quantities, replacing append_csv and count_appended.
+
+    merge_day upserts the rows of a daily file into its month, so merging a day costs O(rows of the day)
+    instead of rewriting the whole month file, and the quantities are added as numbers.
+    The month CSV files are generated on demand by export, with the rows in the order of their first day,
+    the first service provider name and SID of every query and the summed quantity, like count_appended leaves them.
+    A day that is already merged is skipped, so rerunning a day does not count it twice.
+    """
+    def __init__(self, file_name=month_store_file):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS month_counts (month TEXT NOT NULL, query TEXT NOT NULL, total NUMERIC NOT NULL, '
+            'provider TEXT, sid TEXT, PRIMARY KEY (month, query))')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS merged_days (day TEXT PRIMARY KEY, month TEXT NOT NULL, rows INTEGER NOT NULL, merged_at TEXT NOT NULL)')
+        self.connection.commit()
 
-def if_last_day_of_the_month(month_file_name):
-    '''check if today is the last day of the month and append the monthly data to the final DNS file dns_full_data.csv'''
+    def is_merged(self, day):
+        return self.connection.execute('SELECT 1 FROM merged_days WHERE day = ?', (day,)).fetchone() is not None
+
+    def merge_day(self, daily_file, day=FROM_DATE):
+        """
+        Add the quantities of a daily 'query,count,provider,sid' file to the month of the day.
+
+        Like count_appended, only the rows with a service provider (three columns or more) are kept and
+        a quantity that is not numeric counts as 0.
+
+        Returns:
+            int: The number of merged rows, 0 if the day was already merged.
+        """
+        month = day[:7]
+        if self.is_merged(day):
+            logging.info('MonthStore.merge_day(): %s is already merged into %s, skipping', day, month)
+            return 0
+        rows = 0
+        with open_file(daily_file, 'r', newline='') as file, self.connection:
+            for row in csv.reader(file):
+                if len(row) < 3:
+                    continue
+                self.connection.execute(
+                    'INSERT INTO month_counts (month, query, total, provider, sid) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (month, query) DO UPDATE SET total = total + excluded.total',
+                    (month, row[0], parse_count(row[1]) or 0, row[2], row[3] if len(row) > 3 else None))
+                rows += 1
+            self.connection.execute('INSERT INTO merged_days VALUES (?, ?, ?, ?)',
+                                    (day, month, rows, datetime.datetime.now().isoformat(timespec='seconds')))
+        logging.info('MonthStore.merge_day(): Merged %s rows of %s into %s', rows, daily_file, month)
+        return rows
+
+    def export(self, file_name, month=None):
+        """
+        Write the month (or all the months summed, like 'dns_full_data.csv') as a CSV file with a header row.
+
+        Returns:
+            int: The number of written queries.
+        """
+        totals = {}
+        if month is None:
+            rows = self.connection.execute('SELECT query, total, provider, sid FROM month_counts ORDER BY month, rowid')
+        else:
+            rows = self.connection.execute('SELECT query, total, provider, sid FROM month_counts WHERE month = ? ORDER BY rowid', (month,))
+        for query, total, provider, sid in rows:
+            if query in totals:
+                totals[query][1] += total
+            else:
+                totals[query] = [query, total, provider, sid]
+        with open_file(file_name, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['query', 'total quantity', 'service provider name', 'sid'])
+            for row in totals.values():
+                writer.writerow(row if row[3] is not None else row[:3])
+        logging.info('MonthStore.export(): Wrote %s queries of %s into %s', len(totals), month or 'all the months', file_name)
+        return len(totals)
+
+    def close(self):
+        self.connection.close()
+
+
+class HistoryStore:
+    """
+    The long-term history of the monthly quantities, replacing the ever-growing 'dns_full_data.csv'.
+
+    Every month is a partition: a gzip CSV file 'YYYY-MM.csv.gz' with one 'query,total,provider,sid' row per query,
+    sorted by query, and 'index.json' lists the partitions with their number of rows, total and first/last query.
+    Adding a month writes only its partition and the index. The yearly and all-time totals are computed by
+    an external merge of the sorted partitions: at most 'fan_in' files are open at a time (intermediate sorted
+    runs are merged level by level), so the memory does not grow with the number of months.
+    """
+    def __init__(self, directory=history_directory, fan_in=HISTORY_FAN_IN):
+        self.directory = directory
+        self.fan_in = max(2, fan_in)
+        self.index_file = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+        self.index = {'months': {}}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r', encoding='utf-8') as json_file:
+                self.index = json.load(json_file)
+
+    def save_index(self):
+        """Write the index file atomically."""
+        temporary_file = f'{self.index_file}.tmp'
+        with open(temporary_file, 'w', encoding='utf-8') as json_file:
+            json.dump(self.index, json_file, indent=2, sort_keys=True)
+        os.replace(temporary_file, self.index_file)
+
+    def add_month(self, month_file_name, month):
+        """
+        Write (or replace) the partition of a month from a month CSV file with a header row.
+
+        Returns:
+            int: The number of queries of the partition.
+        """
+        totals = {}
+        with open_file(month_file_name, 'r', newline='') as csv_file:
+            csv_reader = csv.reader(csv_file)
+            next(csv_reader, None)
+            for row in csv_reader:
+                if len(row) < 2:
+                    continue
+                value = parse_count(row[1]) or 0
+                if row[0] in totals:
+                    totals[row[0]][1] += value
+                else:
+                    totals[row[0]] = [row[0], value] + row[2:4]
+        partition = f'{month}.csv.gz'
+        temporary_file = os.path.join(self.directory, f'{partition}.tmp')
+        with gzip.open(temporary_file, 'wt', newline='', encoding='utf-8') as partition_file:
+            csv.writer(partition_file).writerows(totals[query] for query in sorted(totals))
+        os.replace(temporary_file, os.path.join(self.directory, partition))
+        self.index['months'][month] = {
+            'file': partition,
+            'rows': len(totals),
+            'total': sum(row[1] for row in totals.values()),
+            'first_query': min(totals, default=None),
+            'last_query': max(totals, default=None),
+            'added_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        self.save_index()
+        logging.info('HistoryStore.add_month(): Wrote %s queries of %s into %s', len(totals), month, partition)
+        return len(totals)
+
+    def merge_runs(self, paths, output_file, final=False):
+        """Merge sorted partitions or runs into one, summing the totals of a query; the first provider and SID are kept."""
+        def read_run(path):
+            with gzip.open(path, 'rt', newline='', encoding='utf-8') as run_file:
+                yield from csv.reader(run_file)
+
+        if final:
+            output = open_file(output_file, 'w', newline='')
+        else:
+            output = gzip.open(output_file, 'wt', newline='', encoding='utf-8', compresslevel=1)
+        rows = 0
+        with output:
+            writer = csv.writer(output)
+            if final:
+                writer.writerow(['query', 'total quantity', 'service provider name', 'sid'])
+            current = None
+            for row in heapq.merge(*(read_run(path) for path in paths), key=lambda row: row[0]):
+                if current is not None and current[0] == row[0]:
+                    current[1] += parse_count(row[1]) or 0
+                    continue
+                if current is not None:
+                    writer.writerow(current)
+                    rows += 1
+                current = [row[0], parse_count(row[1]) or 0] + row[2:]
+            if current is not None:
+                writer.writerow(current)
+                rows += 1
+        return rows
+
+    def totals(self, output_file, year=None):
+        """
+        Write the totals of a year (or of all the months) to a CSV file with a header row, sorted by query.
+
+        Returns:
+            int: The number of written queries.
+        """
+        months = sorted(month for month in self.index['months'] if year is None or month.startswith(f'{year}-'))
+        paths = [os.path.join(self.directory, self.index['months'][month]['file']) for month in months]
+        with tempfile.TemporaryDirectory(dir=self.directory) as run_directory:
+            level = 0
+            while len(paths) > self.fan_in:
+                runs = []
+                for start in range(0, len(paths), self.fan_in):
+                    run = os.path.join(run_directory, f'run_{level}_{start}.csv.gz')
+                    self.merge_runs(paths[start:start + self.fan_in], run)
+                    runs.append(run)
+                paths = runs
+                level += 1
+            rows = self.merge_runs(paths, output_file, final=True)
+        logging.info('HistoryStore.totals(): Wrote %s queries of %s months (%s merge levels) into %s', rows, len(months), level + 1, output_file)
+        return rows
+
+
+def if_last_day_of_the_month(month_file_name, history=None):
+    '''check if today is the last day of the month and append the monthly data to the final DNS file dns_full_data.csv,
+    or add it as a partition of the HistoryStore if one is given'''
     today = datetime.date.today()
     is_last_day_of_month = (today + datetime.timedelta(days=1)).day == 1
-    if is_last_day_of_month:
+    if is_last_day_of_month and history is not None:
+        history.add_month(month_file_name, today.strftime('%Y-%m'))
+    elif is_last_day_of_month:
         input_file = month_file_name
-        output_file = f'dns_full_data.csv'
-        with open(input_file, 'r', encoding='utf-8') as csv_input, open(output_file, 'a', newline='', encoding='utf-8') as csv_output:
+        output_file = f'dns_full_data.csv{OUTPUT_SUFFIX}'
+        with open_file(input_file, 'r') as csv_input, open_file(output_file, 'a', newline='') as csv_output:
             csv_reader = csv.reader(csv_input)
             csv_writer = csv.writer(csv_output)
             for row in csv_reader:
                 csv_writer.writerow(row)
-        logging.info('if_last_day_of_the_month(): Content from %s', {input_file}, 'has been written to %s', {output_file}, 'without a header row.')
+        logging.info('if_last_day_of_the_month(): Content from %s has been written to %s', input_file, output_file)
         count_appended(output_file)
     return None
 
 
+def file_fingerprint(file_name):
+    """Return the sha256 and the number of rows of the (decompressed) content and the size of a file, None if it does not exist."""
+    if not os.path.exists(file_name):
+        return None
+    digest = hashlib.sha256()
+    rows = 0
+    with open_file(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+            rows += block.count(b'\n')
+    return {'sha256': digest.hexdigest(), 'rows': rows, 'bytes': os.path.getsize(file_name)}
+
+
+class RunManifest:
+    """
+    The record of the stages of a daily run, so a rerun after a failure skips the stages that are already done
+    and never merges the day into the month twice.
+
+    Every stage records the fingerprint (file_fingerprint) of its inputs and outputs. A stage is skipped when
+    its inputs that it does not rewrite are unchanged and every output is still the one it wrote, or the one
+    written by a later stage of the same run (the daily file is rewritten in place by several stages).
+    When a stage runs again, the records of the stages after it are dropped, since their inputs may change.
+    The "merged into month" marker of the month file is set in three steps: 'appending' before append_csv,
+    with the size of the month file and the sha256 of its last MONTH_TAIL_BYTES bytes, so a rerun after a failed
+    or interrupted append truncates the month file back to it (restore_month_file); 'appended' after append_csv
+    and 'combined' after count_appended, so a rerun after a failure between them only combines the rows.
+    The markers record the size and not the fingerprint of the month file, which would read the whole month.
+    """
+    def __init__(self, file_name=run_manifest_file, day=FROM_DATE):
+        self.file_name = file_name
+        self.state = {'day': day, 'order': [], 'stages': {}, 'merged_into_month': {}}
+        if os.path.exists(file_name):
+            with open(file_name, 'r', encoding='utf-8') as json_file:
+                self.state = json.load(json_file)
+
+    def save(self):
+        """Write the manifest file atomically."""
+        temporary_file = f'{self.file_name}.tmp'
+        with open(temporary_file, 'w', encoding='utf-8') as json_file:
+            json.dump(self.state, json_file, indent=2, sort_keys=True)
+        os.replace(temporary_file, self.file_name)
+
+    def is_done(self, name, inputs, outputs):
+        record = self.state['stages'].get(name)
+        if record is None:
+            return False
+        for file_name in inputs:
+            if file_name not in outputs and file_fingerprint(file_name) != record['inputs'].get(file_name):
+                return False
+        later = self.state['order'][self.state['order'].index(name):]
+        for file_name in outputs:
+            written = [self.state['stages'][stage]['outputs'].get(file_name) for stage in later]
+            current = file_fingerprint(file_name)
+            if current is None or current not in written:
+                return False
+        return True
+
+    def run_stage(self, name, inputs, outputs, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) unless the stage is already done, then record its inputs and outputs.
+
+        Returns:
+            bool: True if the stage ran, False if it was skipped.
+        """
+        if self.is_done(name, inputs, outputs):
+            logging.info('RunManifest.run_stage(): Skipping %s, its inputs and outputs are unchanged', name)
+            return False
+        input_fingerprints = {file_name: file_fingerprint(file_name) for file_name in inputs}
+        if name in self.state['order']:
+            for stage in self.state['order'][self.state['order'].index(name):]:
+                self.state['stages'].pop(stage, None)
+            del self.state['order'][self.state['order'].index(name):]
+        started = time.monotonic()
+        function(*args, **kwargs)
+        self.state['stages'][name] = {
+            'inputs': input_fingerprints,
+            'outputs': {file_name: file_fingerprint(file_name) for file_name in outputs},
+            'seconds': round(time.monotonic() - started, 3),
+            'completed_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        self.state['order'].append(name)
+        self.save()
+        return True
+
+    def merged_into_month(self, month_file_name):
+        """Return the merge step of the day into the month file: None, 'appending', 'appended' or 'combined'."""
+        return self.state['merged_into_month'].get(month_file_name, {}).get('step')
+
+    def merge_marker(self, month_file_name):
+        """Return the record of the last merge step: the step, the size of the month file after it and when."""
+        return self.state['merged_into_month'].get(month_file_name, {})
+
+    def mark_merged(self, month_file_name, step):
+        size = os.path.getsize(month_file_name)
+        marker = {
+            'step': step,
+            'bytes': size,
+            'at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        if step == 'appending':
+            marker['tail_sha256'] = tail_sha256(month_file_name, size)
+        self.state['merged_into_month'][month_file_name] = marker
+        self.save()
+
+
+def tail_sha256(file_name, size):
+    """Return the sha256 of the MONTH_TAIL_BYTES bytes before 'size' of a file as stored on disk (not decompressed)."""
+    start = max(size - MONTH_TAIL_BYTES, 0)
+    with open(file_name, 'rb') as file:
+        file.seek(start)
+        return hashlib.sha256(file.read(size - start)).hexdigest()
+
+
+def restore_month_file(month_file_name, marker):
+    """
+    Truncate a month file back to the 'appending' marker of the run manifest, taken before append_csv.
+
+    Appending only adds bytes at the end (a new gzip member or zstd frame for a compressed file), so the
+    month file is restored by cutting what an interrupted or failed append left after the recorded size.
+    The last bytes before that size must still be the recorded ones: a month file rewritten in between
+    (by count_appended of another day) is not cut.
+
+    Returns:
+        bool: True if the file was truncated, False if it is unchanged since the marker.
+
+    Raises:
+        RuntimeError: If the recorded bytes of the month file changed, it cannot be restored safely.
+    """
+    size = marker['bytes']
+    current_size = os.path.getsize(month_file_name)
+    if current_size < size or tail_sha256(month_file_name, size) != marker['tail_sha256']:
+        raise RuntimeError(f'{month_file_name} changed since the day started to be appended to it, it cannot be restored')
+    if current_size == size:
+        return False
+    os.truncate(month_file_name, size)
+    logging.warning('restore_month_file(): Truncated %s back to %s bytes, before the interrupted append', month_file_name, size)
+    return True
+
+
+def file_rows(file_name):
+    """Return the number of rows of the (decompressed) content and the size of a file, (0, 0) if it does not exist."""
+    if not os.path.exists(file_name):
+        return 0, 0
+    rows = 0
+    with open_file(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            rows += block.count(b'\n')
+    return rows, os.path.getsize(file_name)
+
+
+def reset_peak_rss():
+    """Reset the peak RSS (VmHWM) of this process to its current RSS, return False where it is not supported (Linux < 4.0)."""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """Return the peak RSS of this process in bytes, since the last reset_peak_rss() on Linux."""
+    try:
+        with open('/proc/self/status', 'r', encoding='ascii') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, and never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMetrics:
+    """
+    The measurements of the stages of a run: for every stage the wall time, the CPU time of the process and of
+    its finished child processes (the count_queries_parallel pool), the rows and bytes it read and wrote, and
+    the peak RSS during the stage.
+
+    Only the stage function is timed and profiled, not the run manifest checks and fingerprints around it.
+    The bytes are the sizes of the input files before the stage and of the output files after it, or what was
+    added to the outputs the stage appends to ('appends'). The rows are not read again from the files: they come
+    from the fingerprints of the run manifest when it ran the stage, from the stages that return the number of
+    rows they wrote (append_csv, count_appended), or are None, unless 'count_rows' reads the files for them.
+    The peak RSS is reset before every stage where /proc/self/clear_refs allows it ('peak_rss_scope': 'stage'),
+    otherwise it is the peak of the process so far ('process'). 'children_lifetime_peak_rss_bytes' cannot be
+    reset: it is the largest peak RSS of all the child processes finished so far (RUSAGE_CHILDREN), not of the stage.
+    The stages skipped by the run manifest are recorded with 'skipped': True and their zero timings are not
+    exported as gauges.
+    The stage named 'profile_stage' (by stage or function name) is also run under cProfile, and its statistics
+    dumped to '<profile_dir>/<stage>_<day>.prof' (python -m pstats <file>).
+    """
+    def __init__(self, day=FROM_DATE, profile_stage=None, profile_dir='.', count_rows=False):
+        self.day = day
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.count_rows = count_rows
+        self.stages = []
+
+    def timed(self, name, function, measured):
+        """Return function wrapped to put its timings, peak RSS and result (and its profile) in the 'measured' dict."""
+        def timed_function(*args, **kwargs):
+            measured['peak_rss_scope'] = 'stage' if reset_peak_rss() else 'process'
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            profiler = cProfile.Profile() if self.profile_stage in (name, getattr(function, '__name__', None)) else None
+            started, cpu_started = time.monotonic(), time.process_time()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                measured['result'] = function(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                measured['wall_seconds'] = time.monotonic() - started
+                measured['cpu_seconds'] = time.process_time() - cpu_started
+                children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+                measured['children_cpu_seconds'] = max(children_after.ru_utime + children_after.ru_stime - children.ru_utime - children.ru_stime, 0.0)
+                measured['children_lifetime_peak_rss_bytes'] = children_after.ru_maxrss * 1024
+                measured['peak_rss_bytes'] = peak_rss()
+                if profiler is not None:
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                    measured['profile'] = os.path.join(self.profile_dir, f'{name}_{self.day}.prof')
+                    profiler.dump_stats(measured['profile'])
+                    logging.info('StageMetrics.timed(): Wrote the profile of %s to %s', name, measured['profile'])
+            return measured['result']
+        timed_function.__name__ = getattr(function, '__name__', name)
+        return timed_function
+
+    def measure(self, name, inputs, outputs, function, *args, manifest=None, appends=(), **kwargs):
+        """
+        Run function(*args, **kwargs) as the stage 'name' (through the run manifest if given) and record its measurements.
+
+        Args:
+            appends (list): The outputs the stage appends to, their written bytes and rows are the added ones.
+
+        Returns:
+            bool: True if the stage ran, False if the manifest skipped it.
+        """
+        sizes = {file_name: os.path.getsize(file_name) if os.path.exists(file_name) else 0 for file_name in [*inputs, *appends]}
+        rows = {}
+        if self.count_rows and manifest is None:
+            rows = {file_name: file_rows(file_name)[0] for file_name in [*inputs, *appends]}
+        measured = {}
+        ran = run_stage(manifest, name, inputs, outputs, self.timed(name, function, measured), *args, **kwargs)
+        rows_in, rows_out = None, None
+        if manifest is not None and ran:
+            fingerprints = manifest.state['stages'][name]
+            rows_in = sum(fingerprint['rows'] for fingerprint in fingerprints['inputs'].values() if fingerprint)
+            rows_out = sum(fingerprint['rows'] for fingerprint in fingerprints['outputs'].values() if fingerprint)
+        elif rows:
+            rows_in = sum(rows[file_name] for file_name in inputs)
+            rows_out = sum(file_rows(file_name)[0] - rows.get(file_name, 0) if file_name in appends else file_rows(file_name)[0]
+                           for file_name in outputs)
+        result = measured.get('result')
+        if isinstance(result, int) and not isinstance(result, bool):
+            rows_out = result
+        bytes_written = 0
+        for file_name in outputs:
+            size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+            bytes_written += size - sizes.get(file_name, 0) if file_name in appends else size
+        record = {
+            'day': self.day,
+            'stage': name,
+            'function': getattr(function, '__name__', str(function)),
+            'wall_seconds': round(measured.get('wall_seconds', 0.0), 6),
+            'cpu_seconds': round(measured.get('cpu_seconds', 0.0), 6),
+            'children_cpu_seconds': round(measured.get('children_cpu_seconds', 0.0), 6),
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'bytes_read': sum(sizes[file_name] for file_name in inputs),
+            'bytes_written': bytes_written,
+            'peak_rss_bytes': measured.get('peak_rss_bytes'),
+            'peak_rss_scope': measured.get('peak_rss_scope'),
+            'children_lifetime_peak_rss_bytes': measured.get('children_lifetime_peak_rss_bytes'),
+            'skipped': not ran,
+        }
+        if 'profile' in measured:
+            record['profile'] = measured['profile']
+        self.stages.append(record)
+        logging.info('StageMetrics.measure(): %s %s: %.3fs wall, %.3fs CPU, %s -> %s rows%s', self.day, name, record['wall_seconds'],
+                     record['cpu_seconds'], rows_in, rows_out, ', skipped' if not ran else '')
+        return ran
+
+    def write(self, file_name, started_at=None, run_id=None):
+        """
+        Write the measurements of the run as JSON to 'file_name', and in the OpenMetrics text format to the
+        same name with a '.prom' extension (for the node_exporter textfile collector or a push gateway).
+        The skipped stages are only in the 'dns_stage_skipped' gauge, not in the measurement ones.
+
+        Returns:
+            list: The paths of the written files.
+        """
+        payload = {'run_id': run_id, 'started_at': started_at, 'written_at': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'stages': self.stages}
+        temporary_file = f'{file_name}.tmp'
+        with open(temporary_file, 'w', encoding='utf-8') as json_file:
+            json.dump(payload, json_file, indent=2)
+        os.replace(temporary_file, file_name)
+        prom_file = os.path.splitext(file_name)[0] + '.prom'
+        metrics = [
+            ('wall_seconds', 'dns_stage_wall_seconds', 'The wall time of the stage.'),
+            ('cpu_seconds', 'dns_stage_cpu_seconds', 'The CPU time of the process during the stage.'),
+            ('children_cpu_seconds', 'dns_stage_children_cpu_seconds', 'The CPU time of the child processes of the stage.'),
+            ('rows_in', 'dns_stage_rows_in', 'The rows read by the stage.'),
+            ('rows_out', 'dns_stage_rows_out', 'The rows written by the stage.'),
+            ('bytes_read', 'dns_stage_read_bytes', 'The size of the input files of the stage.'),
+            ('bytes_written', 'dns_stage_written_bytes', 'The bytes written by the stage (added to the files it appends to).'),
+            ('peak_rss_bytes', 'dns_stage_peak_rss_bytes', 'The peak resident set size during the stage.'),
+        ]
+        lines = ['# TYPE dns_stage_skipped gauge', '# HELP dns_stage_skipped 1 if the run manifest skipped the stage, its measurements are not exported.']
+        for record in self.stages:
+            lines.append(f'dns_stage_skipped{{day="{record["day"]}",stage="{record["stage"]}",function="{record["function"]}"}} '
+                         f'{int(record["skipped"])}')
+        for key, metric, help_text in metrics:
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'# HELP {metric} {help_text}')
+            for record in self.stages:
+                if record['skipped'] or record[key] is None:
+                    continue
+                lines.append(f'{metric}{{day="{record["day"]}",stage="{record["stage"]}",function="{record["function"]}"}} {record[key]}')
+        lines.append('# EOF')
+        with open(f'{prom_file}.tmp', 'w', encoding='utf-8') as text_file:
+            text_file.write('\n'.join(lines) + '\n')
+        os.replace(f'{prom_file}.tmp', prom_file)
+        logging.info('StageMetrics.write(): Wrote the metrics of %s stages to %s and %s', len(self.stages), file_name, prom_file)
+        return [file_name, prom_file]
+
+
+def run_stage(manifest, name, inputs, outputs, function, *args, metrics=None, appends=(), **kwargs):
+    """
+    Run a stage through the manifest, or directly without one, measured by 'metrics' (StageMetrics) if given;
+    'appends' are the outputs the stage appends to, for the measurements.
+    """
+    if metrics is not None:
+        return metrics.measure(name, inputs, outputs, function, *args, manifest=manifest, appends=appends, **kwargs)
+    if manifest is None:
+        function(*args, **kwargs)
+        return True
+    return manifest.run_stage(name, inputs, outputs, function, *args, **kwargs)
+
+
 def clean_up():
     """
     Check if today is the last day of the month and append monthly data to the final DNS file 'dns_full_data.csv'.
@@ -332,23 +1563,265 @@ def clean_up():
         - If it's the last day of the month, data is appended to 'dns_full_data.csv' without a header row.
         - The 'count_appended' function is called to process the appended data.
     """
-    if os.path.exists(original_csv_file) and os.path.exists('updated_values.csv') and os.path.exists(final_file):
+    if os.path.exists(original_csv_file) and os.path.exists(updated_values_file) and os.path.exists(final_file):
         os.remove(original_csv_file)
         os.remove(final_file)
-        os.remove('updated_values.csv')
+        os.remove(updated_values_file)
     logging.info("clean_up(): Removed an original file and temporarly ones")
     return None
 
 
+def day_files(day, workdir='.'):
+    """
+    Return the paths of the files of the stages of a day, 'YYYY-MM-DD', in 'workdir'.
+
+    The stages take these paths as arguments, so the days of run_days do not share any module state (or the
+    current directory), whether they run in separate processes or one after the other in the same one.
+    Every file is named after its day, the mapping file too: 'updated_values_<day>.csv', not the
+    'updated_values.csv' of the module defaults.
+
+    Returns:
+        dict: The 'original', 'final' and 'updated_values' files and the run 'manifest' of the day.
+    """
+    return {
+        'original': os.path.join(workdir, f'dns_result_original_{day}.csv{OUTPUT_SUFFIX}'),
+        'final': os.path.join(workdir, f'dns_result_{day}.csv{OUTPUT_SUFFIX}'),
+        'updated_values': os.path.join(workdir, f'updated_values_{day}.csv{OUTPUT_SUFFIX}'),
+        'manifest': os.path.join(workdir, f'run_manifest_{day}.json'),
+    }
+
+
+def month_file_for(day, workdir='.'):
+    """Return the month file of a day in 'workdir', 'month_YYYY.csv' like is_first_day_of_month names it."""
+    return os.path.join(workdir, f"{date.fromisoformat(day).strftime('%B_%Y').lower()}.csv{OUTPUT_SUFFIX}")
+
+
+def run_day_stages(day, workdir, options):
+    """
+    Run the stages of one day up to the daily file with the provider columns (and its sketch), in 'workdir'.
+
+    Args:
+        day (str): The day, 'YYYY-MM-DD'; its input is 'dns_result_original_<day>.csv' in 'workdir'.
+        workdir (str): The directory of the input, output and intermediate files of the day (day_files),
+            the paths of the options are relative to the current directory.
+        options (argparse.Namespace): The options of the command line.
+
+    Returns:
+        tuple: The path of the daily file, to be merged into the month by merge_day, and the measurements
+            of its stages (StageMetrics.stages, empty with --no-metrics).
+    """
+    files = day_files(day, workdir)
+    original_file, daily_file, mapping_file = files['original'], files['final'], files['updated_values']
+    metrics = None if options.no_metrics else StageMetrics(day, options.profile_stage, options.profile_dir, options.metrics_rows)
+    ptr_cache = None
+    if not options.no_ptr_cache:
+        ptr_cache = PtrCache(options.ptr_cache, options.ptr_cache_ttl, options.ptr_negative_ttl, options.ptr_failure_ttl, options.ptr_cache_size)
+    manifest = None if options.no_manifest else RunManifest(options.manifest or files['manifest'], day)
+    lookup_options = {'dns_server': options.dns_server, 'timeout': options.dns_timeout, 'attempts': options.dns_attempts,
+                      'workers': options.dns_workers, 'dns_port': options.dns_port}
+    try:
+        if options.streaming:
+            run_stage(manifest, 'transform_streaming', [original_file, file_to_match], [daily_file, mapping_file],
+                      transform_streaming, file_to_match, ptr_cache, original_file, mapping_file, daily_file, metrics=metrics, **lookup_options)
+        else:
+            run_stage(manifest, 'reversed_values_lookup', [original_file], [mapping_file], reversed_values_lookup, cache=ptr_cache,
+                      original_csv_file=original_file, updated_values_file=mapping_file, metrics=metrics, **lookup_options)
+    finally:
+        if ptr_cache is not None:
+            ptr_cache.close()
+    if not options.streaming:
+        run_stage(manifest, 'replace_found_fqdns', [original_file, mapping_file], [daily_file], replace_found_fqdns,
+                  original_file, mapping_file, daily_file, metrics=metrics)
+        if options.count_workers > 1:
+            run_stage(manifest, 'count_queries', [daily_file], [daily_file], count_queries_parallel, daily_file, options.count_workers,
+                      metrics=metrics)
+        elif options.compact:
+            run_stage(manifest, 'count_queries', [daily_file], [daily_file], count_queries_compact, daily_file, metrics=metrics)
+        else:
+            run_stage(manifest, 'count_queries', [daily_file], [daily_file], count_queries_from_csv, daily_file, metrics=metrics)
+        run_stage(manifest, 'update_csv_file_with_columns', [daily_file, file_to_match], [daily_file], update_csv_file_with_columns,
+                  file_to_match, daily_file, metrics=metrics)
+    if options.sketch_dir:
+        sketch_file = os.path.join(options.sketch_dir, f'{day}.sketch')
+        run_stage(manifest, 'sketch_day', [daily_file], [sketch_file],
+                  dns_sketches.sketch_day, read_query_counts(daily_file, min_columns=3), day, options.sketch_dir, options.sketch_top_k,
+                  metrics=metrics)
+    logging.info('run_day_stages(): Built %s', daily_file)
+    return daily_file, metrics.stages if metrics is not None else []
+
+
+def merge_day(day, daily_file, options, month_store=None, history=None, metrics=None, workdir='.'):
+    """
+    Merge the daily file of a day into its month: the MonthStore if given, otherwise the month CSV file
+    (append_csv and count_appended, guarded by the "merged into month" marker of the run manifest of the day).
+    When the day is the last one of its month, the month is then added to the HistoryStore if given.
+    The merge stages are measured by 'metrics' (StageMetrics) if given. The default month file and run
+    manifest of the day are in 'workdir'.
+    """
+    month_file_name = options.month_file or month_file_for(day, workdir)
+    manifest = None if options.no_manifest else RunManifest(options.manifest or day_files(day, workdir)['manifest'], day)
+    if month_store is not None:
+        run_stage(None, 'month_store_merge', [daily_file], [], month_store.merge_day, daily_file, day, metrics=metrics)
+        if options.export_month:
+            month_store.export(month_file_name, day[:7])
+    elif manifest is not None and manifest.merged_into_month(month_file_name) == 'combined':
+        logging.info('merge_day(): %s is already merged into %s, skipping', day, month_file_name)
+    else:
+        if not os.path.exists(month_file_name):
+            with open_file(month_file_name, 'w', newline='') as file:
+                csv.writer(file).writerow(['query', 'total quantity', 'service provider name', 'sid'])
+            logging.info('merge_day(): Created %s', month_file_name)
+        step = manifest.merged_into_month(month_file_name) if manifest is not None else None
+        if step == 'appended':
+            # count_appended replaces the month file atomically and combining is idempotent: the file is either
+            # the appended one or already combined by an interrupted run
+            logging.info('merge_day(): %s is already appended to %s, combining it', day, month_file_name)
+        else:
+            if step == 'appending':
+                restore_month_file(month_file_name, manifest.merge_marker(month_file_name))
+            elif manifest is not None:
+                manifest.mark_merged(month_file_name, 'appending')
+            run_stage(None, 'append_csv', [daily_file], [month_file_name], append_csv, daily_file, month_file_name,
+                      metrics=metrics, appends=[month_file_name])
+            if manifest is not None:
+                manifest.mark_merged(month_file_name, 'appended')
+        if options.compact:
+            run_stage(None, 'count_appended', [month_file_name], [month_file_name], count_appended_compact, month_file_name, metrics=metrics)
+        else:
+            run_stage(None, 'count_appended', [month_file_name], [month_file_name], count_appended, month_file_name, metrics=metrics)
+        if manifest is not None:
+            manifest.mark_merged(month_file_name, 'combined')
+    last_day_of_month = (date.fromisoformat(day) + timedelta(days=1)).day == 1
+    if history is not None and last_day_of_month:
+        if month_store is not None:
+            month_store.export(month_file_name, day[:7])
+        history.add_month(month_file_name, day[:7])
+
+
+def run_days(days, workdir, options, processes=1):
+    """
+    Run the stages of several days in a pool of processes, then merge the daily files into their months in date order.
+
+    The days are merged one after the other, oldest first, as soon as all the older days are built; the merge stops
+    at the first day that failed, so a rerun (which skips what the run manifests record as done) keeps the order.
+
+    Args:
+        days (list): The days, 'YYYY-MM-DD'.
+        workdir (str): The directory of the input, output and intermediate files of the days, see run_day_stages.
+        options (argparse.Namespace): The options of the command line.
+        processes (int): The number of days built at the same time, 1 runs them in this process.
+
+    The measurements of the stages of every day (StageMetrics) are written to options.metrics_file at the end,
+    also when a day failed.
+
+    Returns:
+        list: The merged days.
+    """
+    days = sorted(days)
+    daily_files = {}
+    failed = {}
+    started = time.monotonic()
+    started_at = datetime.datetime.now().isoformat(timespec='seconds')
+    # in the default metrics file name, so a rerun of the same days does not overwrite the measurements of a failed run
+    run_id = f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    metrics = None if options.no_metrics else StageMetrics(days[0], options.profile_stage, options.profile_dir, options.metrics_rows)
+    day_stages = {}
+    if processes > 1 and len(days) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(run_day_stages, day, workdir, options): day for day in days}
+            for future in as_completed(futures):
+                try:
+                    daily_files[futures[future]], day_stages[futures[future]] = future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+                    logging.error('run_days(): %s failed: %s', futures[future], e)
+    else:
+        for day in days:
+            try:
+                daily_files[day], day_stages[day] = run_day_stages(day, workdir, options)
+            except Exception as e:
+                failed[day] = e
+                logging.error('run_days(): %s failed: %s', day, e)
+                break
+    if metrics is not None:
+        for day in sorted(day_stages):
+            metrics.stages.extend(day_stages[day])
+    month_store = MonthStore(options.month_store) if options.month_store else None
+    history = HistoryStore(options.history_dir, options.history_fan_in) if options.history_dir else None
+    merged = []
+    try:
+        for day in days:
+            if day not in daily_files:
+                break
+            if metrics is not None:
+                metrics.day = day
+            merge_day(day, daily_files[day], options, month_store, history, metrics, workdir)
+            merged.append(day)
+    finally:
+        if month_store is not None:
+            month_store.close()
+        if metrics is not None:
+            metrics.write(options.metrics_file or os.path.join(workdir, f'run_metrics_{days[0]}_{run_id}.json'), started_at, run_id)
+    logging.info('run_days(): Built %s of %s days and merged %s in %.1fs', len(daily_files), len(days), len(merged), time.monotonic() - started)
+    if failed:
+        first = min(failed)
+        raise RuntimeError(f'{len(failed)} days failed, the months are merged up to the day before {first}: {failed[first]}')
+    return merged
+
+
 if __name__ == "__main__":
-    month_file_name='september_2023.csv'
+    # configured here and not on import, so that the tests and other importers do not create the log file
+    logging.basicConfig(filename='csv_transformation.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Transform the DNS queries of yesterday (or of other days) and append them to the monthly file')
+    parser.add_argument('--date', default=None, help='the day to transform, YYYY-MM-DD, yesterday by default')
+    parser.add_argument('--from-date', default=None, help='the first day of a range of days to transform, YYYY-MM-DD')
+    parser.add_argument('--to-date', default=None, help='the last day of the range, YYYY-MM-DD')
+    parser.add_argument('--workdir', default='.', help='the directory of the daily input files, of their intermediate and daily files, '
+                        'run manifests, default month file and metrics; the paths of the other options are relative to the current directory')
+    parser.add_argument('--processes', type=int, default=1, help='the number of days transformed at the same time')
+    parser.add_argument('--month-file', default=None, help='the month file of every day, month_YYYY.csv of the day by default')
+    parser.add_argument('--dns-server', default=None, help='the DNS server of the PTR lookups, the first nameserver of /etc/resolv.conf by default')
+    parser.add_argument('--dns-port', type=int, default=53, help='the UDP port of the DNS server')
+    parser.add_argument('--dns-timeout', type=float, default=DNS_TIMEOUT, help='the timeout of one PTR query attempt, in seconds')
+    parser.add_argument('--dns-attempts', type=int, default=DNS_ATTEMPTS, help='the number of attempts of every PTR query')
+    parser.add_argument('--dns-workers', type=int, default=DNS_WORKERS, help='the maximum number of concurrent PTR queries')
+    parser.add_argument('--ptr-cache', default=ptr_cache_file, help='the sqlite file caching the PTR lookups between runs')
+    parser.add_argument('--no-ptr-cache', action='store_true', help='resolve every reversed FQDN without the cache')
+    parser.add_argument('--ptr-cache-ttl', type=int, default=PTR_CACHE_TTL, help='the lifetime of a found hostname, in seconds')
+    parser.add_argument('--ptr-negative-ttl', type=int, default=PTR_NEGATIVE_TTL, help='the lifetime of an NXDOMAIN answer, in seconds')
+    parser.add_argument('--ptr-failure-ttl', type=int, default=PTR_FAILURE_TTL, help='the lifetime of a timeout or a server error, in seconds')
+    parser.add_argument('--ptr-cache-size', type=int, default=PTR_CACHE_SIZE, help='the maximum number of cached names, the least recently used are evicted')
+    parser.add_argument('--streaming', action='store_true', help='build the daily file in a single pass instead of rewriting it in four steps')
+    parser.add_argument('--count-workers', type=int, default=1, help='count the queries in this many processes (byte-range shards with a hash-partitioned reduce)')
+    parser.add_argument('--compact', action='store_true', help='count and combine the queries with interned ids and typed arrays')
+    parser.add_argument('--sketch-dir', default=None, help='save the Count-Min/top-K/HyperLogLog sketch of the day in this directory (see dns_sketches.py)')
+    parser.add_argument('--sketch-top-k', type=int, default=dns_sketches.TOP_K, help='the number of heavy hitters kept by the sketch')
+    parser.add_argument('--manifest', default=None, help='the run manifest of the day (run_manifest_<day>.json by default), a rerun skips the stages it records as done')
+    parser.add_argument('--no-manifest', action='store_true', help='run every stage without the run manifest')
+    parser.add_argument('--month-store', default=None, help='merge the day into this sqlite store instead of appending it to the month CSV file')
+    parser.add_argument('--export-month', action='store_true', help='with --month-store, write the month CSV file from the store after the merge')
+    parser.add_argument('--history-dir', default=None, help='on the last day of the month, add the month as a partition of this history store instead of appending it to dns_full_data.csv')
+    parser.add_argument('--history-totals', default=None, help='write the totals of the history store (all the months, or --history-year) into this CSV file')
+    parser.add_argument('--history-year', default=None, help='the year of --history-totals, YYYY')
+    parser.add_argument('--history-fan-in', type=int, default=HISTORY_FAN_IN, help='the maximum number of partitions merged at a time by --history-totals')
+    parser.add_argument('--metrics-file', default=None, help='the JSON file of the stage measurements of the run (run_metrics_<first day>_<YYYYmmddTHHMMSS start>-<pid>.json by default), also written in the OpenMetrics format with a .prom extension')
+    parser.add_argument('--metrics-rows', action='store_true', help='count the rows of the stages the run manifest does not fingerprint, by reading their files again')
+    parser.add_argument('--no-metrics', action='store_true', help='do not measure the stages')
+    parser.add_argument('--profile-stage', default=None, help='run this stage (e.g. count_queries or count_queries_from_csv) under cProfile and dump <stage>_<day>.prof')
+    parser.add_argument('--profile-dir', default='.', help='the directory of the --profile-stage dumps')
+    args = parser.parse_args()
+    first_day = args.from_date or args.date or FROM_DATE
+    last_day = args.to_date or first_day
+    days = [(date.fromisoformat(first_day) + timedelta(days=offset)).isoformat()
+            for offset in range((date.fromisoformat(last_day) - date.fromisoformat(first_day)).days + 1)]
+    if not days:
+        parser.error(f'--to-date {last_day} is before {first_day}')
+    if args.manifest and len(days) > 1:
+        parser.error('--manifest names the manifest of one day, the days of a range use run_manifest_<day>.json')
     #is_first_day_of_month()
-    reversed_values_lookup()
-    replace_found_fqdns()
-    count_queries_from_csv(final_file)
-    update_csv_file_with_columns(file_to_match)
-    append_csv(final_file, month_file_name)
-    count_appended(month_file_name)
     #if_last_day_of_the_month(month_file_name)
+    run_days(days, args.workdir, args, args.processes)
+    if args.history_dir and args.history_totals:
+        HistoryStore(args.history_dir, args.history_fan_in).totals(args.history_totals, args.history_year)
     #clean_up()
     logging.info('Completed the script')
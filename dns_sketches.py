@@ -0,0 +1,261 @@
+"""Bounded-memory sketches of the daily DNS query counts, to answer "top N FQDNs" and "how many distinct names"
+without rescanning the month and history files.
+
+Every day csv_transformation.py (--sketch-dir) feeds the counted queries of the day that have a provider (the rows
+the month file keeps) into a QuerySketch:
+    a Count-Min sketch of the quantities, the top-K heavy hitters checked against it, and a HyperLogLog
+    of the distinct FQDNs.
+The sketch is saved as '<dir>/YYYY-MM-DD.sketch'. Sketches of the same width, depth, K and precision merge
+exactly (the Count-Min counters add up, the HyperLogLog registers take the maximum), so a month or a year is
+the merge of its days, or of its '<dir>/YYYY-MM.sketch' rollups, in a constant memory.
+Usage: python dns_sketches.py --dir sketches --period 2023-09 --top 1000 --rollup
+"""
+import argparse
+import base64
+import collections
+import glob
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+from array import array
+
+CMS_WIDTH = 2 ** 16
+CMS_DEPTH = 4
+TOP_K = 1000
+HLL_PRECISION = 14
+
+
+def hash64(name):
+    """A 64-bit hash of a FQDN, the same in every process and run (unlike hash())."""
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class CountMinSketch:
+    """A Count-Min sketch: the estimate of a quantity is never lower than the true one, and higher by at most
+    e/width of the total with a probability of 1 - exp(-depth)."""
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH, counters=None):
+        self.width = width
+        self.depth = depth
+        self.counters = counters if counters is not None else array('Q', bytes(8 * width * depth))
+        self.total = 0
+
+    def cells(self, name):
+        """The counter of the FQDN in every row, from two 64-bit hashes (Kirsch-Mitzenmacher)."""
+        digest = hashlib.blake2b(name.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return [row * self.width + (first + row * second) % self.width for row in range(self.depth)]
+
+    def add(self, name, count=1):
+        """Add the quantity of a FQDN and return its new estimate."""
+        counters = self.counters
+        estimate = None
+        for cell in self.cells(name):
+            counters[cell] += count
+            if estimate is None or counters[cell] < estimate:
+                estimate = counters[cell]
+        self.total += count
+        return estimate
+
+    def estimate(self, name):
+        return min(self.counters[cell] for cell in self.cells(name))
+
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError(f'cannot merge a {other.width}x{other.depth} Count-Min sketch into a {self.width}x{self.depth} one')
+        self.counters = array('Q', map(sum, zip(self.counters, other.counters)))
+        self.total += other.total
+
+
+class HyperLogLog:
+    """A HyperLogLog of the distinct FQDNs, with a relative standard error of 1.04/sqrt(2**precision)."""
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(2 ** precision)
+
+    def add(self, name):
+        value = hash64(name)
+        index = value >> (64 - self.precision)
+        remaining = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers * registers / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * registers and zeros:
+            # small range correction: linear counting
+            estimate = registers * math.log(registers / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        if self.precision != other.precision:
+            raise ValueError(f'cannot merge a HyperLogLog of precision {other.precision} into one of {self.precision}')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+
+class QuerySketch:
+    """
+    The Count-Min sketch, the top-K heavy hitters and the HyperLogLog of the queries of a period.
+
+    The heavy hitters are the candidates with the highest Count-Min estimates: up to 2*K are kept between
+    two prunings, and a FQDN gets in when its estimate passes the lowest one kept by the last pruning,
+    so a FQDN that becomes heavy later in the period still gets in.
+    """
+    def __init__(self, top_k=TOP_K, width=CMS_WIDTH, depth=CMS_DEPTH, precision=HLL_PRECISION):
+        self.top_k = top_k
+        self.cms = CountMinSketch(width, depth)
+        self.hll = HyperLogLog(precision)
+        self.candidates = {}
+        self.threshold = 0
+        self.periods = []
+
+    def add(self, name, count=1):
+        estimate = self.cms.add(name, count)
+        self.hll.add(name)
+        if name in self.candidates or estimate > self.threshold:
+            self.candidates[name] = estimate
+            if len(self.candidates) > 2 * self.top_k:
+                self.prune()
+
+    def prune(self):
+        """Keep the K candidates with the highest estimates."""
+        self.candidates = dict(heapq.nlargest(self.top_k, self.candidates.items(), key=lambda item: item[1]))
+        self.threshold = min(self.candidates.values(), default=0)
+
+    def top(self, count=None):
+        """Return the (FQDN, estimated quantity) of the heaviest hitters, highest first."""
+        ranked = sorted(((name, self.cms.estimate(name)) for name in self.candidates), key=lambda item: (-item[1], item[0]))
+        return ranked[:count or self.top_k]
+
+    def distinct(self):
+        return self.hll.count()
+
+    def merge(self, other):
+        """Merge the sketch of another period (e.g. another day) into this one."""
+        self.cms.merge(other.cms)
+        self.hll.merge(other.hll)
+        names = set(self.candidates) | set(other.candidates)
+        self.candidates = {name: self.cms.estimate(name) for name in names}
+        if len(self.candidates) > self.top_k:
+            self.prune()
+        self.periods.extend(other.periods)
+
+    def save(self, file_name):
+        """Write the sketch as gzip JSON, atomically."""
+        payload = {
+            'periods': sorted(self.periods),
+            'top_k': self.top_k,
+            'cms': {'width': self.cms.width, 'depth': self.cms.depth, 'total': self.cms.total,
+                    'counters': base64.b64encode(self.cms.counters.tobytes()).decode('ascii')},
+            'hll': {'precision': self.hll.precision, 'registers': base64.b64encode(bytes(self.hll.registers)).decode('ascii')},
+            'candidates': sorted(self.candidates),
+        }
+        temporary_file = f'{file_name}.tmp'
+        with gzip.open(temporary_file, 'wt', encoding='utf-8') as sketch_file:
+            json.dump(payload, sketch_file)
+        os.replace(temporary_file, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        with gzip.open(file_name, 'rt', encoding='utf-8') as sketch_file:
+            payload = json.load(sketch_file)
+        sketch = cls(payload['top_k'], payload['cms']['width'], payload['cms']['depth'], payload['hll']['precision'])
+        sketch.cms.counters = array('Q')
+        sketch.cms.counters.frombytes(base64.b64decode(payload['cms']['counters']))
+        sketch.cms.total = payload['cms']['total']
+        sketch.hll.registers = bytearray(base64.b64decode(payload['hll']['registers']))
+        sketch.candidates = {name: sketch.cms.estimate(name) for name in payload['candidates']}
+        sketch.periods = payload['periods']
+        return sketch
+
+
+def sketch_day(query_counts, day, directory, top_k=TOP_K):
+    """
+    Build and save the sketch of one day from its (FQDN, quantity) pairs.
+
+    Returns:
+        str: The path of the sketch file.
+    """
+    sketch = QuerySketch(top_k)
+    for name, count in query_counts:
+        sketch.add(name, count)
+    sketch.periods = [day]
+    os.makedirs(directory, exist_ok=True)
+    file_name = os.path.join(directory, f'{day}.sketch')
+    sketch.save(file_name)
+    logging.info('sketch_day(): Saved the sketch of %s: %s queries, ~%s distinct FQDNs', day, sketch.cms.total, sketch.distinct())
+    return file_name
+
+
+def load_period(directory, period, from_days=False):
+    """
+    Merge the sketches of a period: a month 'YYYY-MM', a year 'YYYY' or '' for all the history.
+
+    A month rollup 'YYYY-MM.sketch' is used instead of the days of its month when its periods cover every
+    'YYYY-MM-DD.sketch' of the month, otherwise (a day was sketched after the rollup) the day files are merged.
+
+    Args:
+        directory (str): The directory of the sketch files.
+        period (str): The period.
+        from_days (bool): Merge the day files even where a rollup covers them, to build a new rollup.
+
+    Returns:
+        QuerySketch: The merged sketch, None if there is no sketch in the period.
+    """
+    days = collections.defaultdict(list)
+    rollups = {}
+    for path in sorted(glob.glob(os.path.join(directory, f'{period}*.sketch'))):
+        name = os.path.basename(path)
+        if len(name) == len('YYYY-MM-DD.sketch'):
+            days[name[:7]].append(path)
+        elif len(name) == len('YYYY-MM.sketch'):
+            rollups[name[:7]] = path
+    merged = None
+    files = 0
+    for month in sorted(set(days) | set(rollups)):
+        sketches = None
+        if month in rollups and not (from_days and days[month]):
+            rollup = QuerySketch.load(rollups[month])
+            if set(os.path.basename(path)[:10] for path in days[month]) <= set(rollup.periods):
+                sketches = [rollup]
+                files += 1
+            else:
+                logging.info('load_period(): The rollup of %s misses days sketched after it, merging its day files', month)
+        if sketches is None:
+            sketches = (QuerySketch.load(path) for path in days[month])
+            files += len(days[month])
+        for sketch in sketches:
+            if merged is None:
+                merged = sketch
+            else:
+                merged.merge(sketch)
+    logging.info('load_period(): Merged %s sketch files of %r', files, period)
+    return merged
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Report the top FQDNs and the distinct count of a period from the daily sketches')
+    parser.add_argument('--dir', default='sketches', help='the directory of the sketch files')
+    parser.add_argument('--period', default='', help="the period: 'YYYY-MM', 'YYYY' or '' for all the history")
+    parser.add_argument('--top', type=int, default=20, help='the number of heavy hitters to print')
+    parser.add_argument('--rollup', action='store_true', help="save the merged sketch of a 'YYYY-MM' period as its month rollup")
+    args = parser.parse_args()
+    if args.rollup and len(args.period) != len('YYYY-MM'):
+        parser.error('--rollup needs a YYYY-MM period')
+    # a rollup is always rebuilt from the day files, never from the previous rollup
+    sketch = load_period(args.dir, args.period, from_days=args.rollup)
+    if sketch is None:
+        parser.error(f'no sketch of {args.period!r} in {args.dir}')
+    if args.rollup:
+        sketch.save(os.path.join(args.dir, f'{args.period}.sketch'))
+    print(f'period: {args.period or "all"}  days: {len(sketch.periods)}  queries: {sketch.cms.total}  distinct FQDNs: ~{sketch.distinct()}')
+    for rank, (name, estimate) in enumerate(sketch.top(args.top), start=1):
+        print(f'{rank:5}  {estimate:12}  {name}')
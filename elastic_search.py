@@ -17,14 +17,70 @@ Iterate the dictionary of those values, keep a count of it and start calling API
     - increment the loop_number variabl
     If last_sort_value is None: stop calling the funtion
     The loop will be ended, if the count of left hostnames is less then 1
+With --concurrent every hostname runs the steps above in its own worker thread (collect_endpoint),
+the number of workers is limited by --workers and a docs/sec summary is logged per host.
+With --slices N the PIT of every hostname is split into N slices which are walked in parallel,
+each slice with its own search_after cursor; the PIT is closed when all the slices are done.
+With --aggregate no hits are downloaded: a composite terms aggregation on the fqdn field is paged
+on the server side and the 'fqdn,count' rows are written once, in the format of count_queries_from_csv.
+With --stream only the fqdn field and the sort values are requested (_source + filter_path) and every page
+is parsed incrementally by iter_hits, which yields (fqdn, sort) pairs without building the whole JSON tree.
+With --preaggregate the fetched FQDNs are counted in memory by FqdnCountWriter across all the pages and
+endpoints (spilling sorted runs to disk above --memory-budget distinct FQDNs) and the 'fqdn,count' file is written once,
+only if every endpoint is complete: otherwise no file is written and the script exits with status 1.
+Otherwise the rows are appended to the output file, page by page.
+With --checkpoint the output is started from scratch (truncated) and the rows are appended through a Checkpoint,
+which saves the last sort value, page number, rows written and output byte offset of every cursor
+(hostname or hostname/slice-N) after each page in checkpoint_{FROM_DATE}.json.
+With --resume (which implies --checkpoint) the output is truncated to the last committed offset and every
+unfinished cursor continues with search_after from its checkpoint on a new PIT.
+With --window-docs N the day FROM_DATE..TO_DATE is split by plan_windows into time windows of at most ~N docs
+(hourly windows are counted with _count and the dense ones are bisected), and the windows of every endpoint
+are walked by a pool of --window-workers threads, each window with its own search_after cursor.
+All the requests of an endpoint go through its Transport: one keep-alive session, gzip compressed request and
+response bodies (--no-compression to disable), no ?pretty, retries with backoff on 429/5xx and connection errors
+(a PIT is opened by every executed request, so opening one is retried only on 429 and refused connections),
+and the bytes on the wire and a latency histogram are logged per endpoint at the end of the run.
+With --adaptive-page-size every cursor gets a PageSizer, which picks the size of the next page from the response
+time and payload bytes of its recent pages, within --min-page-size..--max-page-size.
+With --backfill-from/--backfill-to one job per day and endpoint is run on a pool of --workers threads, every day is
+written to its own dns_result_original_<day>.csv[.gz|.zst] (and checkpoint_<day>.json), and a '<output>.done' marker is written
+when all the endpoints of the day are complete; the days that already have the marker are skipped, the other ones
+are started from scratch (their output is truncated) unless --resume is given.
+With --pipeline the cursors only fetch the raw pages (reading the last sort value from the end of the page, checked,
+or from the whole page when it is not the last key of the last hit) and push
+them to the bounded queues of a PagePipeline, whose --parse-workers threads parse and write them, so the network
+and the parsing/writing overlap; a full queue blocks its fetchers until the writers catch up.
+With DNS_COMPRESSION=gz (or zst) in the environment the output and spill files are written through a streaming
+gzip (zstd) compressor, with the '.gz' ('.zst') suffix that csv_transformation.py expects (compressed_files.py).
 '''
+import argparse
 import json
 import csv
+import codecs
+import collections
+from collections import deque
+import contextlib
+import gzip
+import heapq
+import os
+import queue
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
 import datetime
 import subprocess
+import sys
 import logging
+import re
+import threading
+import time
+import zlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from compressed_files import compression_suffix, is_compressed, open_file
 
 
 logging.basicConfig(filename='example.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -32,38 +88,283 @@ today = date.today()
 yesterday = today - timedelta(days=1)
 FROM_DATE = yesterday.strftime("%Y-%m-%d")
 TO_DATE = today.strftime("%Y-%m-%d")
-original_csv_file = f'dns_result_original_{FROM_DATE}.csv'
+# '.gz' or '.zst' with DNS_COMPRESSION, see compressed_files.py
+OUTPUT_SUFFIX = compression_suffix()
+original_csv_file = f'dns_result_original_{FROM_DATE}.csv{OUTPUT_SUFFIX}'
+checkpoint_file = f'checkpoint_{FROM_DATE}.json'
+# the @timestamp range of the DNS queries to collect
+RANGE_GTE = "2023-09-27T00:00:00"
+RANGE_LTE = "2023-09-27T00:00:10"
+# the planned windows are never split below this duration
+MIN_WINDOW = timedelta(seconds=1)
+# keyword field with the FQDN of the query, used by the aggregation mode
+FQDN_FIELD = "fqdn"
+# number of hits returned by one page of search_after
+PAGE_SIZE = 10000
+# number of buckets returned by one page of the composite aggregation
+AGGREGATION_PAGE_SIZE = 10000
+# size of the chunks read from the socket by the streaming extraction
+STREAM_CHUNK_SIZE = 64 * 1024
+HITS_ARRAY_START = re.compile(r'"hits"\s*:\s*\[')
+# all the worker threads append to the same csv file, so the writes are serialized
+write_lock = threading.Lock()
+transport_lock = threading.Lock()
+# responses with these status codes are retried by Transport
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# upper bounds (seconds) of the buckets of the request latency histogram
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def load_endpoints(credentials_file='credentials.json'):
+    """
+    Read the credentials JSON and build the dictionary of endpoints to collect the data from.
+
+    Args:
+        credentials_file (str): The path to the JSON file with the credentials.
+
+    Returns:
+        dict: hostname -> {'url', 'user', 'password'} for every endpoint.
+    """
+    with open(credentials_file, 'r') as json_file:
+        credentials = json.load(json_file)
+
+    #extact all the values from json
+    password_hostname1 = credentials['password_hostname1']
+    # password_hostname2 = credentials['password_hostname2']
+    # password_hostname3 = credentials['password_hostname3']
+    # password_hostname4 = credentials['password_hostname4']
+    user = credentials['user']
+    url_hostname1 = credentials['url_hostname1']
+    # url_hostname2 = credentials['url_hostname2']
+    # url_hostname3 = credentials['url_hostname3']
+    # url_hostname4 = credentials['url_hostname4']
+    endpoints = {
+    "hostname1": {
+        "url": url_hostname1,
+        "user": user,
+        "password": password_hostname1
+    },
+    "hostname2": {
+        "url": url_hostname1,
+        "user": user,
+        "password": password_hostname1
+    },
+    # "hostname3": {
+    #     "url": url_hostname3,
+    #     "user": user,
+    #     "password": password_hostname3
+    # },
+    # "hostname4": {
+    #     "url": url_hostname4,
+    #     "user": user,
+    #     "password": password_hostname4
+    # }
+                }
+    return endpoints
+
+
+def is_connect_error(error):
+    """Return True if a request failed before its connection was established, so nothing was sent."""
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+
+class Transport:
+    """
+    HTTP transport of one endpoint: a persistent keep-alive session with gzip compression, retries and statistics.
+
+    Request bodies are sent gzip compressed (Content-Encoding: gzip) and gzip responses are accepted,
+    429 and 5xx responses and connection errors are retried with exponential backoff (or Retry-After).
+    A request that is not idempotent, like opening a PIT, is retried only when it cannot have been executed:
+    when the connection could not be established or the cluster answered 429.
+    The bytes sent and received on the wire and the latency of every request are recorded.
+
+    Args:
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        compress (bool): Compress the request bodies.
+        retries (int): The maximum number of retries of one request.
+        backoff (float): The delay before the first retry in seconds, doubled on every retry.
+        pool_size (int): The maximum number of connections kept open to the endpoint.
+    """
+    def __init__(self, params, compress=True, retries=5, backoff=0.5, pool_size=16):
+        self.url = params['url']
+        self.compress = compress
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.auth = (params['user'], params['password'])
+        self.session.headers.update({"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = collections.Counter()
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def wait_before_retry(self, attempt, response=None):
+        delay = self.backoff * 2 ** attempt
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = int(response.headers['Retry-After'])
+        with self.lock:
+            self.stats['retries'] += 1
+        time.sleep(min(delay, 30))
+
+    @contextlib.contextmanager
+    def open(self, method, path, data=None, timeout=100, idempotent=True):
+        """
+        Send a request and yield the streamed response, the statistics are recorded when the body is consumed.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path (and query string) relative to the endpoint URL.
+            data (dict, optional): The body of the request, sent as JSON.
+            timeout (int): The timeout of the request in seconds.
+            idempotent (bool): False if executing the request twice has a side effect, then a read timeout,
+                a dropped connection or a 5xx response is not retried: the first attempt may have been executed.
+
+        Yields:
+            requests.Response: The response of the last attempt, read with stream=True.
+        """
+        payload, headers = None, None
+        if data is not None:
+            payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+            if self.compress:
+                payload = gzip.compress(payload, compresslevel=1)
+                headers = {"Content-Encoding": "gzip"}
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, f'{self.url}{path}', data=payload, headers=headers,
+                                                timeout=timeout, stream=True)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries or not (idempotent or is_connect_error(e)):
+                    raise
+                logging.warning(f'Transport.open(): {method} {path} failed ({e}), retrying')
+                self.wait_before_retry(attempt)
+                continue
+            retry_codes = RETRY_STATUS_CODES if idempotent else (429,)
+            if response.status_code in retry_codes and attempt < self.retries:
+                response.close()
+                self.record(len(payload or b''), response, started)
+                logging.warning(f'Transport.open(): {method} {path} returned {response.status_code}, retrying')
+                self.wait_before_retry(attempt, response)
+                continue
+            break
+        try:
+            yield response
+        finally:
+            response.close()
+            self.record(len(payload or b''), response, started)
+
+    def request(self, method, path, data=None, timeout=100, idempotent=True):
+        """Send a request and return the response with its body already read, see open."""
+        with self.open(method, path, data, timeout, idempotent) as response:
+            response.content
+        return response
+
+    def record(self, bytes_sent, response, started):
+        seconds = time.monotonic() - started
+        self.local.last_request = (response.raw.tell(), seconds)
+        bucket = next((index for index, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_sent'] += bytes_sent
+            self.stats['bytes_received'] += response.raw.tell()
+            self.stats['seconds'] += seconds
+            self.latency_histogram[bucket] += 1
 
-with open('credentials.json', 'r') as json_file:
-    credentials = json.load(json_file)
+    def last_request(self):
+        """Return the bytes received and the seconds of the last request sent by the calling thread."""
+        return getattr(self.local, 'last_request', (0, 0.0))
 
-#extact all the values from json
-password_hostname1 = credentials['password_hostname1']
-# password_hostname2 = credentials['password_hostname2']
-# password_hostname3 = credentials['password_hostname3']
-# password_hostname4 = credentials['password_hostname4']
-user = credentials['user']
-url_hostname1 = credentials['url_hostname1']
-# url_hostname2 = credentials['url_hostname2']
-# url_hostname3 = credentials['url_hostname3']
-# url_hostname4 = credentials['url_hostname4']
+    def report(self, hostname):
+        """Log and return the statistics of the transport."""
+        with self.lock:
+            histogram = {f'<={bound}s': count for bound, count in zip(LATENCY_BUCKETS, self.latency_histogram)}
+            histogram[f'>{LATENCY_BUCKETS[-1]}s'] = self.latency_histogram[-1]
+            report = dict(self.stats, latency_histogram=histogram)
+        logging.info(f'Transport.report(): {hostname}: {report}')
+        return report
+
+
+class PageSizer:
+    """
+    Adaptive page size of one search_after cursor.
+
+    After every page the time and the payload bytes per hit of the recent pages are used to compute
+    the size of a page that would take target_seconds and stay under max_bytes. The size moves towards it,
+    at most by a factor of 2 per page, within min_size..max_size.
+
+    Args:
+        name (str): The name of the cursor, used in the logs.
+        min_size (int): The smallest page size.
+        max_size (int): The largest page size, index.max_result_window (10000 by default) is the limit of Elasticsearch.
+        target_seconds (float): The wanted response time of one page.
+        max_bytes (int): The largest wanted payload of one page.
+        history (int): The number of recent pages taken into account.
+    """
+    def __init__(self, name='', min_size=500, max_size=PAGE_SIZE, target_seconds=2.0, max_bytes=20 * 1024 * 1024, history=3):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.size = max_size
+        self.recent = deque(maxlen=history)
+        self.chosen_sizes = collections.Counter()
+
+    def observe(self, docs, wire_bytes, seconds):
+        """Take the measurements of the last page into account and return the size of the next page."""
+        self.chosen_sizes[self.size] += 1
+        if docs == 0:
+            return self.size
+        self.recent.append((docs, wire_bytes, seconds))
+        recent_docs = sum(page[0] for page in self.recent)
+        seconds_per_doc = sum(page[2] for page in self.recent) / recent_docs
+        bytes_per_doc = sum(page[1] for page in self.recent) / recent_docs
+        ideal_size = self.max_size
+        if seconds_per_doc > 0:
+            ideal_size = min(ideal_size, self.target_seconds / seconds_per_doc)
+        if bytes_per_doc > 0:
+            ideal_size = min(ideal_size, self.max_bytes / bytes_per_doc)
+        new_size = int(max(self.size / 2, min(self.size * 2, ideal_size)))
+        new_size = max(self.min_size, min(self.max_size, new_size))
+        if new_size != self.size:
+            logging.info(f'PageSizer.observe(): {self.name}: Page of {docs} hits took {seconds:.2f} s and {wire_bytes} bytes, '
+                         f'page size {self.size} -> {new_size}')
+            self.size = new_size
+        return self.size
+
+    def report(self):
+        logging.info(f'PageSizer.report(): {self.name}: Pages per chosen size {dict(sorted(self.chosen_sizes.items()))}')
+
+
+def get_transport(params):
+    """Return the Transport of an endpoint, it is created with the default options on the first call."""
+    with transport_lock:
+        if 'transport' not in params:
+            params['transport'] = Transport(params)
+        return params['transport']
 
 
 #for how long do we need the keep alive?
-def get_pit():
+def get_pit(params):
     """
     Retrieve a PIT (Point-In-Time) value to be passed to the search_after function.
 
     This function sends a request to a specified URL to obtain a PIT value for a specific data query.
     The PIT is used for querying data in a Point-In-Time state.
 
+    Args:
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+
     Returns:
         str or None: The PIT value retrieved from the API, or None if the request fails.
     """
-    full_url = f"{url}/secured_eaas_stg-jpe2b_dns_queries-*/_pit?keep_alive=10m"
-    auth = (user, password)
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(full_url, auth=auth, headers=headers, timeout=100)
+    # every executed request opens a PIT, so it is not retried once it may have reached the cluster
+    response = get_transport(params).request('POST', '/secured_eaas_stg-jpe2b_dns_queries-*/_pit?keep_alive=10m',
+                                             idempotent=False)
     if response.status_code == 200:
         logging.info('get_pit(): Request to get a PIT was successful.')
         api_response = response.text
@@ -75,6 +376,25 @@ def get_pit():
     return pit
 
 
+def close_pit(pit, params):
+    """
+    Close a PIT explicitly instead of waiting for its keep_alive to expire.
+
+    Args:
+        pit (str): The PIT id returned by get_pit.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+
+    Returns:
+        bool: True if the PIT was closed, False otherwise.
+    """
+    response = get_transport(params).request('DELETE', '/_pit', {"id": pit})
+    if response.status_code == 200:
+        logging.info('close_pit(): The PIT was closed.')
+        return True
+    logging.error(f"close_pit(): Request to close the PIT failed with status code {response.status_code}.")
+    return False
+
+
 def extract_fqdn(data):
     """
     Recursively extract FQDNs from nested dictionaries and lists.
@@ -143,13 +463,384 @@ def find_last_key_value(last_response_data):
         return None
 
 
-def write_queries(fqdn_values):
+def get_field(source, field):
+    """
+    Return the value of a (possibly dotted) field from a hit '_source', or None if it is missing.
+
+    Both the flat form {"a.b": value} and the nested form {"a": {"b": value}} are supported.
+    """
+    if field in source:
+        return source[field]
+    value = source
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def iter_hits(chunks):
+    """
+    Incrementally parse a search response and yield the (fqdn, sort) pair of every hit.
+
+    Only the current hit and the unparsed tail of the last chunk are kept in memory:
+    the response is scanned up to the 'hits.hits' array and every element of the array
+    is decoded on its own with json.JSONDecoder.raw_decode as soon as it is complete.
+
+    Args:
+        chunks (iterable): The bytes of the response, e.g. response.iter_content().
+
+    Yields:
+        tuple: The FQDN of the hit (None if the hit has no FQDN_FIELD) and its sort value.
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    position = None
+    exhausted = False
+    while True:
+        if position is None:
+            match = HITS_ARRAY_START.search(buffer)
+            if match:
+                position = match.end()
+                continue
+        else:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                if buffer[position] == ']':
+                    return
+                try:
+                    hit, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if exhausted:
+                        raise
+                else:
+                    yield get_field(hit.get('_source', {}), FQDN_FIELD), hit.get('sort')
+                    continue
+            buffer = buffer[position:]
+            position = 0
+        if exhausted:
+            return
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer += utf8_decoder.decode(b'', final=True)
+        else:
+            buffer += utf8_decoder.decode(chunk)
+
+
+def temporary_name(file_name):
+    """Return the name of the temporary file replacing 'file_name' atomically, with the same compression suffix."""
+    directory, base_name = os.path.split(file_name)
+    return os.path.join(directory, f'.tmp_{base_name}')
+
+
+class FqdnCountWriter:
+    """
+    Pre-aggregating writer: counts the FQDNs of all the pages and endpoints and writes 'fqdn,count' rows once.
+
+    A temporary file next to the output is opened when the writer is created and written when it is closed,
+    then it replaces the output; abort() removes it instead, so a failed collection leaves no partial file.
+    If memory_budget is set and the counter holds more distinct FQDNs than that, the counter is
+    spilled to disk as a run sorted by FQDN; on close the runs are merged with heapq.merge, so the
+    memory needed is bounded by the budget and not by the number of distinct FQDNs of the day.
+
+    Args:
+        file_name (str): The path to the output CSV file, it is overwritten.
+        memory_budget (int, optional): The maximum number of distinct FQDNs kept in memory.
+        spill_dir (str, optional): The directory for the spilled runs, the output directory by default.
+    """
+    def __init__(self, file_name=original_csv_file, memory_budget=None, spill_dir=None):
+        self.file_name = file_name
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir or os.path.dirname(os.path.abspath(file_name))
+        self.counter = collections.Counter()
+        self.spill_files = []
+        self.lock = threading.Lock()
+        self.partial_file = temporary_name(file_name)
+        self.file = open_file(self.partial_file, 'w', newline='', buffering=1024 * 1024)
+
+    def write(self, fqdn_values, last_sort_value=None):
+        """Add a page of FQDNs to the running counter, thread safe."""
+        with self.lock:
+            self.counter.update(fqdn_values)
+            if self.memory_budget and len(self.counter) > self.memory_budget:
+                self.spill()
+
+    def spill(self):
+        """Write the counter to a temporary file sorted by FQDN and clear it."""
+        descriptor, spill_name = tempfile.mkstemp(dir=self.spill_dir, prefix='fqdn_counts_', suffix=f'.spill.csv{OUTPUT_SUFFIX}')
+        os.close(descriptor)
+        with open_file(spill_name, 'w', newline='') as spill_file:
+            csv.writer(spill_file).writerows(sorted(self.counter.items()))
+        self.spill_files.append(spill_name)
+        logging.info(f'FqdnCountWriter.spill(): Spilled {len(self.counter)} FQDNs to {spill_name}')
+        self.counter.clear()
+
+    def merged_counts(self):
+        """Yield the (fqdn, count) pairs of the counter and of all the spilled runs, duplicates summed."""
+        if not self.spill_files:
+            yield from self.counter.items()
+            return
+        spill_handles = [open_file(file_name, 'r', newline='') for file_name in self.spill_files]
+        try:
+            runs = [((row[0], int(row[1])) for row in csv.reader(handle)) for handle in spill_handles]
+            runs.append(iter(sorted(self.counter.items())))
+            current, current_count = None, 0
+            for fqdn, count in heapq.merge(*runs):
+                if fqdn != current:
+                    if current is not None:
+                        yield current, current_count
+                    current, current_count = fqdn, 0
+                current_count += count
+            if current is not None:
+                yield current, current_count
+        finally:
+            for handle in spill_handles:
+                handle.close()
+
+    def close(self):
+        """Write the aggregated rows, in the format of count_queries_from_csv, and remove the spilled runs."""
+        with self.lock:
+            writer = csv.writer(self.file)
+            distinct = 0
+            try:
+                for value, count in self.merged_counts():
+                    if len(value) > 3:
+                        writer.writerow([value, count])
+                        distinct += 1
+                self.file.close()
+            except BaseException:
+                self.discard()
+                raise
+            os.replace(self.partial_file, self.file_name)
+            logging.info(f'FqdnCountWriter.close(): Wrote {distinct} aggregated FQDNs into {self.file_name} '
+                         f'({len(self.spill_files)} spilled runs merged)')
+            self.discard()
+
+    def abort(self):
+        """Drop the counts of a failed collection: the output is not written and the temporary files are removed."""
+        with self.lock:
+            logging.warning(f'FqdnCountWriter.abort(): {self.file_name} was not written')
+            self.discard()
+
+    def discard(self):
+        """Remove the temporary output, if it was not written, and the spilled runs, and clear the counter."""
+        self.file.close()
+        if os.path.exists(self.partial_file):
+            os.remove(self.partial_file)
+        for file_name in self.spill_files:
+            os.remove(file_name)
+        self.spill_files = []
+        self.counter.clear()
+
+
+class Checkpoint:
+    """
+    Row writer that saves a checkpoint of every search_after cursor after each page.
+
+    The rows of a page are appended to the output file and flushed, then the state of the cursor
+    (last sort value, page number, rows written, output byte offset) is saved to the checkpoint file.
+    Both steps are done under one lock, so the largest offset in the checkpoint is always the end of
+    the last committed page, even when several endpoints or slices write at the same time.
+    A compressed output ('.gz', '.zst') is closed after every page, so every page is a complete gzip member
+    (zstd frame) and the committed offset, the size of the file, can be truncated to on resume.
+
+    Args:
+        file_name (str): The path to the checkpoint JSON file.
+        output_file (str): The path to the output CSV file.
+        resume (bool): Load the checkpoint and truncate the output to the last committed offset,
+            otherwise the output and the checkpoint are started from scratch: the output is truncated.
+        slices (int): The number of slices per endpoint, a checkpoint can only be resumed with the same value.
+
+    Note:
+        - The PIT is not saved: a resumed cursor continues on a new PIT from its last sort value,
+          so documents indexed after the first run in the remaining range are collected too.
+        - The windows planned for every endpoint with --window-docs are saved too and reused on resume:
+          a new plan, from the counts of the resumed run, could move the window bounds, which are part
+          of the cursor names, and walk the committed documents again.
+    """
+    def __init__(self, file_name=checkpoint_file, output_file=original_csv_file, resume=False, slices=1):
+        self.file_name = file_name
+        self.output_file = output_file
+        self.slices = slices
+        self.cursors = {}
+        self.windows = {}
+        self.lock = threading.Lock()
+        mode = 'w'
+        if resume and os.path.exists(file_name):
+            with open(file_name, 'r', encoding='utf-8') as json_file:
+                state = json.load(json_file)
+            if state.get('slices', 1) != slices:
+                raise ValueError(f"{file_name} was written with --slices {state.get('slices', 1)}, not {slices}")
+            self.cursors = state['cursors']
+            self.windows = {hostname: [(time_range, docs) for time_range, docs in windows]
+                            for hostname, windows in state.get('windows', {}).items()}
+            offset = max((cursor['offset'] for cursor in self.cursors.values()), default=0)
+            if os.path.exists(output_file) and os.path.getsize(output_file) > offset:
+                os.truncate(output_file, offset)
+                logging.info(f'Checkpoint(): Truncated {output_file} to the last committed offset {offset}')
+            mode = 'a'
+            logging.info(f'Checkpoint(): Resuming {len(self.cursors)} cursors from {file_name}')
+        self.file = open_file(output_file, mode, newline='')
+        self.writer = csv.writer(self.file)
+        if mode == 'w':
+            self.save()
+
+    def state(self, cursor):
+        """Return the saved state of a cursor, or None if it has not committed any page yet."""
+        return self.cursors.get(cursor)
+
+    def cursor(self, cursor):
+        """Return a writer that commits the pages of one cursor, to be passed to write_queries."""
+        return CheckpointCursor(self, cursor)
+
+    def started(self, hostname):
+        """Return True if a cursor of the endpoint has committed a page."""
+        return any(cursor == hostname or cursor.startswith(f'{hostname}/') for cursor in self.cursors)
+
+    def planned_windows(self, hostname):
+        """Return the (time_range, docs) windows saved for the endpoint, or None if it was not walked by windows."""
+        return self.windows.get(hostname)
+
+    def save_windows(self, hostname, windows):
+        """Save the windows planned for the endpoint, before any of them is walked."""
+        with self.lock:
+            self.windows[hostname] = list(windows)
+            self.save()
+
+    def commit(self, cursor, fqdn_values, last_sort_value):
+        """Append the rows of a page, flush them and save the new state of the cursor."""
+        with self.lock:
+            self.writer.writerows([value] for value in fqdn_values)
+            if is_compressed(self.output_file):
+                self.file.close()
+                offset = os.path.getsize(self.output_file)
+                self.file = open_file(self.output_file, 'a', newline='')
+                self.writer = csv.writer(self.file)
+            else:
+                self.file.flush()
+                offset = self.file.buffer.tell()
+            state = self.cursors.setdefault(cursor, {'sort': None, 'page': 0, 'rows': 0, 'offset': 0, 'done': False})
+            state['page'] += 1
+            state['rows'] += len(fqdn_values)
+            state['offset'] = offset
+            if last_sort_value is None:
+                state['done'] = True
+            else:
+                state['sort'] = last_sort_value
+            self.save()
+
+    def save(self):
+        """Write the checkpoint file atomically."""
+        temporary_file = f'{self.file_name}.tmp'
+        with open(temporary_file, 'w', encoding='utf-8') as json_file:
+            json.dump({'output': self.output_file, 'slices': self.slices, 'cursors': self.cursors, 'windows': self.windows},
+                      json_file)
+        os.replace(temporary_file, self.file_name)
+
+    def close(self):
+        self.file.close()
+
+
+class CheckpointCursor:
+    """The writer of one cursor of a Checkpoint: every write commits a page."""
+    def __init__(self, checkpoint, cursor):
+        self.checkpoint = checkpoint
+        self.cursor = cursor
+
+    def write(self, fqdn_values, last_sort_value=None):
+        self.checkpoint.commit(self.cursor, fqdn_values, last_sort_value)
+
+
+class PagePipeline:
+    """
+    Bounded queues between the page fetchers and the parse/write workers.
+
+    The fetchers submit raw pages and continue with the next request right away, the workers parse the
+    pages with iter_hits and write them with write_queries. The pages of one cursor always go to the same
+    worker, so they are written (and checkpointed) in order; a full queue blocks submit, which caps the
+    number of pages held in memory to workers * depth.
+
+    Args:
+        workers (int): The number of parse/write worker threads.
+        depth (int): The maximum number of pages waiting in the queue of one worker.
+    """
+    def __init__(self, workers=2, depth=4):
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(workers)]
+        self.pending = collections.Counter()
+        self.docs = collections.Counter()
+        self.condition = threading.Condition()
+        self.error = None
+        self.threads = [threading.Thread(target=self.run, args=(page_queue,), name=f'es-parse-{index}', daemon=True)
+                        for index, page_queue in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, cursor, raw_page, writer, last_sort_value):
+        """Queue a raw page of a cursor, blocks while the queue of its worker is full."""
+        self.raise_error()
+        with self.condition:
+            self.pending[cursor] += 1
+        self.queues[zlib.crc32(cursor.encode('utf-8')) % len(self.queues)].put((cursor, raw_page, writer, last_sort_value))
+
+    def run(self, page_queue):
+        while True:
+            item = page_queue.get()
+            if item is None:
+                return
+            cursor, raw_page, writer, last_sort_value = item
+            hits = 0
+            if self.error is None:
+                try:
+                    fqdn_values = []
+                    for fqdn, _ in iter_hits([raw_page]):
+                        hits += 1
+                        if fqdn is not None:
+                            fqdn_values.append(fqdn)
+                    write_queries(fqdn_values, writer, last_sort_value)
+                except Exception as e:
+                    logging.error(f'PagePipeline.run(): {cursor}: Could not parse or write a page: {e}')
+                    self.error = e
+            with self.condition:
+                self.docs[cursor] += hits
+                self.pending[cursor] -= 1
+                if not self.pending[cursor]:
+                    del self.pending[cursor]
+                self.condition.notify_all()
+
+    def wait(self, cursor):
+        """Wait until all the submitted pages of a cursor are written and return the number of hits they held."""
+        with self.condition:
+            self.condition.wait_for(lambda: cursor not in self.pending)
+            docs = self.docs.pop(cursor, 0)
+        self.raise_error()
+        return docs
+
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f'a parse/write worker failed: {self.error}') from self.error
+
+    def close(self):
+        """Stop the workers once their queues are drained."""
+        for page_queue in self.queues:
+            page_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.raise_error()
+
+
+def write_queries(fqdn_values, writer=None, last_sort_value=None):
     """
     Write Fully Qualified Domain Names to a CSV file.
     This function takes a list of FQDNs and writes them to a specified CSV file.
 
     Args:
         fqdn_values (list): A list of FQDN values to be written to the CSV file.
+        writer (optional): A FqdnCountWriter or a CheckpointCursor, if given the FQDNs are passed to it instead of appended to the file.
+        last_sort_value (list, optional): The sort value of the last hit of the page, None for the last page.
 
     Returns:
         None
@@ -157,9 +848,13 @@ def write_queries(fqdn_values):
     Note:
         - If 'fqdn_values' is an empty list, no data is written to the CSV file.
         - The CSV file is opened in 'append' mode to add data to the existing file.
+        - The write is done under 'write_lock', so it is safe to call from several threads.
     """
+    if writer is not None:
+        writer.write(fqdn_values, last_sort_value)
+        return None
     if fqdn_values:
-        with open(original_csv_file, 'a', newline='', encoding='utf-8') as file:
+        with write_lock, open_file(original_csv_file, 'a', newline='') as file:
             writer = csv.writer(file)
             for value in fqdn_values:
                 writer.writerow([value])
@@ -167,7 +862,64 @@ def write_queries(fqdn_values):
     logging.info('write_queries(): The list of FQDN values is empty, skipping writing in down')
 
 
-def search_after(pit):
+def build_search_body(pit, keep_alive, last_sort_value=None, slice_spec=None, time_range=None, size=None):
+    """
+    Build the body of a search request over the PIT, sorted by @timestamp.
+
+    Args:
+        pit (str): The PIT id returned by get_pit.
+        keep_alive (str): For how long Elasticsearch keeps the PIT open after this request.
+        last_sort_value (list, optional): The sort value of the last hit of the previous page.
+        slice_spec (dict, optional): {'id': i, 'max': n} to read only the slice i of n of the PIT.
+        time_range (dict, optional): The bounds of the @timestamp range ('gte', 'lt'/'lte'),
+            RANGE_GTE..RANGE_LTE by default.
+        size (int, optional): The number of hits of the page, PAGE_SIZE by default.
+
+    Returns:
+        dict: The body of the request, to be sent as JSON.
+    """
+    if time_range is None:
+        time_range = {"gte": RANGE_GTE, "lte": RANGE_LTE}
+    data = {
+        "size": size or PAGE_SIZE,
+        "query": {
+            "bool": {
+            "must": [],
+            "filter": [
+                {
+                "range": {
+                    "@timestamp": {
+                    "format": "strict_date_optional_time",
+                        **time_range
+                    }
+                }
+                }
+            ],
+            "should": [],
+            "must_not": []
+            }
+        },
+        "pit": {
+            "id": pit,
+            "keep_alive": keep_alive
+        },
+        "sort": [
+            {"@timestamp": {"order": "asc", "format": "strict_date_optional_time_nanos", "numeric_type" : "date_nanos" }}
+        ]
+        }
+    if last_sort_value is not None:
+        first_value = str(last_sort_value[0])
+        second_value = str(last_sort_value[1])
+        data["search_after"] = [
+            first_value,
+            second_value
+            ]
+    if slice_spec is not None:
+        data["slice"] = slice_spec
+    return data
+
+
+def search_after(pit, params, slice_spec=None, writer=None, time_range=None, size=None):
     """
     Perform a search request with authentication and process the response.
 
@@ -175,11 +927,12 @@ def search_after(pit):
     It handles the response, calls the function to extract FQDNs from the data,then calls the function to write them to a CSV file.
 
     Args:
-        url_full_search (str): The URL to send the search request to.
-        user (str): The username for authentication.
-        password (str): The password for authentication.
-        data (dict): The data to send in the request body as JSON.
-        headers (dict): Headers to include in the request.
+        pit (str): The PIT id returned by get_pit.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        slice_spec (dict, optional): {'id': i, 'max': n} to read only the slice i of n of the PIT.
+        writer (optional): A FqdnCountWriter or a CheckpointCursor, passed to write_queries.
+        time_range (dict, optional): The bounds of the @timestamp range, see build_search_body.
+        size (int, optional): The number of hits of the page, PAGE_SIZE by default.
 
     Returns:
         tuple: A tuple containing the response data as a JSON object and loop number.
@@ -189,44 +942,15 @@ def search_after(pit):
         - It extracts FQDNs from the response data using the 'extract_fqdn' function.
         - FQDNs are written to a CSV file using the 'write_queries' function.
     """
-    url_full_search= f'{url}/_search?pretty'
-    headers = {"Content-Type": "application/json"}
-    data = {
-    "size": 10000,
-    "query": {
-        "bool": {
-        "must": [],
-        "filter": [
-            {
-            "range": {
-                "@timestamp": {
-                "format": "strict_date_optional_time",
-                "gte": "2023-09-27T00:00:00",
-                "lte": "2023-09-27T00:00:10"
-                }
-            }
-            }
-        ],
-        "should": [],
-        "must_not": []
-        }
-    },
-    "pit": {
-        "id":pit,
-        "keep_alive": "1m"
-    },
-    "sort": [
-        {"@timestamp": {"order": "asc", "format": "strict_date_optional_time_nanos", "numeric_type" : "date_nanos" }}
-    ]
-    }
-    auth = (user, password)
+    data = build_search_body(pit, "1m", slice_spec=slice_spec, time_range=time_range, size=size)
     timeout_seconds = 100
-    response = requests.post(url = url_full_search, headers=headers, auth=auth, data=json.dumps(data), timeout=timeout_seconds)
+    response_data, loop_number = None, 0
+    response = get_transport(params).request('POST', '/_search', data, timeout=timeout_seconds)
     if response.status_code == 200:
         logging.info('search_after(): Response status code == 200')
         response_data = response.json()
         fqdn_values = extract_fqdn(response_data)
-        write_queries(fqdn_values)
+        write_queries(fqdn_values, writer, find_last_key_value(response_data))
         loop_number = 0
         logging.info('search_after(): Completed the first data extraction request, moving to the search_after loop')
     else:
@@ -234,7 +958,108 @@ def search_after(pit):
     return response_data, loop_number
 
 
-def looping_search_after(last_sort_value, pit, loop_number, hostname):
+def stream_search_after(pit, params, last_sort_value=None, slice_spec=None, hostname='', writer=None, time_range=None, size=None):
+    """
+    Read one page of hits with the streaming extraction and write its FQDNs to the CSV file.
+
+    Only the fqdn field and the sort values are requested ('_source' and 'filter_path'),
+    the response is read in STREAM_CHUNK_SIZE chunks and parsed by iter_hits in a single pass.
+
+    Args:
+        pit (str): The PIT id returned by get_pit.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        last_sort_value (list, optional): The sort value of the last hit of the previous page.
+        slice_spec (dict, optional): {'id': i, 'max': n} to read only the slice i of n of the PIT.
+        hostname (str): The name of the endpoint, used in the logs.
+        writer (optional): A FqdnCountWriter or a CheckpointCursor, passed to write_queries.
+        time_range (dict, optional): The bounds of the @timestamp range, see build_search_body.
+        size (int, optional): The number of hits of the page, PAGE_SIZE by default.
+
+    Returns:
+        tuple: The number of hits of the page and the sort value of its last hit (None if the page was empty).
+
+    Raises:
+        RuntimeError: If the request failed, so the cursor is not taken as complete.
+    """
+    data = build_search_body(pit, "10m", last_sort_value, slice_spec, time_range, size)
+    data["_source"] = [FQDN_FIELD]
+    docs, last_sort_value = 0, None
+    fqdn_values = []
+    with get_transport(params).open('POST', '/_search?filter_path=hits.hits._source,hits.hits.sort', data) as response:
+        if response.status_code != 200:
+            logging.error(f'stream_search_after(): {hostname}: Request failed with status code {response.status_code}')
+            raise RuntimeError(f'{hostname}: search request failed with status code {response.status_code}')
+        for fqdn, sort in iter_hits(response.iter_content(chunk_size=STREAM_CHUNK_SIZE)):
+            if fqdn is not None:
+                fqdn_values.append(fqdn)
+            last_sort_value = sort
+            docs += 1
+    write_queries(fqdn_values, writer, last_sort_value)
+    logging.info(f'stream_search_after(): {hostname}: Streamed a page of {docs} hits')
+    return docs, last_sort_value
+
+
+def fetch_raw_page(pit, params, last_sort_value=None, slice_spec=None, hostname='', time_range=None, size=None):
+    """
+    Read one page of hits like stream_search_after, but return the raw body instead of parsing it.
+
+    Returns:
+        bytes: The (decompressed) body of the response, only the fqdn field and the sort values of the hits.
+
+    Raises:
+        RuntimeError: If the request failed.
+    """
+    data = build_search_body(pit, "10m", last_sort_value, slice_spec, time_range, size)
+    data["_source"] = [FQDN_FIELD]
+    response = get_transport(params).request('POST', '/_search?filter_path=hits.hits._source,hits.hits.sort', data)
+    if response.status_code != 200:
+        logging.error(f'fetch_raw_page(): {hostname}: Request failed with status code {response.status_code}')
+        raise RuntimeError(f'{hostname}: search request failed with status code {response.status_code}')
+    return response.content
+
+
+def last_sort_from_raw(raw_page, previous_sort_value=None):
+    """
+    Return the sort value of the last hit of a raw page without parsing the whole page, or None if it has no hits.
+
+    'sort' is normally the last key of every hit, so the value after the last "sort" key of the body is decoded
+    with raw_decode, and it is used only if it is a list (as long as previous_sort_value, if given) closing
+    the last hit and the hits array. Otherwise the whole page is parsed with iter_hits.
+
+    Args:
+        raw_page (bytes): The body returned by fetch_raw_page.
+        previous_sort_value (list, optional): The sort value of the previous page of the cursor.
+
+    Returns:
+        list or None: The sort value of the last hit.
+
+    Raises:
+        RuntimeError: If the page has hits but the last one has no sort value.
+    """
+    position = raw_page.rfind(b'"sort"')
+    if position >= 0:
+        tail = raw_page[position + len(b'"sort"'):].decode('utf-8').lstrip()
+        if tail.startswith(':'):
+            try:
+                last_sort_value, end = json.JSONDecoder().raw_decode(tail, len(tail) - len(tail[1:].lstrip()))
+            except json.JSONDecodeError:
+                last_sort_value, end = None, 0
+            rest = tail[end:].lstrip()
+            if (isinstance(last_sort_value, list) and last_sort_value
+                    and (previous_sort_value is None or len(last_sort_value) == len(previous_sort_value))
+                    and rest.startswith('}') and rest[1:].lstrip().startswith(']')):
+                return last_sort_value
+    last_sort_value, hits = None, 0
+    for _, last_sort_value in iter_hits([raw_page]):
+        hits += 1
+    if hits and last_sort_value is None:
+        raise RuntimeError('the last hit of the page has no sort value')
+    if hits:
+        logging.warning('last_sort_from_raw(): The sort value is not at the end of the page, parsed the whole page')
+    return last_sort_value
+
+
+def looping_search_after(last_sort_value, pit, loop_number, hostname, params, slice_spec=None, writer=None, time_range=None, size=None):
     """
     Perform a looping search request with authentication and process the response.
 
@@ -243,12 +1068,15 @@ def looping_search_after(last_sort_value, pit, loop_number, hostname):
     and calls the function to write them to a CSV file. Additionally, it retrieves the last sort value from the response.
 
     Args:
-        full_url (str): The full URL to send the search request to.
-        user (str): The username for authentication.
-        params (dict): Parameters including 'password' for authentication.
-        data (dict): The data to send in the request body as JSON.
-        headers (dict): Headers to include in the request.
+        last_sort_value (list): The sort value of the last hit of the previous page.
+        pit (str): The PIT id returned by get_pit.
         loop_number (int): The current loop number.
+        hostname (str): The name of the endpoint, used in the logs.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        slice_spec (dict, optional): {'id': i, 'max': n} to read only the slice i of n of the PIT.
+        writer (optional): A FqdnCountWriter or a CheckpointCursor, passed to write_queries.
+        time_range (dict, optional): The bounds of the @timestamp range, see build_search_body.
+        size (int, optional): The number of hits of the page, PAGE_SIZE by default.
 
     Returns:
         tuple: A tuple containing the response data as a JSON object, the last sort value, and the updated loop number.
@@ -259,94 +1087,621 @@ def looping_search_after(last_sort_value, pit, loop_number, hostname):
         - The last sort value is retrieved using the 'find_last_key_value' function.
         - FQDNs are written to a CSV file using the 'write_queries' function.
     """
-    full_url= f'{url}/_search?pretty'
-    first_value = str(last_sort_value[0])
-    second_value = str(last_sort_value[1])
-
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "size": 10000,
-        "query": {
-            "bool": {
-            "must": [],
-            "filter": [
-                {
-                "range": {
-                    "@timestamp": {
-                    "format": "strict_date_optional_time",
-                        "gte": "2023-09-27T00:00:00",
-                        "lte": "2023-09-27T00:00:10"
-                    }
-                }
-                }
-            ],
-            "should": [],
-            "must_not": []
-            }
-        },
-        "pit": {
-            "id": pit,
-            "keep_alive": "10m"
-        },
-        "sort": [
-            {"@timestamp": {"order": "asc", "format": "strict_date_optional_time_nanos", "numeric_type" : "date_nanos" }}
-        ],
-        "search_after": [
-            first_value,
-            second_value
-            ]
-        }
+    data = build_search_body(pit, "10m", last_sort_value, slice_spec, time_range, size)
     fqdn_values = []
-    password = params["password"]
-    auth = (user, password)
     timeout_seconds = 100
-    response = requests.post(url = full_url, headers=headers, auth=auth, data=json.dumps(data), timeout=timeout_seconds)
+    response_data = None
+    response = get_transport(params).request('POST', '/_search', data, timeout=timeout_seconds)
     if response.status_code == 200:
         response_data = response.json()
         fqdn_values = extract_fqdn(response_data)
         last_sort_value = find_last_key_value(response_data)
-        write_queries(fqdn_values)
+        write_queries(fqdn_values, writer, last_sort_value)
         loop_number += 1
-        logging.info(f'looping_search_after(): Completed the loop number {loop_number}')
+        logging.info(f'looping_search_after(): {hostname}: Completed the loop number {loop_number}')
+    else:
+        logging.error(f'looping_search_after(): {hostname}: Request failed with status code {response.status_code}')
+        last_sort_value = None
     return response_data, last_sort_value, loop_number
 
 
-if __name__ == "__main__":
-    month_file_name='september_2023.csv'
-    endpoints = {
-    "hostname1": {
-        "url": url_hostname1,
-        "password": password_hostname1
-    },
-    "hostname2": {
-        "url": url_hostname1,
-        "password": password_hostname1
-    },
-    # "hostname3": {
-    #     "url": url_hostname3,
-    #     "password": password_hostname3
-    # },
-    # "hostname4": {
-    #     "url": url_hostname4,
-    #     "password": password_hostname4
-    # }
+def aggregate_fqdns(hostname, params, time_range=None):
+    """
+    Count the FQDNs of one endpoint on the server side with a composite terms aggregation.
+
+    The aggregation is paged with 'after_key' until Elasticsearch returns no more buckets,
+    so only one (fqdn, count) pair per distinct FQDN is transferred instead of every hit.
+
+    Args:
+        hostname (str): The name of the endpoint, used in the logs.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        time_range (dict, optional): The bounds of the @timestamp range, RANGE_GTE..RANGE_LTE by default.
+
+    Returns:
+        collections.Counter: The number of queries per FQDN.
+    """
+    if time_range is None:
+        time_range = {"gte": RANGE_GTE, "lte": RANGE_LTE}
+    transport = get_transport(params)
+    fqdn_counts = collections.Counter()
+    after_key = None
+    page_number = 0
+    while True:
+        composite = {
+            "size": AGGREGATION_PAGE_SIZE,
+            "sources": [{"fqdn": {"terms": {"field": FQDN_FIELD}}}]
+        }
+        if after_key is not None:
+            composite["after"] = after_key
+        data = {
+            "size": 0,
+            "track_total_hits": False,
+            "query": {
+                "bool": {
+                    "filter": [
+                        {
+                        "range": {
+                            "@timestamp": {
+                            "format": "strict_date_optional_time",
+                            **time_range
+                            }
+                        }
+                        }
+                    ]
                 }
-    total_endpoints = len(endpoints)
-    for index, (hostname, params) in enumerate(endpoints.items()):
-        logging.info('Started to collect the data for %s', hostname)
-        url = params['url']
-        password = params["password"]
-        pit = get_pit()
-        response_data, loop_number = search_after(pit)
-        last_sort_value = find_last_key_value(response_data)
-        if last_sort_value is None:
+            },
+            "aggs": {"fqdns": {"composite": composite}}
+        }
+        response = transport.request('POST', '/secured_eaas_stg-jpe2b_dns_queries-*/_search', data)
+        if response.status_code != 200:
+            logging.error(f'aggregate_fqdns(): {hostname}: Request failed with status code {response.status_code}')
+            raise RuntimeError(f'{hostname}: aggregation request failed with status code {response.status_code}')
+        aggregation = response.json()["aggregations"]["fqdns"]
+        buckets = aggregation.get("buckets", [])
+        for bucket in buckets:
+            fqdn_counts[bucket["key"]["fqdn"]] += bucket["doc_count"]
+        page_number += 1
+        logging.info(f'aggregate_fqdns(): {hostname}: Completed the aggregation page {page_number} with {len(buckets)} buckets')
+        after_key = aggregation.get("after_key")
+        if not buckets or after_key is None:
             break
+    return fqdn_counts
+
+
+def write_fqdn_counts(fqdn_counts, file_name=original_csv_file):
+    """
+    Write the aggregated 'fqdn,count' rows to a CSV file.
+
+    The rows have the same format as the ones written by count_queries_from_csv in csv_transformation.py:
+    no header, FQDNs shorter than 4 characters are skipped.
+    The rows are written to a temporary file which replaces the output only when it is complete.
+
+    Args:
+        fqdn_counts (collections.Counter): The number of queries per FQDN.
+        file_name (str): The path to the output CSV file, it is overwritten.
+
+    Returns:
+        None
+    """
+    partial_file = temporary_name(file_name)
+    try:
+        with open_file(partial_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            for value, count in fqdn_counts.items():
+                if len(value) > 3:
+                    writer.writerow([value, count])
+    except BaseException:
+        os.remove(partial_file)
+        raise
+    os.replace(partial_file, file_name)
+    logging.info(f'write_fqdn_counts(): Wrote {len(fqdn_counts)} aggregated FQDNs into {file_name}')
+    return None
+
+
+def aggregate_endpoints(endpoints, max_workers=1, time_range=None, file_name=original_csv_file):
+    """
+    Run aggregate_fqdns for all the endpoints, merge their counts and write them once.
+
+    The file is written only when every endpoint was aggregated: a partial count would look like a
+    complete day to csv_transformation.py.
+
+    Args:
+        endpoints (dict): hostname -> endpoint parameters, as returned by load_endpoints.
+        max_workers (int): The maximum number of endpoints aggregated at the same time.
+        time_range (dict, optional): The bounds of the @timestamp range, RANGE_GTE..RANGE_LTE by default.
+        file_name (str): The path to the output CSV file.
+
+    Returns:
+        collections.Counter: The merged number of queries per FQDN.
+
+    Raises:
+        RuntimeError: If the aggregation of an endpoint failed, nothing is written then.
+    """
+    total_counts = collections.Counter()
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='es-aggregate') as executor:
+        futures = {executor.submit(aggregate_fqdns, hostname, params, time_range): hostname
+                   for hostname, params in endpoints.items()}
+        for future in as_completed(futures):
+            hostname = futures[future]
+            try:
+                fqdn_counts = future.result()
+            except Exception as e:
+                logging.error('aggregate_endpoints(): Aggregation for %s failed: %s', hostname, e)
+                failed[hostname] = e
+                continue
+            logging.info('aggregate_endpoints(): %s: %s distinct FQDNs, %s queries',
+                         hostname, len(fqdn_counts), sum(fqdn_counts.values()))
+            total_counts.update(fqdn_counts)
+    if failed:
+        raise RuntimeError(f'The aggregation failed for {", ".join(sorted(failed))}, {file_name} was not written')
+    write_fqdn_counts(total_counts, file_name)
+    return total_counts
+
+
+def count_docs(params, time_range):
+    """
+    Count the documents of an endpoint in a @timestamp range with the _count API.
+
+    Args:
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        time_range (dict): The bounds of the @timestamp range, see build_search_body.
+
+    Returns:
+        int: The number of documents in the range.
+    """
+    data = {"query": {"range": {"@timestamp": {"format": "strict_date_optional_time", **time_range}}}}
+    response = get_transport(params).request('POST', '/secured_eaas_stg-jpe2b_dns_queries-*/_count', data)
+    if response.status_code != 200:
+        logging.error(f'count_docs(): Request failed with status code {response.status_code}')
+        raise RuntimeError(f'_count request failed with status code {response.status_code}')
+    return response.json()["count"]
+
+
+def plan_windows(hostname, params, start, end, window_docs):
+    """
+    Split the [start, end) range into time windows holding at most about window_docs documents each.
+
+    The range is first cut into hourly windows, then every window with more than window_docs documents
+    (counted with count_docs) is bisected until it is small enough or shorter than 2 * MIN_WINDOW,
+    so the dense hours get smaller windows. Empty windows are dropped.
+
+    Args:
+        hostname (str): The name of the endpoint, used in the logs.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        start (datetime.datetime): The beginning of the range, included.
+        end (datetime.datetime): The end of the range, excluded.
+        window_docs (int): The target number of documents per window.
+
+    Returns:
+        list: (time_range, docs) pairs sorted by the beginning of the window,
+            time_range is a {'gte', 'lt'} dict that can be passed to build_search_body.
+    """
+    def to_range(window_start, window_end):
+        return {"gte": window_start.isoformat(timespec='milliseconds'), "lt": window_end.isoformat(timespec='milliseconds')}
+
+    pending = []
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + timedelta(hours=1), end)
+        pending.append((window_start, window_end))
+        window_start = window_end
+    windows = []
+    while pending:
+        window_start, window_end = pending.pop()
+        docs = count_docs(params, to_range(window_start, window_end))
+        if docs > window_docs and window_end - window_start >= 2 * MIN_WINDOW:
+            middle = window_start + (window_end - window_start) / 2
+            pending.append((window_start, middle))
+            pending.append((middle, window_end))
+        elif docs:
+            windows.append((window_start, window_end, docs))
+    windows.sort()
+    logging.info(f'plan_windows(): {hostname}: Planned {len(windows)} windows for {sum(docs for _, _, docs in windows)} docs')
+    return [(to_range(window_start, window_end), docs) for window_start, window_end, docs in windows]
+
+
+def count_hits(response_data):
+    """Return the number of hits in a search response (0 for an empty or failed response)."""
+    if not response_data:
+        return 0
+    return len(response_data.get('hits', {}).get('hits', []))
+
+
+def walk_pit(hostname, params, pit, slice_spec=None, stream=False, writer=None, checkpoint=None, time_range=None,
+             page_sizing=None, pipeline=None):
+    """
+    Walk all the pages of a PIT (or of one slice of it) with search_after.
+
+    Args:
+        hostname (str): The name of the endpoint, used in the logs.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        pit (str): The PIT id returned by get_pit.
+        slice_spec (dict, optional): {'id': i, 'max': n} to walk only the slice i of n.
+        stream (bool): Use the streaming extraction (stream_search_after) for every page.
+        writer (optional): A FqdnCountWriter, passed to write_queries.
+        checkpoint (Checkpoint, optional): Commit every page to the checkpoint and continue from it
+            if this cursor was already started, the writer is ignored.
+        time_range (dict, optional): The bounds of the @timestamp range, see build_search_body.
+        page_sizing (dict, optional): The PageSizer arguments, to adapt the page size of this cursor;
+            otherwise every page has PAGE_SIZE hits.
+        pipeline (PagePipeline, optional): Only fetch the raw pages and let the pipeline parse and write them,
+            the call returns when all the pages of the cursor are written.
+
+    Returns:
+        tuple: The number of docs and the number of pages read.
+
+    Raises:
+        RuntimeError: If a page could not be read, so the cursor is not taken as complete.
+    """
+    cursor = hostname if slice_spec is None else f"{hostname}/slice-{slice_spec['id']}"
+    if time_range is not None:
+        cursor = f"{cursor}/{time_range['gte']}"
+    start_sort_value, loop_number = None, 0
+    if checkpoint is not None:
+        state = checkpoint.state(cursor)
+        if state is not None:
+            if state['done']:
+                logging.info(f'walk_pit(): {cursor}: Already completed in the checkpoint, skipping')
+                return 0, 0
+            start_sort_value, loop_number = state['sort'], state['page']
+            logging.info(f'walk_pit(): {cursor}: Resuming after page {loop_number} from {start_sort_value}')
+        writer = checkpoint.cursor(cursor)
+    page_sizer = PageSizer(cursor, **page_sizing) if page_sizing is not None else None
+    transport = get_transport(params)
+    size = page_sizer.size if page_sizer else None
+    docs, pages = 0, 0
+    last_sort_value = start_sort_value
+    try:
         while True:
+            if pipeline is not None:
+                raw_page = fetch_raw_page(pit, params, last_sort_value, slice_spec, hostname, time_range, size)
+                last_sort_value = last_sort_from_raw(raw_page, last_sort_value)
+                # the workers count the hits, only a non-empty page is known here: it is taken as full for the page sizer
+                page_docs = 0 if last_sort_value is None else size or PAGE_SIZE
+                pipeline.submit(cursor, raw_page, writer, last_sort_value)
+            elif stream:
+                page_docs, last_sort_value = stream_search_after(pit, params, last_sort_value, slice_spec, hostname, writer, time_range, size)
+            elif pages == 0 and start_sort_value is None:
+                response_data, loop_number = search_after(pit, params, slice_spec, writer, time_range, size)
+                if response_data is None:
+                    raise RuntimeError(f'{cursor}: the first page could not be read')
+                page_docs = count_hits(response_data)
+                last_sort_value = find_last_key_value(response_data) if response_data else None
+            else:
+                response_data, last_sort_value, loop_number = looping_search_after(last_sort_value, pit, loop_number, hostname, params,
+                                                                                   slice_spec, writer, time_range, size)
+                if response_data is None:
+                    raise RuntimeError(f'{cursor}: the page after {loop_number} could not be read')
+                page_docs = count_hits(response_data)
+            docs += page_docs
+            pages += 1
+            if page_sizer is not None:
+                size = page_sizer.observe(page_docs, *transport.last_request())
             if last_sort_value is None:
                 break
-            response_data, last_sort_value, loop_number = looping_search_after(last_sort_value, pit, loop_number, hostname)
-        if index >= total_endpoints - 1:
-            break  # Exit the for loop
-         # Continue to the next iteration of the for loop
-        continue
+    finally:
+        if pipeline is not None:
+            docs = pipeline.wait(cursor)
+    if page_sizer is not None:
+        page_sizer.report()
+    return docs, pages
+
+
+def collect_endpoint(hostname, params, slices=1, stream=False, writer=None, checkpoint=None,
+                     window_docs=None, window_workers=4, day_start=None, day_end=None, page_sizing=None, pipeline=None):
+    """
+    Collect all the FQDNs of one endpoint: get the PIT and walk all the pages with search_after.
+
+    All the cursor state (pit, last_sort_value, loop_number) is local to the call,
+    so several endpoints can be collected at the same time from different threads.
+
+    Args:
+        hostname (str): The name of the endpoint, used in the logs and in the summary.
+        params (dict): The endpoint parameters: 'url', 'user' and 'password'.
+        slices (int): The number of PIT slices walked in parallel, 1 means no slicing.
+        stream (bool): Use the streaming extraction for every page.
+        writer (optional): A FqdnCountWriter, passed to write_queries.
+        checkpoint (Checkpoint, optional): Commit every page to the checkpoint and resume the started cursors.
+        window_docs (int, optional): Split the day into windows of about this many docs with plan_windows
+            and walk them in parallel, otherwise the day (or RANGE_GTE..RANGE_LTE without day_start/day_end)
+            is walked as one range.
+        window_workers (int): The maximum number of windows walked at the same time.
+        day_start (datetime.datetime, optional): The beginning of the day, FROM_DATE by default with window_docs.
+        day_end (datetime.datetime, optional): The end of the day (excluded), TO_DATE by default with window_docs.
+        page_sizing (dict, optional): The PageSizer arguments, to adapt the page size of every cursor.
+        pipeline (PagePipeline, optional): Parse and write the pages in the pipeline workers.
+
+    Returns:
+        dict: The summary of the collection: hostname, docs, pages, seconds, docs_per_sec
+            and complete (False if no PIT could be opened).
+
+    Note:
+        - All the slices and windows append to the same 'original_csv_file' through write_queries.
+        - The biggest windows are started first, so the workers finish at about the same time.
+        - With a checkpoint the windows are planned once and saved, a resumed run walks the saved windows.
+          Resuming an endpoint with and without window_docs mixes two sets of cursors, it raises ValueError.
+        - The PIT is closed explicitly when the walk is done, even if it failed.
+    """
+    logging.info('collect_endpoint(): Started to collect the data for %s', hostname)
+    started = time.monotonic()
+    docs, pages = 0, 0
+    slice_specs = [{"id": slice_id, "max": slices} for slice_id in range(slices)] if slices > 1 else [None]
+    planned_windows = checkpoint.planned_windows(hostname) if checkpoint is not None else None
+    if window_docs:
+        day_start = day_start or datetime.datetime.fromisoformat(FROM_DATE)
+        day_end = day_end or datetime.datetime.fromisoformat(TO_DATE)
+        if planned_windows is not None:
+            windows = list(planned_windows)
+            logging.info(f'collect_endpoint(): {hostname}: Resuming the {len(windows)} windows saved in the checkpoint')
+        elif checkpoint is not None and checkpoint.started(hostname):
+            raise ValueError(f'{hostname} was checkpointed without --window-docs, resume it without --window-docs')
+        else:
+            windows = plan_windows(hostname, params, day_start, day_end, window_docs)
+            if checkpoint is not None:
+                checkpoint.save_windows(hostname, windows)
+        windows.sort(key=lambda window: window[1], reverse=True)
+        cursors = [(slice_spec, time_range) for time_range, _ in windows for slice_spec in slice_specs]
+        max_workers = window_workers
+    else:
+        if planned_windows is not None:
+            raise ValueError(f'{hostname} was checkpointed with --window-docs, resume it with --window-docs')
+        time_range = None
+        if day_start is not None and day_end is not None:
+            time_range = {"gte": day_start.isoformat(timespec='milliseconds'), "lt": day_end.isoformat(timespec='milliseconds')}
+        cursors = [(slice_spec, time_range) for slice_spec in slice_specs]
+        max_workers = slices
+    pit = get_pit(params)
+    if pit is not None:
+        try:
+            if len(cursors) > 1:
+                with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{hostname}-cursor') as executor:
+                    results = list(executor.map(
+                        lambda cursor: walk_pit(hostname, params, pit, cursor[0], stream, writer, checkpoint, cursor[1], page_sizing, pipeline),
+                        cursors))
+            elif cursors:
+                results = [walk_pit(hostname, params, pit, cursors[0][0], stream, writer, checkpoint, cursors[0][1], page_sizing, pipeline)]
+            else:
+                results = []
+            for cursor_docs, cursor_pages in results:
+                docs += cursor_docs
+                pages += cursor_pages
+        finally:
+            close_pit(pit, params)
+    else:
+        logging.error('collect_endpoint(): No PIT for %s, skipping the host', hostname)
+    seconds = time.monotonic() - started
+    summary = {
+        'hostname': hostname,
+        'docs': docs,
+        'pages': pages,
+        'seconds': round(seconds, 3),
+        'docs_per_sec': round(docs / seconds, 1) if seconds > 0 else 0.0,
+        'complete': pit is not None,
+    }
+    logging.info('collect_endpoint(): %s: %s docs in %s pages, %.1f s, %.1f docs/sec',
+                 hostname, docs, pages, seconds, summary['docs_per_sec'])
+    return summary
+
+
+def collect_concurrently(endpoints, max_workers=4, **collect_options):
+    """
+    Collect the data from all the endpoints in parallel, one worker thread per endpoint.
+
+    Args:
+        endpoints (dict): hostname -> endpoint parameters, as returned by load_endpoints.
+        max_workers (int): The maximum number of endpoints collected at the same time.
+        **collect_options: Passed to collect_endpoint (slices, stream, writer, checkpoint, window_docs...).
+
+    Returns:
+        list: The per-host summaries returned by collect_endpoint, failed hosts are logged and left out.
+    """
+    summaries = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='es-collect') as executor:
+        futures = {executor.submit(collect_endpoint, hostname, params, **collect_options): hostname
+                   for hostname, params in endpoints.items()}
+        for future in as_completed(futures):
+            hostname = futures[future]
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                logging.error('collect_concurrently(): Collection for %s failed: %s', hostname, e)
+    for summary in sorted(summaries, key=lambda item: item['hostname']):
+        logging.info('collect_concurrently(): summary %s', summary)
+    return summaries
+
+
+def backfill(endpoints, first_day, last_day, max_workers=4, preaggregate=False, memory_budget=None, resume=False,
+             **collect_options):
+    """
+    Collect every day of a date range, one job per day and endpoint on a bounded thread pool.
+
+    Every day is written to its own 'dns_result_original_<day>.csv', through a Checkpoint ('checkpoint_<day>.json')
+    or a FqdnCountWriter with preaggregate. The writer of a day is opened when its first job starts and closed
+    when its last job ends, then the '<output>.done' marker is written if all the endpoints of the day are complete.
+    The days whose marker already exists are skipped.
+
+    Args:
+        endpoints (dict): hostname -> endpoint parameters, as returned by load_endpoints.
+        first_day (datetime.date): The first day to collect.
+        last_day (datetime.date): The last day to collect, included.
+        max_workers (int): The maximum number of jobs run at the same time.
+        preaggregate (bool): Write the 'fqdn,count' file of every day with a FqdnCountWriter.
+        memory_budget (int, optional): Passed to FqdnCountWriter.
+        resume (bool): Continue the days that have a checkpoint of a failed run.
+        **collect_options: Passed to collect_endpoint (slices, stream, window_docs, page_sizing...).
+
+    Returns:
+        list: The days that were completed by this run.
+
+    Raises:
+        RuntimeError: If some days are incomplete, once all the jobs are done. With preaggregate their output
+            is not written, otherwise their checkpoint is kept for --resume.
+    """
+    days = []
+    day = first_day
+    while day <= last_day:
+        output_file = f'dns_result_original_{day.isoformat()}.csv{OUTPUT_SUFFIX}'
+        if os.path.exists(f'{output_file}.done') and os.path.exists(output_file):
+            logging.info(f'backfill(): {day} is already complete, skipping')
+        else:
+            days.append(day)
+        day += timedelta(days=1)
+    day_states = {day: {'writer': None, 'remaining': len(endpoints), 'summaries': [], 'failed': False} for day in days}
+    day_lock = threading.Lock()
+
+    def open_day(day):
+        with day_lock:
+            state = day_states[day]
+            if state['writer'] is None:
+                output_file = f'dns_result_original_{day.isoformat()}.csv{OUTPUT_SUFFIX}'
+                if preaggregate:
+                    state['writer'] = FqdnCountWriter(output_file, memory_budget)
+                else:
+                    state['writer'] = Checkpoint(f'checkpoint_{day.isoformat()}.json', output_file, resume=resume,
+                                                 slices=collect_options.get('slices', 1))
+            return state['writer']
+
+    def run_job(day, hostname, params):
+        writer = open_day(day)
+        day_start = datetime.datetime.combine(day, datetime.time())
+        options = dict(collect_options, day_start=day_start, day_end=day_start + timedelta(days=1))
+        if preaggregate:
+            return collect_endpoint(hostname, params, writer=writer, **options)
+        return collect_endpoint(hostname, params, checkpoint=writer, **options)
+
+    completed = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='es-backfill') as executor:
+        futures = {executor.submit(run_job, day, hostname, params): (day, hostname)
+                   for day in days for hostname, params in endpoints.items()}
+        for future in as_completed(futures):
+            day, hostname = futures[future]
+            state = day_states[day]
+            try:
+                summary = future.result()
+                state['summaries'].append(summary)
+                state['failed'] = state['failed'] or not summary['complete']
+            except Exception as e:
+                logging.error('backfill(): %s %s failed: %s', day, hostname, e)
+                state['failed'] = True
+            state['remaining'] -= 1
+            if state['remaining']:
+                continue
+            if preaggregate and state['failed'] and state['writer'] is not None:
+                state['writer'].abort()
+            elif state['writer'] is not None:
+                state['writer'].close()
+            if state['failed']:
+                logging.error('backfill(): %s is incomplete, rerun it (with --resume) to complete it', day)
+                continue
+            output_file = f'dns_result_original_{day.isoformat()}.csv{OUTPUT_SUFFIX}'
+            with open(f'{output_file}.done', 'w', encoding='utf-8') as marker:
+                json.dump(state['summaries'], marker)
+            completed.append(day)
+            logging.info('backfill(): %s is complete: %s docs', day, sum(summary['docs'] for summary in state['summaries']))
+    failed_days = sorted(day.isoformat() for day, state in day_states.items() if state['failed'])
+    if failed_days:
+        raise RuntimeError(f'The backfill of {", ".join(failed_days)} is incomplete')
+    return sorted(completed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Collect the DNS queries FQDNs from the Elasticsearch clusters')
+    parser.add_argument('--concurrent', action='store_true', help='collect all the endpoints in parallel')
+    parser.add_argument('--workers', type=int, default=4, help='the maximum number of endpoints collected at the same time')
+    parser.add_argument('--slices', type=int, default=1, help='split the PIT of every endpoint into N slices walked in parallel')
+    parser.add_argument('--aggregate', action='store_true', help='count the FQDNs with a server side aggregation instead of downloading the hits')
+    parser.add_argument('--stream', action='store_true', help='request only the fqdn field and parse every page incrementally')
+    parser.add_argument('--preaggregate', action='store_true', help='count the fetched FQDNs in memory and write the fqdn,count file once')
+    parser.add_argument('--memory-budget', type=int, default=None, help='with --preaggregate, spill the counts to disk above N distinct FQDNs')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='truncate the output and save a checkpoint of every cursor after each page, for --resume')
+    parser.add_argument('--resume', action='store_true', help='continue the walk from the checkpoint of a failed --checkpoint run')
+    parser.add_argument('--window-docs', type=int, default=None, help='split the day into time windows of about N docs walked in parallel')
+    parser.add_argument('--window-workers', type=int, default=4, help='the maximum number of windows walked at the same time per endpoint')
+    parser.add_argument('--no-compression', action='store_true', help='send the request bodies uncompressed')
+    parser.add_argument('--adaptive-page-size', action='store_true', help='adapt the page size to the response time and payload of recent pages')
+    parser.add_argument('--min-page-size', type=int, default=500)
+    parser.add_argument('--max-page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--target-page-seconds', type=float, default=2.0, help='the wanted response time of one page')
+    parser.add_argument('--backfill-from', type=date.fromisoformat, default=None, help='the first day to backfill, YYYY-MM-DD')
+    parser.add_argument('--backfill-to', type=date.fromisoformat, default=None, help='the last day to backfill (included), YYYY-MM-DD')
+    parser.add_argument('--pipeline', action='store_true', help='fetch the pages and parse/write them in separate threads')
+    parser.add_argument('--parse-workers', type=int, default=2, help='the number of parse/write threads of --pipeline')
+    parser.add_argument('--queue-depth', type=int, default=4, help='the maximum number of raw pages queued per parse/write thread')
+    args = parser.parse_args()
+    if (args.checkpoint or args.resume) and (args.aggregate or args.preaggregate):
+        parser.error('--checkpoint and --resume work only with the row output, not with --aggregate or --preaggregate')
+    if (args.backfill_from is None) != (args.backfill_to is None) or (args.backfill_from and args.aggregate):
+        parser.error('--backfill-from and --backfill-to go together, without --aggregate')
+    endpoints = load_endpoints()
+    for params in endpoints.values():
+        params['transport'] = Transport(params, compress=not args.no_compression)
+    collect_options = {
+        'slices': args.slices,
+        'stream': args.stream,
+        'window_docs': args.window_docs,
+        'window_workers': args.window_workers,
+        'page_sizing': None,
+        'pipeline': PagePipeline(args.parse_workers, args.queue_depth) if args.pipeline and not args.aggregate else None,
+    }
+    if args.adaptive_page_size:
+        collect_options['page_sizing'] = {
+            'min_size': args.min_page_size,
+            'max_size': args.max_page_size,
+            'target_seconds': args.target_page_seconds,
+        }
+    # non-zero when an endpoint failed, so that the scheduler does not run csv_transformation.py on a partial day
+    exit_code = 0
+    try:
+        if args.aggregate:
+            try:
+                aggregate_endpoints(endpoints, max_workers=args.workers if args.concurrent else 1)
+            except RuntimeError as e:
+                logging.error(f'Aggregation failed: {e}')
+                exit_code = 1
+        elif args.backfill_from:
+            try:
+                backfill(endpoints, args.backfill_from, args.backfill_to, max_workers=args.workers, preaggregate=args.preaggregate,
+                         memory_budget=args.memory_budget, resume=args.resume, **collect_options)
+            except RuntimeError as e:
+                logging.error(f'Backfill failed: {e}')
+                exit_code = 1
+        else:
+            writer, checkpoint = None, None
+            if args.preaggregate:
+                writer = FqdnCountWriter(original_csv_file, args.memory_budget)
+            elif args.checkpoint or args.resume:
+                checkpoint = Checkpoint(checkpoint_file, original_csv_file, resume=args.resume, slices=args.slices)
+            summaries = []
+            try:
+                if args.concurrent:
+                    summaries = collect_concurrently(endpoints, max_workers=args.workers, writer=writer, checkpoint=checkpoint,
+                                                     **collect_options)
+                else:
+                    for hostname, params in endpoints.items():
+                        summaries.append(collect_endpoint(hostname, params, writer=writer, checkpoint=checkpoint, **collect_options))
+            except BaseException:
+                if writer is not None:
+                    writer.abort()
+                raise
+            finally:
+                if checkpoint is not None:
+                    checkpoint.close()
+            # collect_concurrently leaves the failed endpoints out of its summaries
+            if len(summaries) < len(endpoints) or not all(summary['complete'] for summary in summaries):
+                exit_code = 1
+            if writer is not None and exit_code:
+                writer.abort()
+            elif writer is not None:
+                writer.close()
+    finally:
+        # the parse/write threads are stopped even if the collection failed
+        if collect_options['pipeline'] is not None:
+            collect_options['pipeline'].close()
+    for hostname, params in endpoints.items():
+        params['transport'].report(hostname)
+    if exit_code:
+        logging.error('The collection is incomplete')
+        sys.exit(exit_code)
     logging.info('Completed the collection from all hosts')
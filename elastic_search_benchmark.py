@@ -0,0 +1,186 @@
+"""Throughput benchmark of the elastic_search.py extraction modes against the local fake_elastic_search.py server.
+
+The fake server is started in this process with one day of synthetic DNS-query documents, then every mode
+is run in its own child process (so the peak RSS of one mode does not leak into the next one), in a temporary
+working directory, over the whole day. For every mode the benchmark reports:
+    docs, seconds, docs/sec, pages (search or aggregation requests), pages/sec,
+    bytes received and sent on the wire (Transport statistics) and the peak RSS of the child process.
+The results are printed as a table and written to a JSON file, to be compared between two versions.
+Usage: python elastic_search_benchmark.py --docs 1000000 --modes stream,pipeline,aggregate --output bench.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import fake_elastic_search
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# the longest time a mode may take before the benchmark reports it as failed
+MODE_TIMEOUT = 3600
+# collect_endpoint options of every mode, 'aggregate' runs aggregate_endpoints instead
+MODES = {
+    'sequential': {},
+    'stream': {'stream': True},
+    'sliced': {'stream': True, 'slices': 4},
+    'windows': {'stream': True, 'window_docs': 50000, 'window_workers': 4},
+    'adaptive': {'stream': True, 'page_sizing': {'target_seconds': 0.5}},
+    'pipeline': {'pipeline': True, 'window_docs': 50000, 'window_workers': 4},
+    'preaggregate': {'stream': True, 'preaggregate': True},
+    'aggregate': {'aggregate': True},
+}
+
+
+def run_mode(mode, url, day, endpoints_count, result_queue):
+    """Run one mode in the child process and put its measurements in result_queue."""
+    workdir = tempfile.mkdtemp(prefix=f'es_bench_{mode}_')
+    try:
+        os.chdir(workdir)
+        result_queue.put(measure_mode(mode, url, day, endpoints_count, workdir))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure_mode(mode, url, day, endpoints_count, workdir):
+    """Run one mode in 'workdir' and return its measurements."""
+    sys.path.insert(0, REPO_DIR)
+    import elastic_search
+
+    options = dict(MODES[mode])
+    endpoints = {f'hostname{index + 1}': {'url': url, 'user': 'benchmark', 'password': 'benchmark'}
+                 for index in range(endpoints_count)}
+    for params in endpoints.values():
+        params['transport'] = elastic_search.Transport(params)
+    day_start = datetime.combine(day, datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    output_file = os.path.join(workdir, f'dns_result_original_{day.isoformat()}.csv{elastic_search.OUTPUT_SUFFIX}')
+    started = time.monotonic()
+    if options.pop('aggregate', False):
+        time_range = {'gte': day_start.isoformat(), 'lt': day_end.isoformat()}
+        counts = elastic_search.aggregate_endpoints(endpoints, max_workers=endpoints_count, time_range=time_range,
+                                                    file_name=output_file)
+        docs = sum(counts.values())
+        pages = None
+    else:
+        writer, checkpoint, pipeline = None, None, None
+        if options.pop('preaggregate', False):
+            writer = elastic_search.FqdnCountWriter(output_file)
+        else:
+            checkpoint = elastic_search.Checkpoint(os.path.join(workdir, 'checkpoint.json'), output_file,
+                                                   slices=options.get('slices', 1))
+        if options.pop('pipeline', False):
+            pipeline = elastic_search.PagePipeline()
+        summaries = elastic_search.collect_concurrently(endpoints, max_workers=endpoints_count, writer=writer,
+                                                        checkpoint=checkpoint, pipeline=pipeline,
+                                                        day_start=day_start, day_end=day_end, **options)
+        if pipeline is not None:
+            pipeline.close()
+        (writer or checkpoint).close()
+        docs = sum(summary['docs'] for summary in summaries)
+        pages = sum(summary['pages'] for summary in summaries)
+    seconds = time.monotonic() - started
+    stats = [params['transport'].report(hostname) for hostname, params in endpoints.items()]
+    if pages is None:
+        pages = sum(stat.get('requests', 0) for stat in stats)
+    return {
+        'mode': mode,
+        'docs': docs,
+        'seconds': round(seconds, 3),
+        'docs_per_sec': round(docs / seconds, 1) if seconds else 0.0,
+        'pages': pages,
+        'pages_per_sec': round(pages / seconds, 2) if seconds else 0.0,
+        'bytes_received': sum(stat.get('bytes_received', 0) for stat in stats),
+        'bytes_sent': sum(stat.get('bytes_sent', 0) for stat in stats),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'output_bytes': os.path.getsize(output_file) if os.path.exists(output_file) else 0,
+    }
+
+
+def run_benchmark(modes, docs, endpoints_count=1, latency=0.0, distinct_fqdns=5000, mode_timeout=MODE_TIMEOUT):
+    """
+    Start the fake server and run every mode against it, one child process per mode.
+
+    A mode whose child process fails, is killed or runs longer than 'mode_timeout' seconds is reported
+    with an 'error' and no measurements, and the benchmark goes on with the next mode.
+
+    Returns:
+        list: The measurements of every mode, see measure_mode.
+    """
+    day = date.today() - timedelta(days=1)
+    server = fake_elastic_search.start_server(docs, day.isoformat(), latency=latency, distinct_fqdns=distinct_fqdns)
+    url = f'http://127.0.0.1:{server.server_port}'
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for mode in modes:
+            result_queue = context.Queue()
+            process = context.Process(target=run_mode, args=(mode, url, day, endpoints_count, result_queue))
+            process.start()
+            deadline = time.monotonic() + mode_timeout
+            result = None
+            while result is None and time.monotonic() < deadline:
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    if not process.is_alive():
+                        break
+            if result is None:
+                # a last look: the child may have put its result just before exiting
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    pass
+            if process.is_alive() and result is None:
+                process.terminate()
+            process.join()
+            if result is None:
+                result = {'mode': mode, 'error': f'failed with exit code {process.exitcode}' if process.exitcode else f'timed out after {mode_timeout}s'}
+                logging.error('run_benchmark(): %s %s', mode, result['error'])
+            else:
+                logging.info('run_benchmark(): %s', result)
+            results.append(result)
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_table(results):
+    columns = ['mode', 'docs', 'seconds', 'docs_per_sec', 'pages', 'pages_per_sec', 'bytes_received', 'bytes_sent', 'peak_rss_mb']
+    widths = [max(len(column), *(len(str(result.get(column, ''))) for result in results)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        if 'error' in result:
+            print(result['mode'].rjust(widths[0]) + '  ' + result['error'])
+            continue
+        print('  '.join(str(result[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the elastic_search.py modes against a local fake Elasticsearch')
+    parser.add_argument('--docs', type=int, default=200000, help='the number of synthetic documents of the day')
+    parser.add_argument('--fqdns', type=int, default=5000, help='the number of distinct FQDNs')
+    parser.add_argument('--endpoints', type=int, default=1, help='the number of endpoints collected in parallel')
+    parser.add_argument('--latency', type=float, default=0.0, help='the delay added by the server to every request, in seconds')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'comma separated modes, from {",".join(MODES)}')
+    parser.add_argument('--mode-timeout', type=int, default=MODE_TIMEOUT, help='the longest time of one mode, in seconds')
+    parser.add_argument('--output', default='elastic_search_benchmark.json', help='the JSON file with the results')
+    args = parser.parse_args()
+    modes = args.modes.split(',')
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f'unknown modes: {unknown}')
+    results = run_benchmark(modes, args.docs, args.endpoints, args.latency, args.fqdns, args.mode_timeout)
+    print_table(results)
+    with open(args.output, 'w', encoding='utf-8') as json_file:
+        json.dump({'docs': args.docs, 'endpoints': args.endpoints, 'latency': args.latency, 'results': results}, json_file, indent=2)
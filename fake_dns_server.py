@@ -0,0 +1,122 @@
+"""A local stub DNS server answering the PTR queries of csv_transformation.py, to test the lookups without a real resolver.
+
+Every reverse name 'D.C.B.A.in-addr.arpa' is answered with 'ip-A-B-C-D.example.internal.', except:
+    --nxdomain-every N: the addresses whose last octet is a multiple of N get NXDOMAIN,
+    --drop-every N: every Nth query is not answered at all, to exercise the client timeouts.
+--latency delays every answer, the answers are sent from a thread pool so slow answers do not block the others.
+Usage: python fake_dns_server.py --port 5353 --latency 0.05 --nxdomain-every 7
+"""
+import argparse
+import collections
+import logging
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+TTL = 3600
+
+
+def read_question(message):
+    """Return the id, the flags, the name, the type and the end offset of the question of a DNS query."""
+    query_id, flags = struct.unpack('!HH', message[:4])
+    offset = 12
+    labels = []
+    while message[offset]:
+        length = message[offset]
+        labels.append(message[offset + 1:offset + 1 + length].decode('ascii'))
+        offset += 1 + length
+    query_type, = struct.unpack('!H', message[offset + 1:offset + 3])
+    return query_id, flags, '.'.join(labels), query_type, offset + 5
+
+
+def ptr_target(name, nxdomain_every=0):
+    """Return the hostname of a reverse name, None for NXDOMAIN."""
+    parts = name.lower().split('.')
+    if len(parts) != 6 or parts[4:] != ['in-addr', 'arpa'] or not all(part.isdigit() for part in parts[:4]):
+        return None
+    if nxdomain_every and int(parts[0]) % nxdomain_every == 0:
+        return None
+    return 'ip-' + '-'.join(reversed(parts[:4])) + '.example.internal.'
+
+
+def build_answer(message, nxdomain_every=0):
+    """Build the response to a query: one PTR record pointing back to the question name, or NXDOMAIN."""
+    query_id, flags, name, query_type, question_end = read_question(message)
+    target = ptr_target(name, nxdomain_every) if query_type == 12 else None
+    rcode = 0 if target else 3
+    header = struct.pack('!HHHHHH', query_id, 0x8180 | (flags & 0x0100) | rcode, 1, 1 if target else 0, 0, 0)
+    answer = b''
+    if target:
+        rdata = b''.join(bytes([len(label)]) + label.encode('ascii') for label in target.rstrip('.').split('.')) + b'\x00'
+        # 0xC00C points to the question name at offset 12
+        answer = struct.pack('!HHHIH', 0xC00C, 12, 1, TTL, len(rdata)) + rdata
+    return header + message[12:question_end] + answer
+
+
+class FakeDnsServer:
+    """The UDP socket, the answer threads and the query counters of the stub server."""
+    def __init__(self, port=0, latency=0.0, nxdomain_every=0, drop_every=0, workers=32):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', port))
+        self.port = self.sock.getsockname()[1]
+        self.latency = latency
+        self.nxdomain_every = nxdomain_every
+        self.drop_every = drop_every
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stats = collections.Counter()
+
+    def answer(self, message, address):
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            self.sock.sendto(build_answer(message, self.nxdomain_every), address)
+            self.stats['answered'] += 1
+        except (OSError, IndexError, struct.error, UnicodeDecodeError) as e:
+            logging.error('FakeDnsServer.answer(): Could not answer %s: %s', address, e)
+
+    def serve_forever(self):
+        while True:
+            try:
+                message, address = self.sock.recvfrom(4096)
+            except OSError:
+                self.executor.shutdown(wait=False)
+                return
+            self.stats['queries'] += 1
+            if self.drop_every and self.stats['queries'] % self.drop_every == 0:
+                self.stats['dropped'] += 1
+                continue
+            self.executor.submit(self.answer, message, address)
+
+    def close(self):
+        self.sock.close()
+
+
+def start_server(port=0, latency=0.0, nxdomain_every=0, drop_every=0, workers=32):
+    """
+    Start the stub server in a background thread.
+
+    Returns:
+        FakeDnsServer: The running server, listening on 127.0.0.1:<server.port>. Stop it with server.close().
+    """
+    server = FakeDnsServer(port, latency, nxdomain_every, drop_every, workers)
+    threading.Thread(target=server.serve_forever, name='fake-dns', daemon=True).start()
+    logging.info('start_server(): Serving PTR answers on port %s', server.port)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='A local stub DNS server answering PTR queries')
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--latency', type=float, default=0.0, help='the delay of every answer, in seconds')
+    parser.add_argument('--nxdomain-every', type=int, default=0, help='answer NXDOMAIN when the last octet is a multiple of N')
+    parser.add_argument('--drop-every', type=int, default=0, help='do not answer every Nth query')
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency, args.nxdomain_every, args.drop_every)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.close()
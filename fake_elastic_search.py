@@ -0,0 +1,257 @@
+"""A local stand-in for the Elasticsearch DNS-queries cluster, to measure elastic_search.py without production.
+
+Synthetic DNS-query documents ({"@timestamp", "fqdn"}) are generated for one day, denser in the busy hours,
+with FQDNs picked from a skewed (Zipf-like) list that includes reverse 'in-addr.arpa' names.
+The server implements the parts of the API used by the extractor:
+    POST /<index>/_pit, DELETE /_pit
+    POST /_search and /<index>/_search: pit, size, sort on @timestamp, search_after, slice, _source,
+        filter_path=hits.hits._source,hits.hits.sort and the composite terms aggregation
+    POST /<index>/_count
+gzip request bodies (Content-Encoding) and gzip responses (Accept-Encoding) are supported,
+--latency adds a fixed delay to every request and --fail-every N answers every Nth search with a 503.
+Usage: python fake_elastic_search.py --port 9200 --docs 1000000 --day 2023-09-27
+"""
+import argparse
+import bisect
+import collections
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# relative number of queries in every hour of the day, the office hours are the busiest
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 3, 5, 8, 10, 10, 9, 8, 9, 10, 10, 9, 7, 5, 4, 3, 2, 2, 1]
+
+
+def generate_documents(docs, day, distinct_fqdns=5000, seed=42):
+    """
+    Generate the synthetic DNS-query documents of one day, sorted by @timestamp.
+
+    Args:
+        docs (int): The number of documents.
+        day (str): The day of the documents, YYYY-MM-DD.
+        distinct_fqdns (int): The number of distinct FQDNs, one in ten of them is a reverse 'in-addr.arpa' name.
+        seed (int): The seed of the random generator, the same arguments always give the same documents.
+
+    Returns:
+        tuple: The sorted list of timestamps in nanoseconds and the list of FQDNs of the documents.
+    """
+    rng = random.Random(seed)
+    day_start = int(datetime.fromisoformat(day).replace(tzinfo=timezone.utc).timestamp()) * 10**9
+    hour_ns = 3600 * 10**9
+    hours = rng.choices(range(24), weights=HOUR_WEIGHTS, k=docs)
+    timestamps = sorted(day_start + hour * hour_ns + rng.randrange(hour_ns) for hour in hours)
+    names = []
+    for index in range(distinct_fqdns):
+        if index % 10 == 9:
+            names.append(f'{index % 250 + 1}.{index // 250 % 250}.168.192.in-addr.arpa')
+        else:
+            names.append(f'host{index}.service{index % 37}.example.com')
+    weights = [1 / (rank + 1) for rank in range(distinct_fqdns)]
+    fqdns = rng.choices(names, weights=weights, k=docs)
+    return timestamps, fqdns
+
+
+def to_nanos(value):
+    """Convert an ES date ('2023-09-27T00:00:00', with optional fraction and 'Z') to nanoseconds."""
+    value = str(value).rstrip('Z')
+    fraction = 0
+    if '.' in value:
+        value, digits = value.split('.')
+        fraction = int(digits.ljust(9, '0')[:9])
+    seconds = int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+    return seconds * 10**9 + fraction
+
+
+def to_iso(nanos):
+    """Convert nanoseconds to the strict_date_optional_time_nanos format."""
+    moment = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=nanos // 10**9)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S') + '.%09dZ' % (nanos % 10**9)
+
+
+class FakeElasticsearch:
+    """The documents, the open PITs and the traffic counters shared by all the request handlers."""
+    def __init__(self, timestamps, fqdns, latency=0.0, compress=True, fail_every=0):
+        self.timestamps = timestamps
+        self.fqdns = fqdns
+        self.latency = latency
+        self.compress = compress
+        self.fail_every = fail_every
+        self.pits = set()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def find_range(self, query):
+        """Return the [lo, hi) positions of the documents matching the @timestamp range of the query."""
+        filters = query.get('bool', {}).get('filter', []) if 'bool' in query else [query]
+        lo, hi = 0, len(self.timestamps)
+        for query_filter in filters:
+            bounds = query_filter.get('range', {}).get('@timestamp')
+            if not bounds:
+                continue
+            if 'gte' in bounds:
+                lo = max(lo, bisect.bisect_left(self.timestamps, to_nanos(bounds['gte'])))
+            if 'gt' in bounds:
+                lo = max(lo, bisect.bisect_right(self.timestamps, to_nanos(bounds['gt'])))
+            if 'lte' in bounds:
+                hi = min(hi, bisect.bisect_right(self.timestamps, to_nanos(bounds['lte'])))
+            if 'lt' in bounds:
+                hi = min(hi, bisect.bisect_left(self.timestamps, to_nanos(bounds['lt'])))
+        return lo, max(lo, hi)
+
+    def search(self, body, filter_path):
+        lo, hi = self.find_range(body.get('query', {}))
+        if 'aggs' in body or 'aggregations' in body:
+            return self.composite(body.get('aggs') or body.get('aggregations'), lo, hi)
+        if 'pit' in body and body['pit']['id'] not in self.pits:
+            raise KeyError('No search context found for id [%s]' % body['pit']['id'])
+        if 'search_after' in body:
+            after = (to_nanos(body['search_after'][0]), int(body['search_after'][1]))
+            lo = max(lo, after[1] + 1)
+        slice_spec = body.get('slice')
+        size = body.get('size', 10)
+        positions = []
+        for position in range(lo, hi):
+            if slice_spec is None or position % slice_spec['max'] == slice_spec['id']:
+                positions.append(position)
+                if len(positions) >= size:
+                    break
+        source_fields = body.get('_source')
+        hits = []
+        for position in positions:
+            source = {'@timestamp': to_iso(self.timestamps[position]), 'fqdn': self.fqdns[position]}
+            if isinstance(source_fields, list):
+                source = {key: value for key, value in source.items() if key in source_fields}
+            hit = {'_index': 'dns_queries', '_id': str(position), '_score': None, '_source': source,
+                   'sort': [to_iso(self.timestamps[position]), position]}
+            hits.append(hit)
+        if filter_path:
+            kept = {part.split('.')[-1] for part in filter_path.split(',')}
+            hits = [{key: value for key, value in hit.items() if key in kept} for hit in hits]
+            return {'hits': {'hits': hits}} if hits else {}
+        return {'pit_id': body.get('pit', {}).get('id'), 'took': 1, 'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': hi - lo, 'relation': 'eq'}, 'max_score': None, 'hits': hits}}
+
+    def composite(self, aggs, lo, hi):
+        name, aggregation = next(iter(aggs.items()))
+        composite = aggregation['composite']
+        source_name = next(iter(composite['sources'][0]))
+        counts = collections.Counter(self.fqdns[lo:hi])
+        keys = sorted(counts)
+        if 'after' in composite:
+            keys = keys[bisect.bisect_right(keys, composite['after'][source_name]):]
+        keys = keys[:composite.get('size', 10)]
+        result = {'buckets': [{'key': {source_name: key}, 'doc_count': counts[key]} for key in keys]}
+        if keys:
+            result['after_key'] = {source_name: keys[-1]}
+        return {'took': 1, 'hits': {'total': {'value': hi - lo}, 'hits': []}, 'aggregations': {name: result}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeElasticsearch/0.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.fake.stats['bytes_received'] += len(raw)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        return json.loads(raw) if raw else {}
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.server.fake.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.fake.stats['bytes_sent'] += len(data)
+        self.server.fake.stats['requests'] += 1
+
+    def do_POST(self):
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.read_body()
+        try:
+            if url.path.endswith('/_pit'):
+                pit = uuid.uuid4().hex
+                with fake.lock:
+                    fake.pits.add(pit)
+                self.reply(200, {'id': pit})
+            elif url.path.endswith('/_count'):
+                lo, hi = fake.find_range(body.get('query', {}))
+                self.reply(200, {'count': hi - lo})
+            elif url.path.endswith('/_search'):
+                with fake.lock:
+                    fake.stats['searches'] += 1
+                    failing = fake.fail_every and fake.stats['searches'] % fake.fail_every == 0
+                if failing:
+                    self.reply(503, {'error': 'injected failure', 'status': 503})
+                    return
+                self.reply(200, fake.search(body, query.get('filter_path', [None])[0]))
+            else:
+                self.reply(404, {'error': f'unknown path {url.path}'})
+        except KeyError as e:
+            self.reply(404, {'error': {'type': 'search_context_missing_exception', 'reason': str(e)}})
+
+    def do_DELETE(self):
+        fake = self.server.fake
+        body = self.read_body()
+        with fake.lock:
+            found = body.get('id') in fake.pits
+            fake.pits.discard(body.get('id'))
+        self.reply(200 if found else 404, {'succeeded': found, 'num_freed': int(found)})
+
+
+def start_server(docs, day, port=0, latency=0.0, distinct_fqdns=5000, seed=42, compress=True, fail_every=0):
+    """
+    Start the fake server in a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its URL is http://127.0.0.1:<server.server_port>
+            and its FakeElasticsearch is server.fake. Stop it with server.shutdown().
+    """
+    timestamps, fqdns = generate_documents(docs, day, distinct_fqdns, seed)
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.fake = FakeElasticsearch(timestamps, fqdns, latency, compress, fail_every)
+    threading.Thread(target=server.serve_forever, name='fake-es', daemon=True).start()
+    logging.info('start_server(): Serving %s docs of %s on port %s', docs, day, server.server_port)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='A local stand-in for the Elasticsearch DNS-queries cluster')
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--docs', type=int, default=100000, help='the number of synthetic documents')
+    parser.add_argument('--day', default=(datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d'), help='the day of the documents')
+    parser.add_argument('--fqdns', type=int, default=5000, help='the number of distinct FQDNs')
+    parser.add_argument('--latency', type=float, default=0.0, help='the delay added to every request, in seconds')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--fail-every', type=int, default=0, help='answer every Nth search request with a 503')
+    args = parser.parse_args()
+    server = start_server(args.docs, args.day, args.port, args.latency, args.fqdns, args.seed, fail_every=args.fail_every)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,56 @@
+"""Checks of the PTR lookups of csv_transformation.py against the local stub server of fake_dns_server.py.
+
+Usage: python -m pytest -q test_dns_lookups.py (or python -m unittest test_dns_lookups)
+"""
+import time
+import unittest
+
+import csv_transformation
+import fake_dns_server
+
+
+class ResolvePtrTest(unittest.TestCase):
+    """resolve_ptr and resolve_ptrs against a stub server on an ephemeral port."""
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fake_dns_server.start_server(port=0, nxdomain_every=7)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def test_answer(self):
+        status, hostname, ttl = csv_transformation.resolve_ptr('4.3.2.10.in-addr.arpa', '127.0.0.1', timeout=1, port=self.server.port)
+        self.assertEqual(status, 'NOERROR')
+        self.assertEqual(hostname, 'ip-10-2-3-4.example.internal.')
+        self.assertEqual(ttl, fake_dns_server.TTL)
+
+    def test_nxdomain(self):
+        status, hostname, _ = csv_transformation.resolve_ptr('14.3.2.10.in-addr.arpa', '127.0.0.1', timeout=1, port=self.server.port)
+        self.assertEqual((status, hostname), ('NXDOMAIN', None))
+
+    def test_resolve_many(self):
+        names = [f'{last}.0.168.192.in-addr.arpa' for last in range(1, 50)]
+        results = csv_transformation.resolve_ptrs(names, '127.0.0.1', timeout=1, workers=8, port=self.server.port)
+        self.assertEqual(set(results), set(names))
+        for last in range(1, 50):
+            status, hostname, _ = results[f'{last}.0.168.192.in-addr.arpa']
+            if last % 7 == 0:
+                self.assertEqual((status, hostname), ('NXDOMAIN', None))
+            else:
+                self.assertEqual((status, hostname), ('NOERROR', f'ip-192-168-0-{last}.example.internal.'))
+
+    def test_timeout(self):
+        silent = fake_dns_server.start_server(port=0, drop_every=1)
+        try:
+            started = time.monotonic()
+            result = csv_transformation.resolve_ptr('4.3.2.10.in-addr.arpa', '127.0.0.1', timeout=0.2, attempts=2, port=silent.port)
+            self.assertEqual(result, ('TIMEOUT', None, 0))
+            self.assertGreaterEqual(time.monotonic() - started, 0.4)
+            self.assertEqual(silent.stats['dropped'], 2)
+        finally:
+            silent.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Checks of the on-disk PTR cache of csv_transformation.py, filled with the answers of fake_dns_server.py.
+
+Usage: python -m pytest -q test_ptr_cache.py (or python -m unittest test_ptr_cache)
+"""
+import os
+import tempfile
+import time
+import unittest
+
+import csv_transformation
+import fake_dns_server
+
+
+class PtrCacheTest(unittest.TestCase):
+    """The expiry, negative caching and LRU eviction of PtrCache, with the stub server answers."""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = fake_dns_server.start_server(port=0, nxdomain_every=7)
+        self.cache = csv_transformation.PtrCache(os.path.join(self.directory.name, 'ptr_cache.sqlite'),
+                                                 ttl=100, negative_ttl=50, failure_ttl=10, max_entries=3)
+
+    def tearDown(self):
+        self.cache.connection.close()
+        self.server.close()
+        self.directory.cleanup()
+
+    def resolve(self, names, port=None):
+        return csv_transformation.resolve_ptrs(names, '127.0.0.1', timeout=0.2, attempts=1, workers=4, port=port or self.server.port)
+
+    def test_cached_names_are_not_queried_again(self):
+        names = ['1.0.168.192.in-addr.arpa', '7.0.168.192.in-addr.arpa']
+        self.cache.put_many(self.resolve(names))
+        queries = self.server.stats['queries']
+        cached = self.cache.get_many(names)
+        self.assertEqual(cached['1.0.168.192.in-addr.arpa'][:2], ('NOERROR', 'ip-192-168-0-1.example.internal.'))
+        self.assertEqual(cached['7.0.168.192.in-addr.arpa'][:2], ('NXDOMAIN', None))
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['negative_hits'], 1)
+        self.assertEqual(self.resolve([name for name in names if name not in cached]), {})
+        self.assertEqual(self.server.stats['queries'], queries)
+
+    def test_ttl_expiry(self):
+        now = time.time()
+        found, missing = '1.0.168.192.in-addr.arpa', '7.0.168.192.in-addr.arpa'
+        self.cache.put_many(self.resolve([found, missing]), now=now)
+        # the NXDOMAIN answer expires after negative_ttl, the hostname after ttl
+        self.assertEqual(set(self.cache.get_many([found, missing], now=now + 49)), {found, missing})
+        self.assertEqual(set(self.cache.get_many([found, missing], now=now + 51)), {found})
+        self.assertEqual(self.cache.get_many([found, missing], now=now + 101), {})
+        self.assertEqual(self.cache.stats['expired'], 3)
+
+    def test_timeout_is_cached_for_failure_ttl(self):
+        silent = fake_dns_server.start_server(port=0, drop_every=1)
+        try:
+            results = self.resolve(['1.0.168.192.in-addr.arpa'], port=silent.port)
+        finally:
+            silent.close()
+        self.assertEqual(results['1.0.168.192.in-addr.arpa'][0], 'TIMEOUT')
+        now = time.time()
+        self.cache.put_many(results, now=now)
+        self.assertIn('1.0.168.192.in-addr.arpa', self.cache.get_many(['1.0.168.192.in-addr.arpa'], now=now + 9))
+        self.assertEqual(self.cache.get_many(['1.0.168.192.in-addr.arpa'], now=now + 11), {})
+
+    def test_lru_eviction(self):
+        names = [f'{last}.0.168.192.in-addr.arpa' for last in range(1, 6)]
+        now = time.time()
+        for offset, name in enumerate(names):
+            self.cache.put_many(self.resolve([name]), now=now + offset)
+        # using the oldest entry makes it the most recently used one
+        self.cache.get_many([names[0]], now=now + 10)
+        self.cache.evict()
+        self.assertEqual(self.cache.stats['evicted'], 2)
+        self.assertEqual(set(self.cache.get_many(names, now=now + 11)), {names[0], names[3], names[4]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,218 @@
+"""Checks of the run manifest of csv_transformation.py: the skipped stages, the restore of the month file and
+the merge of a day into its month when a run is interrupted between the appending, appended and combined steps.
+
+Usage: python -m pytest -q test_run_manifest.py (or python -m unittest test_run_manifest)
+"""
+import argparse
+import csv
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import csv_transformation
+from compressed_files import open_file
+
+HEADER = ['query', 'total quantity', 'service provider name', 'sid']
+DAY = '2026-09-30'
+
+
+def write_rows(file_name, rows, mode='w'):
+    with open_file(file_name, mode, newline='') as file:
+        csv.writer(file).writerows(rows)
+
+
+def read_rows(file_name):
+    with open_file(file_name, 'r', newline='') as file:
+        return list(csv.reader(file))
+
+
+def copy_rows(source, destination):
+    write_rows(destination, read_rows(source))
+
+
+class Interrupted(Exception):
+    """The crash of a run, raised by the patched steps."""
+
+
+class RunManifestTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.manifest_file = self.path('run_manifest.json')
+        self.source, self.target = self.path('source.csv'), self.path('target.csv')
+        write_rows(self.source, [['a.example.com', 1]])
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_unchanged_stage_is_done(self):
+        manifest = csv_transformation.RunManifest(self.manifest_file, DAY)
+        self.assertTrue(manifest.run_stage('copy', [self.source], [self.target], copy_rows, self.source, self.target))
+        self.assertTrue(manifest.is_done('copy', [self.source], [self.target]))
+        # a rerun loads the manifest from the file and skips the stage
+        rerun = csv_transformation.RunManifest(self.manifest_file, DAY)
+        with mock.patch('test_run_manifest.copy_rows') as function:
+            self.assertFalse(rerun.run_stage('copy', [self.source], [self.target], function, self.source, self.target))
+        function.assert_not_called()
+
+    def test_stage_is_not_done_when_an_input_or_output_changed(self):
+        manifest = csv_transformation.RunManifest(self.manifest_file, DAY)
+        self.assertFalse(manifest.is_done('copy', [self.source], [self.target]))
+        manifest.run_stage('copy', [self.source], [self.target], copy_rows, self.source, self.target)
+        write_rows(self.source, [['b.example.com', 2]], mode='a')
+        self.assertFalse(manifest.is_done('copy', [self.source], [self.target]))
+        manifest.run_stage('copy', [self.source], [self.target], copy_rows, self.source, self.target)
+        write_rows(self.target, [['c.example.com', 3]])
+        self.assertFalse(manifest.is_done('copy', [self.source], [self.target]))
+        os.remove(self.target)
+        self.assertFalse(manifest.is_done('copy', [self.source], [self.target]))
+
+    def test_output_rewritten_by_a_later_stage(self):
+        manifest = csv_transformation.RunManifest(self.manifest_file, DAY)
+        manifest.run_stage('copy', [self.source], [self.target], copy_rows, self.source, self.target)
+        manifest.run_stage('count', [self.target], [self.target], csv_transformation.count_queries_from_csv, self.target)
+        write_rows(self.source, [['a.example.com', 1]])
+        self.assertTrue(manifest.is_done('copy', [self.source], [self.target]))
+        self.assertTrue(manifest.is_done('count', [self.target], [self.target]))
+        # running the first stage again drops the record of the later one, its input may have changed
+        write_rows(self.source, [['b.example.com', 2]], mode='a')
+        manifest.run_stage('copy', [self.source], [self.target], copy_rows, self.source, self.target)
+        self.assertEqual(manifest.state['order'], ['copy'])
+        self.assertFalse(manifest.is_done('count', [self.target], [self.target]))
+
+
+class RestoreMonthFileTest(unittest.TestCase):
+    suffixes = ('', '.gz')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def marked_month_file(self, suffix):
+        """A month file with a first day and the 'appending' marker taken before appending the second one."""
+        month_file = os.path.join(self.directory, f'september_2026.csv{suffix}')
+        write_rows(month_file, [HEADER] + [[f'host{index}.example.com', index, 'aws', 'sid-1'] for index in range(100)])
+        manifest = csv_transformation.RunManifest(os.path.join(self.directory, 'run_manifest.json'), DAY)
+        manifest.mark_merged(month_file, 'appending')
+        return month_file, manifest.merge_marker(month_file)
+
+    def test_unchanged_file_is_kept(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                month_file, marker = self.marked_month_file(suffix)
+                self.assertEqual(set(marker), {'step', 'bytes', 'at', 'tail_sha256'})
+                self.assertFalse(csv_transformation.restore_month_file(month_file, marker))
+                self.assertEqual(os.path.getsize(month_file), marker['bytes'])
+
+    def test_appended_rows_are_cut(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                month_file, marker = self.marked_month_file(suffix)
+                rows = read_rows(month_file)
+                write_rows(month_file, [['new.example.com', 5, 'aws', 'sid-1']], mode='a')
+                with open(month_file, 'ab') as file:
+                    # the torn end of an interrupted write
+                    file.write(b'\x1f\x8b\x08partial' if suffix else b'partial.example.c')
+                self.assertTrue(csv_transformation.restore_month_file(month_file, marker))
+                self.assertEqual(read_rows(month_file), rows)
+
+    def test_rewritten_or_shorter_file_is_not_cut(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                month_file, marker = self.marked_month_file(suffix)
+                rows = read_rows(month_file)
+                write_rows(month_file, [rows[0], ['other.example.com', 1, 'aws', 'sid-1']] + rows[1:])
+                with self.assertRaises(RuntimeError):
+                    csv_transformation.restore_month_file(month_file, marker)
+                write_rows(month_file, rows[:10])
+                with self.assertRaises(RuntimeError):
+                    csv_transformation.restore_month_file(month_file, marker)
+
+
+class MergeDayInterruptedTest(unittest.TestCase):
+    """merge_day interrupted at every step of the merge marker, then run again: the day is counted exactly once."""
+    suffixes = ('', '.gz')
+    crash_points = ('before appending', 'before append_csv', 'during append_csv', 'before appended',
+                    'before count_appended', 'before replacing the combined file', 'before combined')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def merge(self, suffix, name):
+        """Return the options, daily file and month file of a month with one day merged, in a directory of its own."""
+        directory = os.path.join(self.directory, f'{name}{suffix}')
+        os.makedirs(directory)
+        month_file = os.path.join(directory, f'september_2026.csv{suffix}')
+        write_rows(month_file, [HEADER] + [[f'host{index}.example.com', index + 1, 'aws', 'sid-1'] for index in range(50)])
+        daily_file = os.path.join(directory, f'dns_result_{DAY}.csv{suffix}')
+        write_rows(daily_file, [[f'host{index}.example.com', 1000, 'aws', 'sid-1'] for index in range(25, 75)]
+                   + [['short.example.com', 3]])
+        options = argparse.Namespace(month_file=month_file, no_manifest=False, manifest=os.path.join(directory, 'run_manifest.json'),
+                                     export_month=False, compact=False)
+        return options, daily_file, month_file
+
+    def expected_rows(self, suffix):
+        options, daily_file, month_file = self.merge(suffix, 'expected')
+        csv_transformation.merge_day(DAY, daily_file, options)
+        return read_rows(month_file)
+
+    def interrupted_append(self, final_file, month_file_name):
+        """Append half of the day and the torn end of a write, then crash."""
+        rows = read_rows(final_file)
+        write_rows(month_file_name, rows[:len(rows) // 2], mode='a')
+        with open(month_file_name, 'ab') as file:
+            file.write(b'\x1f\x8b\x08' if month_file_name.endswith('.gz') else b'host60.exa')
+        raise Interrupted()
+
+    def crashes(self, month_file):
+        """The patches that interrupt merge_day at every step, by crash point."""
+        mark_merged = csv_transformation.RunManifest.mark_merged
+        replace = os.replace
+
+        def crash_at(step):
+            def patched(manifest, month_file_name, marked_step):
+                if marked_step == step:
+                    raise Interrupted()
+                return mark_merged(manifest, month_file_name, marked_step)
+            return mock.patch.object(csv_transformation.RunManifest, 'mark_merged', patched)
+
+        def replace_month(source, destination):
+            if destination == month_file:
+                raise Interrupted()
+            return replace(source, destination)
+
+        return {
+            'before appending': crash_at('appending'),
+            'before append_csv': mock.patch('csv_transformation.append_csv', side_effect=Interrupted()),
+            'during append_csv': mock.patch('csv_transformation.append_csv', self.interrupted_append),
+            'before appended': crash_at('appended'),
+            'before count_appended': mock.patch('csv_transformation.count_appended', side_effect=Interrupted()),
+            'before replacing the combined file': mock.patch('csv_transformation.os.replace', replace_month),
+            'before combined': crash_at('combined'),
+        }
+
+    def test_interrupted_merge_counts_the_day_once(self):
+        for suffix in self.suffixes:
+            expected = self.expected_rows(suffix)
+            self.assertIn(['host30.example.com', '1031', 'aws', 'sid-1'], expected)
+            for crash in self.crash_points:
+                with self.subTest(suffix=suffix, crash=crash):
+                    options, daily_file, month_file = self.merge(suffix, crash.replace(' ', '_'))
+                    with self.crashes(month_file)[crash], self.assertRaises(Interrupted):
+                        csv_transformation.merge_day(DAY, daily_file, options)
+                    csv_transformation.merge_day(DAY, daily_file, options)
+                    self.assertEqual(read_rows(month_file), expected)
+                    # merged once, a third run leaves the month file alone
+                    size = os.path.getsize(month_file)
+                    csv_transformation.merge_day(DAY, daily_file, options)
+                    self.assertEqual(os.path.getsize(month_file), size)
+                    self.assertEqual(csv_transformation.RunManifest(options.manifest, DAY).merged_into_month(month_file), 'combined')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+"""Checks that the faster modes of csv_transformation.py write the same files as the original four steps.
+
+Every test builds a small day (and month) file from a fixed seed, runs the original functions on one copy and
+the mode under test on another one, and compares the rows. The reversed names are resolved by fake_dns_server.py.
+Usage: python -m pytest -q test_transformation_modes.py (or python -m unittest test_transformation_modes)
+"""
+import csv
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import csv_transformation
+import fake_dns_server
+from compressed_files import open_file
+
+PROVIDER_ROWS = [
+    ['aws', 'sid-1', 'prod', 'amazonaws.com'],
+    ['gcp', 'sid-2', 'prod', 'googleapis.com'],
+    ['internal', 'sid-3', 'dev', 'example.internal'],
+    ['ip-192', 'sid-4', 'dev', 'ip-192-168'],
+]
+
+
+def write_rows(file_name, rows):
+    with open_file(file_name, 'w', newline='') as file:
+        csv.writer(file).writerows(rows)
+
+
+def read_rows(file_name):
+    with open_file(file_name, 'r', newline='') as file:
+        return list(csv.reader(file))
+
+
+def day_rows(seed=7, rows=400):
+    """The 'fqdn,count' rows of an original file: repeated names, reversed names (some NXDOMAIN, some resolving
+    to a name that is also queried directly), names shorter than 4 characters and rows without a count."""
+    generator = random.Random(seed)
+    names = [f'host{index}.amazonaws.com' for index in range(20)]
+    names += [f'api{index}.googleapis.com' for index in range(10)]
+    names += [f'site{index}.example.org' for index in range(10)]
+    names += [f'{last}.0.168.192.in-addr.arpa' for last in range(1, 15)]
+    names += ['ip-192-168-0-1.example.internal.', 'a.b', 'xyz']
+    result = []
+    for _ in range(rows):
+        name = generator.choice(names)
+        if generator.random() < 0.05:
+            result.append([name])
+        else:
+            result.append([name, generator.randint(1, 50)])
+    return result
+
+
+class TransformationModeTest(unittest.TestCase):
+    """A temporary directory with the provider file, the stub DNS server and the helpers shared by the tests."""
+    suffixes = ('', '.gz')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fake_dns_server.start_server(port=0, nxdomain_every=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.file_to_match = self.path('file_to_match.csv')
+        write_rows(self.file_to_match, PROVIDER_ROWS)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def lookup_options(self):
+        return {'dns_server': '127.0.0.1', 'dns_port': self.server.port, 'timeout': 1, 'workers': 4}
+
+    def four_steps(self, original_file, suffix, count_queries=csv_transformation.count_queries_from_csv, name='four_steps'):
+        """Run the original reversed_values_lookup, replace_found_fqdns, count_queries_from_csv (or 'count_queries')
+        and update_csv_file_with_columns, and return the daily file."""
+        final_file = self.path(f'{name}.csv{suffix}')
+        updated_values_file = self.path(f'{name}_updated_values.csv{suffix}')
+        csv_transformation.reversed_values_lookup(original_csv_file=original_file, updated_values_file=updated_values_file,
+                                                  **self.lookup_options())
+        csv_transformation.replace_found_fqdns(original_file, updated_values_file, final_file)
+        count_queries(final_file)
+        csv_transformation.update_csv_file_with_columns(self.file_to_match, final_file)
+        return final_file
+
+    def assert_same_counts(self, count_queries, suffix, rows=2000):
+        """Count a copy of the same 'query,count' file with count_queries_from_csv and with 'count_queries'."""
+        expected_file, counted_file = self.path(f'expected.csv{suffix}'), self.path(f'counted.csv{suffix}')
+        write_rows(expected_file, day_rows(rows=rows))
+        shutil.copyfile(expected_file, counted_file)
+        csv_transformation.count_queries_from_csv(expected_file)
+        count_queries(counted_file)
+        self.assertEqual(read_rows(counted_file), read_rows(expected_file))
+
+
+class StreamingTest(TransformationModeTest):
+    def test_transform_streaming_writes_the_four_steps_daily_file(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                original_file = self.path(f'dns_result_original.csv{suffix}')
+                write_rows(original_file, day_rows())
+                expected = read_rows(self.four_steps(original_file, suffix))
+                final_file = self.path(f'streaming.csv{suffix}')
+                csv_transformation.transform_streaming(self.file_to_match, original_csv_file=original_file,
+                                                       updated_values_file=self.path(f'streaming_updated_values.csv{suffix}'),
+                                                       final_file=final_file, **self.lookup_options())
+                self.assertEqual(read_rows(final_file), expected)
+                # the fixture covers the replaced, unresolved, provider and short names
+                names = {row[0] for row in expected}
+                self.assertIn('ip-192-168-0-1.example.internal.', names)
+                self.assertIn('5.0.168.192.in-addr.arpa', names)
+                self.assertNotIn('xyz', names)
+                self.assertTrue(any(len(row) == 4 for row in expected) and any(len(row) == 2 for row in expected))
+
+
+class ParallelCountTest(TransformationModeTest):
+    @staticmethod
+    def count_in_processes(final_file):
+        # 8 byte ranges reduced in 3 partitions, so the merge by first row is exercised (a '.gz' file falls back to one process)
+        csv_transformation.count_queries_parallel(final_file, workers=2, partitions=3, chunks_per_worker=4)
+
+    def test_count_queries_parallel_counts_like_count_queries_from_csv(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                self.assert_same_counts(self.count_in_processes, suffix)
+
+    def test_count_queries_parallel_writes_the_four_steps_daily_file(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                original_file = self.path(f'dns_result_original.csv{suffix}')
+                write_rows(original_file, day_rows())
+                expected = read_rows(self.four_steps(original_file, suffix))
+                final_file = self.four_steps(original_file, suffix, self.count_in_processes, name='parallel')
+                self.assertEqual(read_rows(final_file), expected)
+
+
+
+def month_rows(seed=11, days=5):
+    """The rows of a month file: a header and the daily rows of several days, with and without a provider,
+    plus a few non-numeric quantities."""
+    generator = random.Random(seed)
+    rows = [['query', 'count', 'provider', 'sid']]
+    for day in range(days):
+        for index in range(60):
+            name = f'host{generator.randint(0, 40)}.amazonaws.com'
+            if index % 3 == 0:
+                rows.append([name, generator.randint(1, 500)])
+            else:
+                rows.append([name, generator.randint(1, 500), 'aws', 'sid-1'])
+        rows.append([f'day{day}.example.internal', 'n/a', 'internal', 'sid-3'])
+        rows.append(['day0.example.internal', day, 'internal', 'sid-3'])
+    return rows
+
+
+class CompactTest(TransformationModeTest):
+    def test_count_queries_compact_counts_like_count_queries_from_csv(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                self.assert_same_counts(csv_transformation.count_queries_compact, suffix)
+
+    def test_count_queries_compact_writes_the_four_steps_daily_file(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                original_file = self.path(f'dns_result_original.csv{suffix}')
+                write_rows(original_file, day_rows())
+                expected = read_rows(self.four_steps(original_file, suffix))
+                final_file = self.four_steps(original_file, suffix, csv_transformation.count_queries_compact, name='compact')
+                self.assertEqual(read_rows(final_file), expected)
+
+    def test_count_appended_compact_writes_the_count_appended_month_file(self):
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                expected_file, compact_file = self.path(f'month.csv{suffix}'), self.path(f'month_compact.csv{suffix}')
+                write_rows(expected_file, month_rows())
+                shutil.copyfile(expected_file, compact_file)
+                self.assertEqual(csv_transformation.count_appended_compact(compact_file),
+                                 csv_transformation.count_appended(expected_file))
+                self.assertEqual(read_rows(compact_file), read_rows(expected_file))
+
+    def test_count_appended_compact_sums_the_fractions_apart(self):
+        # count_appended adds the quantities in row order, count_appended_compact adds the integers and then
+        # the sum of the fractional quantities: float addition is not associative, so the last digits can differ
+        rows = [['query', 'count', 'provider', 'sid']]
+        rows += [['host.amazonaws.com', value, 'aws', 'sid-1'] for value in ('1', '2', '0.1', '0.2')]
+        expected_file, compact_file = self.path('month.csv'), self.path('month_compact.csv')
+        write_rows(expected_file, rows)
+        write_rows(compact_file, rows)
+        csv_transformation.count_appended(expected_file)
+        csv_transformation.count_appended_compact(compact_file)
+        self.assertEqual(read_rows(expected_file)[1][1], '3.3000000000000003')
+        self.assertEqual(read_rows(compact_file)[1][1], '3.3')
+        self.assertAlmostEqual(float(read_rows(compact_file)[1][1]), float(read_rows(expected_file)[1][1]))
+
+
+if __name__ == "__main__":
+    unittest.main()